@@ -1,13 +1,29 @@
+import os
+import json
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from sklearn import preprocessing
-from scipy.io.wavfile import read
-from python_speech_features import mfcc
-from python_speech_features import delta
-from speechpy.processing import cmvn
-from dtw import dtw
+from banded_dtw import dtw_distance, dtw_distance_batch
+import instrumentation
 
-def acoustic_distance(file1, file2):
-  """Computes the acoustic distance between audio files based on Bartelds (2020)."""
+# Half-width (in frames) of the slanted band that constrains the DTW warping path
+WINDOW_SIZE = 200
+
+# MFCC parameters used for every recording. Cached features are keyed on these
+# (see FeatureCache), so changing any of them automatically invalidates the cache.
+MFCC_PARAMS = {'winlen': 0.025,
+               'winstep': 0.01,
+               'preemph': 0.97,
+               'numcep': 12,
+               'appendEnergy': True,
+               #'nfft': 1024
+               'nfft': 2048}   # Changed from 1024 by L Bailey
+
+def acoustic_features(file, params=MFCC_PARAMS):
+  """Computes the feature matrix used by acoustic_distance() for one recording:
+  MFCCs + deltas + double-deltas (frames x 36), with cepstral mean and variance
+  normalization. This is the per-file part of Bartelds (2020)."""
 
   """L Bailey made a single change to this function: the nfft parameter in mfcc() is
   set to 2048 instead of the original 1024, to be compatible with the sample rate of
@@ -21,35 +37,225 @@ def acoustic_distance(file1, file2):
 
 
   """
-  rate1, audio1 = read(file1)
-  rate2, audio2 = read(file2)
-  mfcc_feature1 = mfcc(audio1,
-                      rate1,
-                      winlen = 0.025,
-                      winstep = 0.01,
-                      preemph = 0.97,
-                      numcep = 12,
-                      appendEnergy = True,
-                      winfunc = np.hamming,
-                      #nfft=1024
-                      nfft=2048)   # Changed from 1024 by L Bailey
-  mfcc_feature2 = mfcc(audio2,
-                      rate2,
-                      winlen = 0.025,
-                      winstep = 0.01,
-                      preemph = 0.97,
-                      numcep = 12,
-                      appendEnergy = True,
-                      winfunc = np.hamming,
-                      #nfft=1024
-                      nfft=2048)   # Changed from 1024 by L Bailey
-  deltas1 = delta(mfcc_feature1, 2)
-  double_deltas1 = delta(deltas1, 2)
-  deltas2 = delta(mfcc_feature2, 2)
-  double_deltas2 = delta(deltas2, 2)
-  combined1 = np.hstack((mfcc_feature1, deltas1, double_deltas1))
-  combined2 = np.hstack((mfcc_feature2, deltas2, double_deltas2))
-  combined1 = cmvn(combined1, variance_normalization=True)
-  combined2 = cmvn(combined2, variance_normalization=True)
-  res = dtw(combined1, combined2, window_type="slantedband", window_args={"window_size" : 200}, distance_only=True)
-  return res.distance / (combined1.shape[1] + combined2.shape[1])
+  # Imported here, so that processes which only read cached features don't need them
+  from scipy.io.wavfile import read
+  from python_speech_features import mfcc
+  from python_speech_features import delta
+  from speechpy.processing import cmvn
+
+  with instrumentation.phase('acoustic.wav_read'):
+    rate, audio = read(file)
+  with instrumentation.phase('acoustic.mfcc'):
+    mfcc_feature = mfcc(audio,
+                        rate,
+                        winfunc = np.hamming,
+                        **params)
+    deltas = delta(mfcc_feature, 2)
+    double_deltas = delta(deltas, 2)
+    combined = np.hstack((mfcc_feature, deltas, double_deltas))
+    combined = cmvn(combined, variance_normalization=True)
+  return combined
+
+def acoustic_distance_features(combined1, combined2):
+  """Computes the acoustic distance between two feature matrices returned by
+  acoustic_features() (or FeatureCache.load())."""
+  with instrumentation.phase('acoustic.dtw', pairs=1):
+    distance = dtw_distance(combined1, combined2, window_size=WINDOW_SIZE)
+  return distance / (combined1.shape[1] + combined2.shape[1])
+
+def acoustic_distance_batch(combined1, others):
+  """Computes the acoustic distance between one feature matrix and each of a list
+  of feature matrices, with a single batched DTW call."""
+  with instrumentation.phase('acoustic.dtw', pairs=len(others)):
+    distances = dtw_distance_batch(combined1, others, window_size=WINDOW_SIZE)
+  if np.isinf(distances).any():
+    raise ValueError('No warping path found compatible with the local constraints')
+  return distances / (combined1.shape[1] + np.array([other.shape[1] for other in others]))
+
+def acoustic_distance(file1, file2, cache=None):
+  """Computes the acoustic distance between audio files based on Bartelds (2020).
+
+  If a FeatureCache is given, features are read from (and saved to) the cache
+  rather than recomputed from the audio on every call."""
+  if cache is None:
+    combined1 = acoustic_features(file1)
+    combined2 = acoustic_features(file2)
+  else:
+    combined1 = cache.load(file1)
+    combined2 = cache.load(file2)
+  return acoustic_distance_features(combined1, combined2)
+
+@instrumentation.traced
+def pairwise_acoustic_distances(file_pairs, cache, n_jobs=1, chunksize=256):
+  """Computes acoustic_distance() for every (file1, file2) in file_pairs, returning
+  an array of distances in the same order.
+
+  Features come from the FeatureCache. Consecutive pairs that share their first
+  file (i.e. one row of an RDM) are scored together with one batched DTW call.
+  With n_jobs > 1 (or None, for all cores) these rows are packed into chunks of
+  about chunksize pairs and spread over a process pool. Chunks never split a row
+  and every distance is written back to its own position, so the result does not
+  depend on the number of workers."""
+  if n_jobs is None:
+    n_jobs = os.cpu_count()
+
+  distances = np.zeros(len(file_pairs))
+  tasks = [(k, file1, file2) for k, (file1, file2) in enumerate(file_pairs)]
+
+  chunks = []
+  for _, row in itertools.groupby(tasks, key=lambda task: task[1]):
+    if not chunks or len(chunks[-1]) >= chunksize:
+      chunks.append([])
+    chunks[-1].extend(row)
+
+  if n_jobs == 1 or len(chunks) <= 1:
+    for chunk in chunks:
+      for k, distance in _distance_worker(cache, chunk):
+        distances[k] = distance
+    cache.evict()
+    return distances
+
+  with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+
+    # Featurize every recording first (one task per file), so that no two workers
+    # ever compute the features of the same recording
+    files = sorted(set(f for pair in file_pairs for f in pair))
+    entries = list(pool.map(_feature_worker, [cache] * len(files), files, chunksize=16))
+
+    # Evict here, once, rather than in every worker (where one worker could
+    # delete the entries another has just written), keeping this batch's entries
+    cache.evict(keep=entries)
+
+    # Then compute the distances, streaming each chunk's results back as it finishes
+    for result in pool.map(_distance_worker, [cache] * len(chunks), chunks):
+      for k, distance in result:
+        distances[k] = distance
+
+  return distances
+
+# Pool workers (these must be top-level functions so that they can be pickled)
+def _feature_worker(cache, file):
+  cache.load(file)
+  instrumentation.flush()
+  return cache.path(file)
+
+def _distance_worker(cache, tasks):
+  features = {}
+  results = []
+  for file1, row in itertools.groupby(tasks, key=lambda task: task[1]):
+    row = list(row)
+    for file in [file1] + [file2 for _, _, file2 in row]:
+      if file not in features:
+        features[file] = cache.load(file)
+    row_distances = acoustic_distance_batch(features[file1], [features[file2] for _, _, file2 in row])
+    results.extend(zip([k for k, _, _ in row], row_distances))
+  instrumentation.flush()
+  return results
+
+
+class FeatureCache:
+  """On-disk cache of acoustic_features(), one .npy file per recording.
+
+  Entries are keyed on the content of the WAV file and the MFCC parameters, so
+  a re-recorded (or renamed/copied) file is always featurized correctly, and
+  features are shared between any runs that use the same recordings. Cached
+  arrays are loaded memory-mapped (read-only).
+
+  When the cache grows beyond max_bytes, evict() deletes the least recently
+  used entries (pairwise_acoustic_distances() calls it once per batch). An entry
+  that is deleted before it is read is recomputed.
+  """
+
+  # Bump this if acoustic_features() changes in a way the parameters don't capture
+  version = 1
+
+  def __init__(self, cache_dir, max_bytes=2 * 1024**3, params=MFCC_PARAMS):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.params = dict(params)
+    self.hits = 0
+    self.misses = 0
+
+    # Content hashes, remembered per (path, size, mtime) so that unchanged files
+    # are only read once per session
+    self._hashes = {}
+
+  def key(self, file):
+    """Cache key for a recording: hash of the file contents + feature parameters."""
+    stat = os.stat(file)
+    stamp = (os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+    if stamp not in self._hashes:
+      with instrumentation.phase('acoustic_cache.hash'):
+        h = hashlib.sha1()
+        with open(file, 'rb') as f:
+          for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+        self._hashes[stamp] = h.hexdigest()
+
+    params = json.dumps(self.params, sort_keys=True) + str(self.version)
+    return self._hashes[stamp] + '_' + hashlib.sha1(params.encode()).hexdigest()[:12]
+
+  def path(self, file):
+    return os.path.join(self.cache_dir, self.key(file) + '.npy')
+
+  def load(self, file):
+    """Return the features for a recording, computing and caching them if needed."""
+    fn = self.path(file)
+
+    # An entry can be evicted (by another process) at any time, so a missing
+    # file at any point is a miss
+    try:
+      features = np.load(fn, mmap_mode='r')
+    except FileNotFoundError:
+      pass
+    else:
+      self.hits += 1
+      instrumentation.count('acoustic_cache.hit')
+
+      # Touch the entry so that eviction removes the least recently *used* files
+      try:
+        os.utime(fn)
+      except FileNotFoundError:
+        pass
+      return features
+
+    self.misses += 1
+    instrumentation.count('acoustic_cache.miss')
+    os.makedirs(self.cache_dir, exist_ok=True)
+    features = acoustic_features(file, self.params)
+
+    # Write to a temporary file first, so that an interrupted run (or another
+    # process writing the same entry) never leaves a truncated file behind
+    tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+    with open(tmp_fn, 'wb') as f:
+      np.save(f, features)
+    os.replace(tmp_fn, fn)
+    return features
+
+  def evict(self, keep=()):
+    """Delete least recently used entries (other than the paths in keep) until
+    the cache fits in max_bytes."""
+    keep = set(keep)
+    if not os.path.isdir(self.cache_dir):
+      return
+    entries = []
+    for entry in os.scandir(self.cache_dir):
+      if entry.name.endswith('.npy'):
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, fn in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      if fn in keep:
+        continue
+      # Entries that are still memory-mapped can't be removed on Windows; skip them
+      try:
+        os.remove(fn)
+      except OSError:
+        pass
+      total -= size
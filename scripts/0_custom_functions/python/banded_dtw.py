@@ -0,0 +1,139 @@
+############################################################
+# Distance-only dynamic time warping with a slanted band
+############################################################
+
+# This is a dedicated replacement for the call that acoustic_distance() used to
+# make to the dtw package:
+#
+#   dtw(x, y, window_type="slantedband", window_args={"window_size": 200},
+#       distance_only=True).distance
+#
+# i.e. euclidean local distances, the (default) symmetric2 step pattern:
+#
+#   g[i, j] = min(g[i-1, j-1] + 2*d[i, j],
+#                 g[i-1, j  ] +   d[i, j],
+#                 g[i,   j-1] +   d[i, j])
+#
+# and a band of +/- window_size reference frames around the diagonal joining
+# (0, 0) and (N-1, M-1).
+#
+# The recursion is run one query frame (row i) at a time, and only the previous
+# row is kept in memory. Within a row, the diagonal and vertical steps only need
+# the previous row, so they are computed for the whole row at once. The
+# horizontal step, g[j] = min(a[j], g[j-1] + d[j]), is a running minimum, and is
+# also computed for the whole row at once using cumulative sums:
+#
+#   g[j] = C[j] + min(a[l] - C[l] for l <= j),   where C = cumsum(d)
+#
+# Local costs are only computed for the part of each row that falls inside the
+# band, for a block of rows at a time (one matrix multiply per block, with the
+# block size chosen so that the costs never take more than max_bytes).
+#
+# dtw_distance_batch() scores one query against many references at once (each
+# reference is an extra column in every array), which is how the phonological
+# model uses it: every recording against all the recordings after it in the
+# word list.
+
+import numpy as np
+
+
+def dtw_distance(query, reference, window_size=200):
+    """DTW distance between two (frames x features) arrays."""
+    distance = dtw_distance_batch(query, [reference], window_size)[0]
+    if np.isinf(distance):
+        raise ValueError('No warping path found compatible with the local constraints')
+    return distance
+
+
+def dtw_distance_batch(query, references, window_size=200, max_bytes=16 * 1024**2):
+    """DTW distance between one query and each of a list of references (all
+    frames x features arrays). Returns an array with one distance per reference
+    (inf if the band does not allow any warping path)."""
+
+    query = np.asarray(query, dtype=float)
+    n, n_features = query.shape
+
+    # Stack the references into one zero-padded (max_frames x n_refs x features)
+    # array, so that any range of reference frames is a contiguous block
+    lengths = np.array([len(r) for r in references])
+    n_refs = len(references)
+    m = lengths.max()
+    refs = np.zeros((m, n_refs, n_features))
+    for r, reference in enumerate(references):
+        refs[:lengths[r], r] = reference
+
+    # Squared norms, for |x - y|^2 = |x|^2 + |y|^2 - 2 x.y
+    query_sq = np.einsum('if,if->i', query, query)
+    refs_sq = np.einsum('jrf,jrf->jr', refs, refs)
+
+    # Slope of the band's centre line for each reference (as in dtw's slantedband)
+    if n > 1:
+        slope = (lengths - 1) / (n - 1)
+    else:
+        slope = np.zeros(n_refs)
+
+    # First and last reference frame inside the band, for each query frame (rows)
+    # and reference (columns)
+    centre = np.arange(n)[:, None] * slope
+    first = np.maximum(0, np.ceil(centre - window_size)).astype(int)
+    last = np.minimum(lengths - 1, np.floor(centre + window_size)).astype(int)
+
+    # Range of reference frames [lo, hi) inside the band of at least one reference
+    band_lo = first.min(axis=1)
+    band_hi = np.maximum(band_lo, last.max(axis=1) + 1)
+
+    # Number of query frames per block of local costs
+    block = max(1, max_bytes // (8 * m * n_refs))
+
+    # Rolling buffers for the cumulative cost of the previous and current rows.
+    # Row 0 of each buffer stands for j = -1 (always inf), so reference frame j
+    # is row j + 1.
+    j_all = np.arange(m)[:, None]
+    prev = np.full((m + 1, n_refs), np.inf)
+    cur = np.full((m + 1, n_refs), np.inf)
+
+    for i in range(n):
+
+        # Local (euclidean) distances for the next block of rows (band only),
+        # clipped at zero against rounding error
+        if i % block == 0:
+            i_stop = min(n, i + block)
+            block_lo, block_hi = band_lo[i], max(band_lo[i], band_hi[i:i_stop].max())
+            costs = query[i:i_stop] @ refs[block_lo:block_hi].reshape(-1, n_features).T
+            costs = costs.reshape(i_stop - i, block_hi - block_lo, n_refs)
+            costs *= -2
+            costs += refs_sq[block_lo:block_hi]
+            costs += query_sq[i:i_stop, None, None]
+            np.maximum(costs, 0, out=costs)
+            np.sqrt(costs, out=costs)
+
+        lo, hi = band_lo[i], band_hi[i]
+        cur.fill(np.inf)
+
+        if lo < hi:
+            j = j_all[lo:hi]
+            invalid = (j < first[i]) | (j > last[i])
+
+            d = costs[i % block, lo - block_lo:hi - block_lo]
+
+            # Best cost of reaching each cell from the previous row (vertical or diagonal)
+            if i == 0:
+                a = np.full((hi - lo, n_refs), np.inf)
+                a[0] = d[0]
+            else:
+                a = prev[lo + 1:hi + 1] + d
+                np.minimum(a, prev[lo:hi] + 2 * d, out=a)
+
+            # Then allow horizontal steps along the row (running minimum)
+            c = np.cumsum(d, axis=0)
+            a -= c
+            a[invalid] = np.inf
+            g = np.minimum.accumulate(a, axis=0)
+            g += c
+            g[invalid] = np.inf
+
+            cur[lo + 1:hi + 1] = g
+
+        prev, cur = cur, prev
+
+    return prev[lengths, np.arange(n_refs)]
@@ -0,0 +1,165 @@
+############################################################
+# Voxelwise JZS Bayes factors for group maps
+############################################################
+
+# Python version of compute_wholebrain_bfs_onesample.m and
+# compute_wholebrain_bfs_twosample.m, which call bf.ttest() (bayesFactor
+# toolbox) once per voxel. Here the t statistics of all voxels are computed at
+# once, and so are their Bayes factors.
+#
+# The JZS Bayes factor of a t statistic (Rouder et al., 2009, eq. 1, with a
+# Cauchy prior of scale r on the effect size) is
+#
+#   BF10 = int_0^inf (1 + n g r^2)^(-1/2) (1 + t^2 / ((1 + n g r^2) df))^(-(df+1)/2)
+#                    (2 pi)^(-1/2) g^(-3/2) exp(-1/(2g)) dg  /  (1 + t^2/df)^(-(df+1)/2)
+#
+# With g = exp(s) the integrand decays exponentially on both sides, so the
+# trapezoidal rule on a fixed grid of s converges very quickly (a relative error
+# of about 1e-10 against adaptive quadrature). All voxels share the grid (and all
+# the terms that only depend on g), so a chunk of voxels is one (voxels x nodes)
+# array and one matrix-vector product. One-tailed Bayes factors are converted
+# from the two-tailed one with the one-tailed t-test, as bf.ttest() does:
+# BF10 * 2 * (1 - p_one_tailed).
+#
+# Group data are (subjects x voxels) arrays. The searchlight maps of all
+# subjects are stacked once into an uncompressed 4D NIfTI (stack_maps()), which
+# is then memory-mapped, so only the voxels in the brain mask are ever read
+# (load_stacked()).
+
+import os
+import numpy as np
+
+import instrumentation
+
+
+# Default scale of the Cauchy prior (as bf.ttest())
+SCALE = np.sqrt(2) / 2
+
+# Grid of s = log(g) for the integral, and its trapezoidal weights
+_S = np.arange(-10, 50 + 1e-9, 0.2)
+_WEIGHTS = np.full(len(_S), 0.2)
+_WEIGHTS[[0, -1]] = 0.1
+
+
+def jzs_bf10(t, n, df=None, scale=SCALE):
+    """Two-tailed JZS Bayes factors (BF10) for an array of t statistics, from
+    samples of n (or n pairs), with df degrees of freedom (default n - 1)."""
+    if df is None:
+        df = n - 1
+    t = np.asarray(t, dtype=np.float64)
+
+    g = np.exp(_S)
+    a = 1 + n * g * scale ** 2
+
+    # Log of everything that only depends on g (including the Jacobian, g)
+    log_base = -0.5 * np.log(a) - 0.5 * np.log(2 * np.pi) - 1.5 * _S - 1 / (2 * g) + _S
+
+    # The t-dependent term, divided by the denominator
+    t2 = t.reshape(-1, 1) ** 2
+    log_ratio = -(df + 1) / 2 * (np.log1p(t2 / (a * df)) - np.log1p(t2 / df))
+
+    return (np.exp(log_base + log_ratio) @ _WEIGHTS).reshape(t.shape)
+
+
+def t_statistics(x, y=None):
+    """One-sample (against 0) or paired t statistics of every column of x (and
+    y): returns (t, df)."""
+    d = np.asarray(x, dtype=np.float64)
+    if y is not None:
+        d = d - np.asarray(y, dtype=np.float64)
+    n = d.shape[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = d.mean(axis=0) / (d.std(axis=0, ddof=1) / np.sqrt(n))
+    return t, n - 1
+
+
+def bf_ttest(x, y=None, tail='both', scale=SCALE, chunk_size=8192):
+    """Bayes factors (BF10) of a one-sample (y=None) or paired t-test at every
+    voxel (column) of x, as bf.ttest(x) or bf.ttest(x, y) for each column. tail
+    is 'both', 'right' or 'left'. Columns are read chunk_size at a time."""
+    from scipy import stats
+
+    if tail not in ('both', 'right', 'left'):
+        raise ValueError("tail must be 'both', 'right' or 'left', not %r" % tail)
+
+    n, n_voxels = x.shape
+    bf10 = np.empty(n_voxels)
+    for start in range(0, n_voxels, chunk_size):
+        stop = min(start + chunk_size, n_voxels)
+        with instrumentation.phase('bayes.ttest', voxels=stop - start):
+            t, df = t_statistics(x[:, start:stop], None if y is None else y[:, start:stop])
+            bf = jzs_bf10(t, n, df, scale=scale)
+
+            # One-tailed: 2 * (1 - p) of the one-tailed t-test
+            if tail == 'right':
+                bf *= 2 * stats.t.cdf(t, df)
+            elif tail == 'left':
+                bf *= 2 * stats.t.cdf(-t, df)
+
+        bf10[start:stop] = bf
+
+    return bf10
+
+
+def useful_voxels(*datasets, chunk_size=8192):
+    """Voxels (columns) that are finite and not constant in all of the datasets
+    stacked together (cosmo_remove_useless_data()), as a boolean array."""
+    n_voxels = datasets[0].shape[1]
+    useful = np.empty(n_voxels, dtype=bool)
+    for start in range(0, n_voxels, chunk_size):
+        stop = min(start + chunk_size, n_voxels)
+        x = np.vstack([np.asarray(d[:, start:stop]) for d in datasets])
+        useful[start:stop] = np.isfinite(x).all(axis=0) & (x.min(axis=0) != x.max(axis=0))
+    return useful
+
+
+############################################################
+# Stacked maps
+############################################################
+
+def stack_maps(filenames, out_fn, mask):
+    """Stack maps (one per subject) into a 4D NIfTI (uncompressed, so it can be
+    memory-mapped), keeping only the voxels in mask (elsewhere 0). Unless one of
+    the maps is newer, an existing stack is kept as it is. Returns out_fn."""
+    import nibabel as nib
+
+    if os.path.exists(out_fn):
+        newest = max(os.path.getmtime(fn) for fn in filenames)
+        if os.path.getmtime(out_fn) >= newest and nib.load(out_fn).shape[3:] == (len(filenames),):
+            return out_fn
+
+    first = nib.load(filenames[0])
+    stacked = np.zeros(first.shape[:3] + (len(filenames),), dtype=np.float32)
+    for k, fn in enumerate(filenames):
+        stacked[..., k] = np.where(mask, np.asarray(nib.load(fn).dataobj, dtype=np.float32).reshape(mask.shape), 0)
+
+    tmp_fn = '%s.%d.tmp.nii' % (out_fn[:-len('.nii')], os.getpid())
+    img = nib.Nifti1Image(stacked, first.affine, header=first.header)
+    img.set_data_dtype(np.float32)
+    nib.save(img, tmp_fn)
+    os.replace(tmp_fn, out_fn)
+    return out_fn
+
+
+def load_stacked(fn, mask):
+    """The voxels in mask of a stacked 4D NIfTI, as a (subjects x voxels) array.
+    The file is memory-mapped, and only the voxels in mask are read."""
+    import nibabel as nib
+
+    volumes = np.asanyarray(nib.load(fn, mmap=True).dataobj)
+    out = np.empty((volumes.shape[3], int(mask.sum())), dtype=np.float32)
+    for k in range(volumes.shape[3]):
+        out[k] = volumes[..., k][mask]
+    return out
+
+
+def write_map(values, voxels, reference, filename):
+    """Write values at the voxels (a boolean mask) of the reference image's
+    volume, 0 everywhere else (as cosmo_map2fmri())."""
+    import nibabel as nib
+
+    volume = np.zeros(reference.shape[:3], dtype=np.float32)
+    volume[voxels] = values
+    img = nib.Nifti1Image(volume, reference.affine, header=reference.header)
+    img.set_data_dtype(np.float32)
+    nib.save(img, filename)
@@ -0,0 +1,171 @@
+############################################################
+# Synthetic fixtures for the model builder benchmarks
+############################################################
+
+# Builds a small, self-contained project folder with everything
+# make_rsa_model_functions.py reads, so the builders can be benchmarked offline:
+#
+#   <root>/scripts/top_dir_win.txt     points at <root>
+#   <root>/scripts/bench/              working directory for the benchmarks
+#   <root>/MRIanalyses/assets/...      generated assets:
+#     - word_audio_recordings/<voice>/auto_find_labels/<word><set>.wav
+#       (synthetic "speech": a few harmonics that depend on the letters, per voice)
+#     - corpora_and_models/SEMmodel_glove-wiki-gigaword-300.model (random vectors)
+#     - corpora_and_models/iphod_corpus (only if corpustools is installed)
+#     - the five ratings tables, with random values
+#   <root>/words.txt                    the generated words, one per line
+#
+# Everything is generated from a fixed seed, so fixtures (and benchmark results)
+# are reproducible.
+
+import os
+import numpy as np
+import pandas as pd
+
+# Same voices and sets as make_rsa_model_functions.py
+VOICES = ['vol1', 'vol2', 'vol3', 'vol4', 'vol5', 'vol6',
+          'ai_Clara_f_CAN', 'ai_Liam_m_CAN', 'ai_Jenny_f_USA', 'ai_Davis_m_USA']
+SINGLE_SET_VOICES = ['ai_Clara_f_CAN', 'ai_Liam_m_CAN', 'ai_Jenny_f_USA', 'ai_Davis_m_USA', 'vol6']
+
+RATE = 16000
+
+_ONSETS = ['b', 'c', 'd', 'f', 'g', 'h', 'l', 'm', 'n', 'p', 'r', 's', 't', 'v', 'w', 'br', 'cl', 'st', 'tr']
+_VOWELS = ['a', 'e', 'i', 'o', 'u', 'ai', 'ea', 'oo']
+_CODAS = ['', '', 'n', 'r', 's', 't', 'nd', 'st']
+
+# Phone "transcription" of each letter, for the IPHOD-like corpus
+_PHONES = {letter: letter.upper() for letter in 'abcdefghijklmnopqrstuvwxyz'}
+
+
+def make_words(n, seed=0):
+    """n unique pseudo-words of 1-3 syllables."""
+    rng = np.random.default_rng(seed)
+    words = []
+    seen = set()
+    while len(words) < n:
+        word = ''.join(rng.choice(_ONSETS) + rng.choice(_VOWELS) + rng.choice(_CODAS)
+                       for _ in range(rng.integers(1, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def _write_wav(fn, word, voice_idx, s, rng):
+    from scipy.io.wavfile import write
+
+    duration = 0.25 + 0.05 * len(word)
+    t = np.arange(int(RATE * duration)) / RATE
+    pitch = 110 + 15 * voice_idx + 5 * s
+
+    # One formant-ish segment per letter
+    audio = np.zeros_like(t)
+    segments = np.array_split(np.arange(len(t)), len(word))
+    for letter, segment in zip(word, segments):
+        formant = 300 + 90 * (ord(letter) - ord('a'))
+        audio[segment] = (np.sin(2 * np.pi * pitch * t[segment])
+                          + 0.5 * np.sin(2 * np.pi * formant * t[segment]))
+    audio += 0.05 * rng.standard_normal(len(t))
+    write(fn, RATE, (audio / np.abs(audio).max() * 12000).astype(np.int16))
+
+
+def write_recordings(assets_dir, words, seed=0):
+    """Synthetic recordings of every word, for every voice and set."""
+    rng = np.random.default_rng(seed)
+    for voice_idx, voice in enumerate(VOICES):
+        folder = os.path.join(assets_dir, 'word_audio_recordings', voice, 'auto_find_labels')
+        os.makedirs(folder, exist_ok=True)
+        for s in [1, 2]:
+            if s == 2 and voice in SINGLE_SET_VOICES:
+                continue
+            for word in words:
+                fn = os.path.join(folder, word + str(s) + '.wav')
+                if not os.path.exists(fn):
+                    _write_wav(fn, word, voice_idx, s, rng)
+
+
+def write_sem_model(assets_dir, words, seed=0):
+    """Random 300-d KeyedVectors covering every word (plus some unrelated words)."""
+    from gensim.models import KeyedVectors
+
+    rng = np.random.default_rng(seed)
+    keys = list(words) + ['filler%d' % i for i in range(1000)]
+    model = KeyedVectors(300)
+    model.add_vectors(keys, rng.standard_normal((len(keys), 300)).astype(np.float32))
+
+    folder = os.path.join(assets_dir, 'corpora_and_models')
+    os.makedirs(folder, exist_ok=True)
+    model.save(os.path.join(folder, 'SEMmodel_glove-wiki-gigaword-300.model'))
+
+
+def write_ratings(assets_dir, words, seed=0):
+    """Random ratings tables, in the formats the builders read."""
+    rng = np.random.default_rng(seed)
+    n = len(words)
+
+    pd.DataFrame({'Word': words, 'Conc.M': rng.uniform(1, 5, n)}).to_csv(
+        os.path.join(assets_dir, 'Brysbaert_et_al_2014_concreteness_ratings.csv'), index=False)
+
+    folder = os.path.join(assets_dir, 'grapheme_to_phoneme_consistency_norms')
+    os.makedirs(folder, exist_ok=True)
+    pd.DataFrame({'WORD': words, 'O': rng.random(n), 'N': rng.random(n), 'C': rng.random(n)}).to_csv(
+        os.path.join(folder, 'quickread_words_alphabetical_consistency.csv'), index=False)
+
+    pd.DataFrame({'Words': words, 'IMAG': rng.uniform(1, 7, n)}).to_csv(
+        os.path.join(assets_dir, 'Scott_et_al_2019_imageability_ratings.csv'), index=False)
+
+    pd.DataFrame({'WORD': words, 'N_MORPHEMES': rng.integers(1, 4, n)}).to_csv(
+        os.path.join(assets_dir, 'quickread_words_morphemes.csv'), index=False)
+
+    pd.DataFrame({'WORD': words, 'RATING': rng.integers(0, 2, n)}).to_csv(
+        os.path.join(assets_dir, 'quickread_words_noun_or_verb.csv'), index=False)
+
+
+def write_iphod_corpus(assets_dir, words, seed=0):
+    """IPHOD-like corpustools corpus (one phone per letter, with random binary
+    features for each phone). Returns None, or the reason it couldn't be built."""
+    try:
+        from corpustools.corpus.classes import Corpus, Word, FeatureMatrix
+        from corpustools.corpus.io.binary import save_binary
+    except ImportError as e:
+        return 'corpustools is not installed (%s)' % e
+
+    rng = np.random.default_rng(seed)
+    feature_names = ['f%d' % i for i in range(12)]
+    entries = [dict({'symbol': phone}, **{f: rng.choice(['+', '-']) for f in feature_names})
+               for phone in sorted(set(_PHONES.values()))]
+
+    corpus = Corpus('iphod_fixture')
+    corpus.set_feature_matrix(FeatureMatrix('fixture_features', entries))
+    for word in words:
+        corpus.add_word(Word(spelling=word, transcription=[_PHONES[c] for c in word], frequency=1))
+
+    folder = os.path.join(assets_dir, 'corpora_and_models')
+    os.makedirs(folder, exist_ok=True)
+    save_binary(corpus, os.path.join(folder, 'iphod_corpus'))
+    return None
+
+
+def make_fixtures(root, n_words, n_recorded_words, seed=0):
+    """Create (or top up) a fixture project in root. Only the first
+    n_recorded_words words get recordings. Returns (words, notes), where notes
+    maps fixture names to the reason they are unavailable."""
+    assets_dir = os.path.join(root, 'MRIanalyses', 'assets')
+    os.makedirs(os.path.join(root, 'scripts', 'bench'), exist_ok=True)
+    os.makedirs(assets_dir, exist_ok=True)
+    with open(os.path.join(root, 'scripts', 'top_dir_win.txt'), 'w') as f:
+        f.write(root)
+
+    words = make_words(n_words, seed)
+    with open(os.path.join(root, 'words.txt'), 'w') as f:
+        f.write('\n'.join(words))
+
+    notes = {}
+    write_ratings(assets_dir, words, seed)
+    write_sem_model(assets_dir, words, seed)
+    write_recordings(assets_dir, words[:n_recorded_words], seed)
+    reason = write_iphod_corpus(assets_dir, words, seed)
+    if reason is not None:
+        notes['iphod_corpus'] = reason
+
+    return words, notes
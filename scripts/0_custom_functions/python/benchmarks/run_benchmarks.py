@@ -0,0 +1,347 @@
+############################################################
+# Benchmarks for the hypothesis model builders
+############################################################
+
+# Times every builder in make_rsa_model_functions.py (and the pairwise acoustic
+# distance on its own) on synthetic fixtures (see fixtures.py), at several
+# vocabulary sizes, and fits a scaling exponent to each builder so its
+# complexity class can be checked (e.g. ~n^2 for a builder that computes every
+# pair).
+#
+# Each (builder, size) runs in its own process, so the first ("cold") call pays
+# for everything a fresh session would: loading assets, empty on-disk caches
+# (acoustic features, glyphs, master RDMs). Further ("warm") calls reuse
+# whatever the process has kept. For each run we record:
+#
+#   cold_s      time of the first call
+#   warm_s      best time of the remaining calls
+#   peak_mb     peak memory traced by tracemalloc (Python and numpy allocations)
+#               during one more warm call
+#   maxrss_mb   high-water mark of the process' resident memory
+#
+# Usage (from this folder):
+#
+#   python run_benchmarks.py                          all builders, default sizes
+#   python run_benchmarks.py -b semantic visual -s 30 120 500
+#   python run_benchmarks.py --save results.json     also writes results.csv
+#   python run_benchmarks.py --plot scaling.png      (needs matplotlib)
+#
+# To compare branches, benchmark each checkout's custom functions folder and
+# compare the saved results:
+#
+#   git worktree add ../baseline main
+#   python run_benchmarks.py --functions-dir ../baseline/scripts/0_custom_functions/python --save main.json
+#   python run_benchmarks.py --save branch.json --compare main.json
+#
+# Older versions of make_rsa_model_functions.py can be benchmarked too: without
+# pairwise_acoustic_distances(), acoustic_distance is timed as one
+# acoustic_distance(file1, file2) call per pair, and without a glyph cache
+# --font is ignored. Those versions import all of their dependencies
+# (corpustools, wordkit, pattern, ...) up front; if one is missing, every
+# builder is skipped with the name of the missing module.
+#
+# Some builders are slow enough that they are capped at a smaller vocabulary by
+# default (see SIZE_CAPS; --no-caps lifts this). Builders whose fixtures can't be
+# made here (articulatory needs corpustools; visual needs the experiment's font,
+# or --font) are skipped, with the reason.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+from fixtures import make_fixtures, VOICES
+
+DEFAULT_SIZES = [30, 120, 500, 2000]
+
+BUILDERS = ['articulatory', 'orthographic', 'phonological', 'semantic', 'visual',
+            'conc', 'g2p', 'imag', 'morph', 'nounverb', 'wordlength', 'acoustic_distance']
+
+# Builders that need recordings of the words
+ACOUSTIC_BUILDERS = ['phonological', 'acoustic_distance']
+
+# Largest vocabulary size each builder runs at by default (the number of pairs
+# grows as n^2, and these compute every pair the slow way round)
+SIZE_CAPS = {'articulatory': 120, 'phonological': 120, 'acoustic_distance': 500}
+
+
+############################################################
+# Worker (one builder at one size, in a fresh process)
+############################################################
+
+def _run_builder(mrf, builder, words):
+    if builder == 'acoustic_distance':
+        # Distance between every pair of recordings of one set, with an (initially
+        # empty) feature cache
+        folder = os.path.join(mrf.acoust_path, VOICES[0], 'auto_find_labels')
+        files = [os.path.join(folder, w + '1.wav') for w in words]
+        pairs = [(files[i], files[j]) for i in range(len(files)) for j in range(i + 1, len(files))]
+        if not hasattr(mrf, 'pairwise_acoustic_distances'):
+            return [mrf.acoustic_distance(file1, file2) for file1, file2 in pairs]
+        return mrf.pairwise_acoustic_distances(pairs, mrf.acoustic_cache)
+
+    return getattr(mrf, 'make_' + builder + '_matrix')(words)
+
+
+def _maxrss_mb():
+    try:
+        import resource
+    except ImportError:
+        # (not available on Windows)
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / (1024**2 if sys.platform == 'darwin' else 1024)
+
+
+def worker(job):
+    import tracemalloc
+
+    fixtures_dir = job['fixtures']
+
+    # Start cold: no on-disk caches from earlier runs
+    shutil.rmtree(os.path.join(fixtures_dir, 'MRIanalyses', 'assets', 'cache'), ignore_errors=True)
+
+    # make_rsa_model_functions.py finds the project from ../top_dir_win.txt
+    os.chdir(os.path.join(fixtures_dir, 'scripts', 'bench'))
+    sys.path.insert(0, job['functions_dir'])
+    try:
+        import make_rsa_model_functions as mrf
+    except ImportError as e:
+        return {'builder': job['builder'], 'size': job['size'],
+                'import_error': 'make_rsa_model_functions could not be imported (missing %s)'
+                                % (e.name or e)}
+
+    if job['font'] is not None and hasattr(mrf, 'glyph_cache'):
+        from visual_silhouettes import GlyphCache
+        mrf.glyph_cache = GlyphCache(mrf.glyph_cache.cache_dir, font=job['font'])
+
+    with open(os.path.join(fixtures_dir, 'words.txt')) as f:
+        words = f.read().split('\n')[:job['size']]
+
+    result = {'builder': job['builder'], 'size': job['size']}
+
+    start = time.perf_counter()
+    _run_builder(mrf, job['builder'], words)
+    result['cold_s'] = time.perf_counter() - start
+
+    warm = []
+    for _ in range(job['repeat'] - 1):
+        start = time.perf_counter()
+        _run_builder(mrf, job['builder'], words)
+        warm.append(time.perf_counter() - start)
+    result['warm_s'] = min(warm) if warm else None
+
+    tracemalloc.start()
+    _run_builder(mrf, job['builder'], words)
+    result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024**2
+    tracemalloc.stop()
+
+    result['maxrss_mb'] = _maxrss_mb()
+    return result
+
+
+############################################################
+# Driver
+############################################################
+
+def _git_revision(path):
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=path, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _font_reason(font):
+    from PIL import ImageFont
+    try:
+        ImageFont.truetype(font, 12)
+    except OSError:
+        return 'font %r is not available (use --font)' % font
+    return None
+
+
+def run_job(job, timeout):
+    """Run one (builder, size) in a new process. Returns the result, or raises
+    RuntimeError with the worker's error output."""
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', json.dumps(job)],
+                          capture_output=True, text=True, timeout=timeout)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else
+                           'worker exited with code %d' % proc.returncode)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def scaling_exponents(results, key):
+    """Slope of log(key) against log(size), for each builder with at least two
+    sizes (times under a millisecond are too noisy to use)."""
+    exponents = {}
+    for builder in sorted(set(r['builder'] for r in results)):
+        points = [(r['size'], r[key]) for r in results
+                  if r['builder'] == builder and r.get(key) is not None and r[key] > 1e-3]
+        if len(points) >= 2:
+            x, y = np.log(np.array(points, dtype=float)).T
+            exponents[builder] = float(np.polyfit(x, y, 1)[0])
+    return exponents
+
+
+def print_results(report):
+    print('%-18s %6s %10s %10s %10s %10s' % ('builder', 'size', 'cold_s', 'warm_s', 'peak_mb', 'maxrss_mb'))
+    fmt = lambda v, f: (f % v) if v is not None else '-'
+    for r in report['results']:
+        print('%-18s %6d %10s %10s %10s %10s' % (r['builder'], r['size'], fmt(r['cold_s'], '%.4f'),
+                                                 fmt(r['warm_s'], '%.4f'), fmt(r['peak_mb'], '%.1f'),
+                                                 fmt(r['maxrss_mb'], '%.0f')))
+
+    print('\nScaling exponents (time ~ n^k, fitted over sizes):')
+    for builder in sorted(report['exponents']['warm_s']):
+        print('  %-18s cold k=%5.2f   warm k=%5.2f   peak memory k=%5.2f'
+              % (builder, report['exponents']['cold_s'].get(builder, np.nan),
+                 report['exponents']['warm_s'][builder],
+                 report['exponents']['peak_mb'].get(builder, np.nan)))
+
+    for builder, reason in report['skipped'].items():
+        print('Skipped %s: %s' % (builder, reason))
+
+
+def compare(report, baseline):
+    """Print the time and memory of each run relative to a saved baseline
+    (ratios < 1 are faster/smaller than the baseline)."""
+    base = {(r['builder'], r['size']): r for r in baseline['results']}
+    print('\nCompared with %s (%s):' % (baseline['meta']['functions_dir'], baseline['meta']['git_revision']))
+    print('%-18s %6s %12s %12s %12s' % ('builder', 'size', 'cold ratio', 'warm ratio', 'peak ratio'))
+    for r in report['results']:
+        b = base.get((r['builder'], r['size']))
+        if b is None:
+            continue
+        ratio = lambda key: ('%.2f' % (r[key] / b[key])) if r[key] and b[key] else '-'
+        print('%-18s %6d %12s %12s %12s' % (r['builder'], r['size'], ratio('cold_s'), ratio('warm_s'),
+                                             ratio('peak_mb')))
+
+
+def plot(report, filename):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    for builder in sorted(set(r['builder'] for r in report['results'])):
+        runs = [r for r in report['results'] if r['builder'] == builder]
+        sizes = [r['size'] for r in runs]
+        axes[0].loglog(sizes, [r['warm_s'] or r['cold_s'] for r in runs], 'o-', label=builder)
+        axes[1].loglog(sizes, [r['peak_mb'] for r in runs], 'o-', label=builder)
+    axes[0].set(xlabel='Words', ylabel='Warm time (s)')
+    axes[1].set(xlabel='Words', ylabel='Peak traced memory (MB)')
+    axes[0].legend(fontsize='small')
+    fig.tight_layout()
+    fig.savefig(filename)
+
+
+def save(report, filename):
+    import pandas as pd
+
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=1)
+    pd.DataFrame(report['results']).to_csv(os.path.splitext(filename)[0] + '.csv', index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the hypothesis model builders on synthetic fixtures.')
+    parser.add_argument('-b', '--builders', nargs='+', choices=BUILDERS, default=BUILDERS)
+    parser.add_argument('-s', '--sizes', nargs='+', type=int, default=DEFAULT_SIZES)
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='calls per run: one cold, then the best of the rest (default: 3)')
+    parser.add_argument('--no-caps', action='store_true', help='run every builder at every size')
+    parser.add_argument('--functions-dir', default=os.path.dirname(here),
+                        help='custom functions folder to benchmark (default: this checkout)')
+    parser.add_argument('--fixtures', help='folder for the fixtures (kept, and reused by later runs); '
+                                           'default: a temporary folder')
+    parser.add_argument('--font', help='font for the visual builder, if the experiment font is missing')
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds per run (default: 3600)')
+    parser.add_argument('--save', help='write the results to this .json file (and a .csv next to it)')
+    parser.add_argument('--compare', help='results .json to compare with')
+    parser.add_argument('--plot', help='write scaling curves to this image (needs matplotlib)')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker is not None:
+        print(json.dumps(worker(json.loads(args.worker))))
+        return 0
+
+    functions_dir = os.path.abspath(args.functions_dir)
+    sizes = sorted(set(args.sizes))
+    runs = [(b, n) for b in args.builders for n in sizes if args.no_caps or n <= SIZE_CAPS.get(b, n)]
+
+    fixtures_dir = os.path.abspath(args.fixtures) if args.fixtures else tempfile.mkdtemp(prefix='rsa_bench_')
+    n_recorded = max([n for b, n in runs if b in ACOUSTIC_BUILDERS], default=0)
+    print('Making fixtures in %s ...' % fixtures_dir)
+    _, notes = make_fixtures(fixtures_dir, max(sizes), n_recorded)
+
+    skipped = {}
+    if 'articulatory' in args.builders and 'iphod_corpus' in notes:
+        skipped['articulatory'] = notes['iphod_corpus']
+    if 'visual' in args.builders:
+        font_reason = _font_reason(args.font or 'arial.ttf')
+        if font_reason is not None:
+            skipped['visual'] = font_reason
+
+    report = {'meta': {'functions_dir': functions_dir, 'git_revision': _git_revision(functions_dir),
+                       'python': platform.python_version(), 'numpy': np.__version__,
+                       'machine': platform.platform(), 'cpu_count': os.cpu_count(),
+                       'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeat': args.repeat},
+              'results': [], 'skipped': skipped}
+
+    try:
+        for builder, size in runs:
+            if builder in skipped:
+                continue
+            print('  %s, %d words' % (builder, size), flush=True)
+            job = {'builder': builder, 'size': size, 'fixtures': fixtures_dir,
+                   'functions_dir': functions_dir, 'repeat': args.repeat, 'font': args.font}
+            try:
+                result = run_job(job, args.timeout)
+            except (RuntimeError, subprocess.TimeoutExpired) as e:
+                skipped['%s (%d words)' % (builder, size)] = str(e)
+                continue
+
+            # The module can't be imported: no builder can run
+            if 'import_error' in result:
+                skipped['all builders'] = result['import_error']
+                break
+            report['results'].append(result)
+    finally:
+        if not args.fixtures:
+            shutil.rmtree(fixtures_dir, ignore_errors=True)
+
+    report['exponents'] = {key: scaling_exponents(report['results'], key)
+                           for key in ['cold_s', 'warm_s', 'peak_mb']}
+
+    print()
+    print_results(report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    if args.save:
+        save(report, args.save)
+    if args.plot:
+        try:
+            plot(report, args.plot)
+        except ImportError:
+            print('matplotlib is not installed; no plot written')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+############################################################
+# Out-of-core, blocked computation of large RDMs
+############################################################
+
+# For lexicon-sized vocabularies (tens of thousands of words, e.g. for stimulus
+# screening) neither the square matrix nor the dense feature arrays fit in
+# memory. Here the pair space is tiled into blocks of block_size x block_size
+# words; each tile is computed in one vectorized call, and written straight to
+# its place in a condensed (pdist-ordered) array on disk. Only the features of
+# two blocks and one tile are in memory at a time, so memory use is set by
+# block_size, not by the number of words. (Tiles are written with plain file
+# writes rather than through a memory map, so the output never counts towards
+# the memory of the process.)
+#
+# A result is a folder:
+#
+#   values.npy        condensed distances (n*(n-1)/2 values), memory-mappable
+#   meta.json         measure, labels, masked labels, block size
+#   neighbours.npz    (with top_k) the k nearest words of every word: indices
+#                     and distances, each n x k, nearest first
+#
+# Every file is written under a temporary name and only renamed once it is
+# complete, so an interrupted run never leaves a partial result behind.
+#
+# The pairs of masked labels are written as NaN, whatever distances() gives
+# for them. load() gives the result as an RDM backed by the memory map, so rows,
+# pairs and (small) subsets can be read from it without loading the rest (nor
+# reading the masked rows to check that they are NaN).
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+import instrumentation
+from rdm import RDM
+
+
+def compute(labels, rows, distances, out_dir, block_size=2048, dtype=np.float32, top_k=None,
+            masked=(), measure=None):
+    """Compute an RDM over labels block by block, into out_dir.
+
+    rows(start, stop) returns the features of labels[start:stop] (in any form),
+    and distances(features_a, features_b) the (len(a) x len(b)) distances
+    between two blocks of features. With top_k, the top_k nearest labels of every
+    label are also kept (NaN distances are never nearest). Returns out_dir."""
+    labels = list(labels)
+    n = len(labels)
+    if top_k is not None and not 0 < top_k < n:
+        raise ValueError('top_k must be between 1 and %d' % (n - 1))
+
+    os.makedirs(out_dir, exist_ok=True)
+    values_fn = os.path.join(out_dir, 'values.npy')
+    tmp_fn = '%s.%d.tmp' % (values_fn, os.getpid())
+    dtype = np.dtype(dtype)
+
+    n_values = n * (n - 1) // 2
+    masked = set(masked)
+    is_masked = np.array([l in masked for l in labels], dtype=bool)
+
+    # Position of (i, i+1) in the condensed array, i.e. where the pairs of row i start
+    row_start = np.arange(n, dtype=np.int64)
+    row_start = row_start * (2 * n - row_start - 1) // 2
+
+    if top_k is not None:
+        nearest = np.zeros((n, top_k), dtype=np.int64)
+        nearest_distances = np.full((n, top_k), np.inf)
+
+    # Create the .npy file (header, then room for every value) and write the
+    # tiles into it. If anything fails, the partial file is removed
+    try:
+        with open(tmp_fn, 'w+b') as f:
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                     'fortran_order': False, 'shape': (n_values,)})
+            header_size = f.tell()
+            f.truncate(header_size + n_values * dtype.itemsize)
+
+            starts = range(0, n, block_size)
+            for a0 in starts:
+                a1 = min(a0 + block_size, n)
+                features_a = rows(a0, a1)
+
+                for b0 in starts:
+                    if b0 < a0:
+                        continue
+                    b1 = min(b0 + block_size, n)
+                    features_b = features_a if b0 == a0 else rows(b0, b1)
+
+                    with instrumentation.phase('blocked_rdm.tile', rows=a1 - a0, cols=b1 - b0):
+                        tile = np.asarray(distances(features_a, features_b), dtype=np.float64)
+                        tile[is_masked[a0:a1]] = np.nan
+                        tile[:, is_masked[b0:b1]] = np.nan
+
+                    # Write each row's part of the tile (pairs i < j only) to its place
+                    with instrumentation.phase('blocked_rdm.write'):
+                        data = tile.astype(dtype)
+                        for i in range(a0, a1):
+                            j0 = max(b0, i + 1)
+                            if j0 < b1:
+                                f.seek(header_size + (row_start[i] + j0 - i - 1) * dtype.itemsize)
+                                f.write(data[i - a0, j0 - b0:].tobytes())
+
+                    if top_k is not None:
+                        with instrumentation.phase('blocked_rdm.top_k'):
+                            tile = np.where(np.isnan(tile), np.inf, tile)
+                            if b0 == a0:
+                                np.fill_diagonal(tile, np.inf)
+                            _merge_nearest(nearest, nearest_distances, a0, a1, b0, tile)
+                            if b0 != a0:
+                                _merge_nearest(nearest, nearest_distances, b0, b1, a0, tile.T)
+    except BaseException:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+    os.replace(tmp_fn, values_fn)
+
+    if top_k is not None:
+        order = np.argsort(nearest_distances, axis=1, kind='stable')
+        neighbours_fn = os.path.join(out_dir, 'neighbours.npz')
+        tmp_fn = '%s.%d.tmp.npz' % (neighbours_fn[:-len('.npz')], os.getpid())
+        np.savez(tmp_fn, indices=np.take_along_axis(nearest, order, axis=1),
+                 distances=np.take_along_axis(nearest_distances, order, axis=1))
+        os.replace(tmp_fn, neighbours_fn)
+    elif os.path.exists(os.path.join(out_dir, 'neighbours.npz')):
+        os.remove(os.path.join(out_dir, 'neighbours.npz'))
+
+    meta_fn = os.path.join(out_dir, 'meta.json')
+    tmp_fn = '%s.%d.tmp' % (meta_fn, os.getpid())
+    with open(tmp_fn, 'w') as f:
+        json.dump({'measure': measure, 'labels': [str(l) for l in labels],
+                   'masked': [str(l) for l in labels if l in masked],
+                   'block_size': block_size, 'dtype': dtype.str, 'top_k': top_k}, f)
+    os.replace(tmp_fn, meta_fn)
+
+    return out_dir
+
+
+# Merge a tile (rows r0:r1 of the RDM, columns from c0) into the running k
+# nearest of those rows
+def _merge_nearest(nearest, nearest_distances, r0, r1, c0, tile):
+    k = nearest.shape[1]
+    candidates = np.hstack([nearest_distances[r0:r1], tile])
+    columns = np.hstack([nearest[r0:r1], np.broadcast_to(np.arange(c0, c0 + tile.shape[1]), tile.shape)])
+
+    best = np.argpartition(candidates, k - 1, axis=1)[:, :k]
+    nearest_distances[r0:r1] = np.take_along_axis(candidates, best, axis=1)
+    nearest[r0:r1] = np.take_along_axis(columns, best, axis=1)
+
+
+def load(out_dir):
+    """A result of compute(), as an RDM backed by a read-only memory map."""
+    with open(os.path.join(out_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    values = np.load(os.path.join(out_dir, 'values.npy'), mmap_mode='r')
+
+    # compute() has already written NaN in the masked rows, so they are not
+    # checked (which would read every one of their cells)
+    return RDM(meta['labels'], values, masked=meta['masked'], dtype=values.dtype, check_masked=False)
+
+
+def load_neighbours(out_dir):
+    """The nearest neighbours kept by compute(top_k=...), as a DataFrame with one
+    row per (word, rank): word, rank (1 = nearest), neighbour, distance."""
+    with open(os.path.join(out_dir, 'meta.json')) as f:
+        labels = np.array(json.load(f)['labels'], dtype=object)
+    with np.load(os.path.join(out_dir, 'neighbours.npz')) as data:
+        indices, distances = data['indices'], data['distances']
+
+    n, k = indices.shape
+    found = np.isfinite(distances).ravel()
+    return pd.DataFrame({'word': np.repeat(labels, k),
+                         'rank': np.tile(np.arange(1, k + 1), n),
+                         'neighbour': labels[indices.ravel()],
+                         'distance': distances.ravel()})[found].reset_index(drop=True)
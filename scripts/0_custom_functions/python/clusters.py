@@ -0,0 +1,202 @@
+############################################################
+# Clusters of thresholded maps, with atlas labels
+############################################################
+
+# Python version of what x9_make_cluster_tables.sh does with FSL: cluster
+# (26-connected clusters above a minimum extent, numbered by size, the largest
+# last), fslstats on every cluster, atlasquery for the label of its centre of
+# gravity (COG), and fslmaths/fslstats against every Harvard-Oxford mask for its
+# anatomical labels. Here the map is labelled with one connected-components
+# pass (scipy.ndimage.label), and the statistics of all the clusters (number of
+# voxels, mean and max BF, intensity-weighted COG) come from a few bincounts
+# over the label volume.
+#
+# The anatomical masks can overlap, so they are precomputed into one label
+# volume in which every distinct combination of masks has its own label (and a
+# table of which masks each label stands for). The number of voxels of every
+# cluster in every mask is then a single bincount over (cluster, combination),
+# times that table. The label volume is cached next to the masks folder
+# (<atlas_dir>_labels.npz), and rebuilt when a mask changes.
+#
+# atlasquery's probabilistic atlases are not needed: the COG label is the mask
+# that contains the COG (cortical masks first, then the Left_/Right_ subcortical
+# ones, as atlasquery is tried with the cortical atlas first), choosing the one
+# with most voxels of the cluster if there are several. Like the FSL version, it
+# gets the hemisphere of the COG (<label>_LH or _RH), and clusters whose COG is
+# in no mask are left out of the table.
+
+import os
+import glob
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+
+# Columns of the cluster tables (as written by x9_make_cluster_tables.sh, whose
+# 'Cluster extent (mm^3)' is in fact the number of voxels, from FSL's cluster,
+# and ' NEW CE' the number of voxels and volume in mm^3, as fslstats -V prints
+# them)
+columns = ['Cluster N', 'Mean BF', 'Cluster extent (mm^3)', 'Max BF', 'x', 'y', 'z',
+           'Anatomical labels', 'COG label', ' NEW CE']
+
+
+def find_clusters(values, threshold=1, min_extent=20):
+    """26-connected clusters of the voxels above threshold, with at least
+    min_extent voxels, as a label volume (0 outside clusters), numbered by size
+    (1 = the smallest, as FSL's cluster), and the number of clusters."""
+    labels, n = ndimage.label(values > threshold, structure=np.ones((3, 3, 3), dtype=bool))
+    sizes = np.bincount(labels.ravel(), minlength=n + 1)
+    sizes[0] = 0
+
+    # Relabel the clusters that are large enough, by ascending size
+    keep = np.flatnonzero(sizes >= min_extent)
+    keep = keep[np.argsort(sizes[keep], kind='stable')]
+    relabel = np.zeros(n + 1, dtype=np.int32)
+    relabel[keep] = np.arange(1, len(keep) + 1)
+    return relabel[labels], len(keep)
+
+
+def cluster_stats(values, labels, n_clusters, affine):
+    """Statistics of every cluster (1..n_clusters) of a label volume: a DataFrame
+    with n_voxels, extent (mm^3), mean and max value, and the intensity-weighted
+    COG (x, y, z in mm)."""
+    flat = labels.ravel()
+    in_cluster = flat > 0
+    index = flat[in_cluster] - 1
+    v = values.ravel()[in_cluster].astype(np.float64)
+
+    n_voxels = np.bincount(index, minlength=n_clusters)
+    total = np.bincount(index, weights=v, minlength=n_clusters)
+    peak = np.asarray(ndimage.maximum(values, labels, np.arange(1, n_clusters + 1)), dtype=np.float64)
+
+    ijk = np.stack(np.unravel_index(np.flatnonzero(in_cluster), labels.shape), axis=1)
+    cog_ijk = np.stack([np.bincount(index, weights=v * ijk[:, d], minlength=n_clusters) for d in range(3)],
+                       axis=1) / total[:, None]
+    cog = cog_ijk @ affine[:3, :3].T + affine[:3, 3]
+
+    return pd.DataFrame({'n_voxels': n_voxels,
+                         'extent': n_voxels * abs(np.linalg.det(affine[:3, :3])),
+                         'mean': total / n_voxels, 'max': peak,
+                         'x': cog[:, 0], 'y': cog[:, 1], 'z': cog[:, 2]},
+                        index=pd.RangeIndex(1, n_clusters + 1, name='cluster'))
+
+
+############################################################
+# Atlas
+############################################################
+
+def build_atlas(mask_files):
+    """Label volume of a set of (possibly overlapping) masks: returns (labels,
+    membership, names), where every voxel's label is the row of membership
+    (labels x masks, boolean) that says which masks contain it."""
+    import nibabel as nib
+
+    names = [os.path.basename(fn)[:-len('.nii.gz')] for fn in mask_files]
+    masks = np.stack([np.asarray(nib.load(fn).dataobj).ravel() != 0 for fn in mask_files], axis=1)
+    shape = nib.load(mask_files[0]).shape[:3]
+
+    # One label per distinct combination of masks (packed into bytes)
+    packed = np.ascontiguousarray(np.packbits(masks, axis=1))
+    rows = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+    _, first, labels = np.unique(rows, return_index=True, return_inverse=True)
+    return labels.astype(np.int32).reshape(shape), masks[first], names
+
+
+def load_atlas(atlas_dir, cache_fn=None):
+    """The label volume of all the masks in atlas_dir (see build_atlas()),
+    cached in cache_fn (default <atlas_dir>_labels.npz)."""
+    mask_files = sorted(glob.glob(os.path.join(atlas_dir, '*.nii.gz')))
+    if not mask_files:
+        raise FileNotFoundError('No masks in %s' % atlas_dir)
+    if cache_fn is None:
+        cache_fn = atlas_dir.rstrip(os.sep) + '_labels.npz'
+
+    names = [os.path.basename(fn)[:-len('.nii.gz')] for fn in mask_files]
+    if os.path.exists(cache_fn) and os.path.getmtime(cache_fn) >= max(os.path.getmtime(fn) for fn in mask_files):
+        with np.load(cache_fn) as cached:
+            if list(cached['names']) == names:
+                return cached['labels'], cached['membership'], names
+
+    labels, membership, names = build_atlas(mask_files)
+    tmp_fn = '%s.%d.tmp.npz' % (cache_fn[:-len('.npz')], os.getpid())
+    np.savez(tmp_fn, labels=labels, membership=membership, names=np.array(names))
+    os.replace(tmp_fn, cache_fn)
+    return labels, membership, names
+
+
+def atlas_overlap(labels, n_clusters, atlas_labels, membership):
+    """Number of voxels of every cluster (1..n_clusters) in every mask of the
+    atlas (clusters x masks)."""
+    flat = labels.ravel()
+    in_cluster = flat > 0
+    n_combinations = len(membership)
+    pairs = (flat[in_cluster] - 1).astype(np.int64) * n_combinations + atlas_labels.ravel()[in_cluster]
+    counts = np.bincount(pairs, minlength=n_clusters * n_combinations).reshape(n_clusters, n_combinations)
+    return counts @ membership.astype(np.int64)
+
+
+def _is_subcortical(name):
+    return name.startswith('Left_') or name.startswith('Right_')
+
+
+def _structure(name):
+    """Mask name without its hemisphere (Left_/Right_ prefix, or _LH/_RH suffix)."""
+    for prefix in ('Left_', 'Right_'):
+        if name.startswith(prefix):
+            return name[len(prefix):]
+    for suffix in ('_LH', '_RH'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def cog_label(cog_mm, overlap, atlas_labels, membership, names, affine):
+    """Label of a cluster's COG (mm, rounded to the nearest mm as atlasquery
+    gets it) with its hemisphere, e.g. 'Temporal_Pole_LH'; None if the COG is in
+    no mask. overlap is the cluster's number of voxels in every mask."""
+    cog_mm = np.round(cog_mm)
+    ijk = np.round(np.linalg.solve(affine[:3, :3], cog_mm - affine[:3, 3])).astype(int)
+    if (ijk < 0).any() or (ijk >= atlas_labels.shape).any():
+        return None
+
+    candidates = np.flatnonzero(membership[atlas_labels[tuple(ijk)]])
+    if not len(candidates):
+        return None
+    cortical = [k for k in candidates if not _is_subcortical(names[k])]
+    if cortical:
+        candidates = cortical
+    best = max(candidates, key=lambda k: overlap[k])
+    return '%s_%s' % (_structure(names[best]), 'LH' if cog_mm[0] < 0 else 'RH')
+
+
+############################################################
+# Tables
+############################################################
+
+def cluster_table(values, affine, atlas_labels, membership, names, threshold=1, min_extent=20):
+    """Cluster table of a thresholded map (as x9_make_cluster_tables.sh writes
+    them), and the map with the small clusters removed."""
+    labels, n_clusters = find_clusters(values, threshold, min_extent)
+    kept = np.where(labels > 0, values, 0).astype(np.float32)
+    if not n_clusters:
+        return pd.DataFrame(columns=columns), kept
+
+    if atlas_labels.shape != labels.shape:
+        raise ValueError('The atlas (%s) and the map (%s) are not on the same grid'
+                         % (atlas_labels.shape, labels.shape))
+
+    stats = cluster_stats(values, labels, n_clusters, affine)
+    overlap = atlas_overlap(labels, n_clusters, atlas_labels, membership)
+
+    rows = []
+    for cluster, s in stats.iterrows():
+        counts = overlap[cluster - 1]
+        label = cog_label(s[['x', 'y', 'z']].to_numpy(float), counts, atlas_labels, membership, names, affine)
+        if label is None:
+            continue
+        anatomical = '+'.join('%s (%d)' % (names[k], counts[k]) for k in np.flatnonzero(counts))
+        rows.append([cluster, round(s['mean'], 6), int(s['n_voxels']), round(s['max'], 6),
+                     round(s['x'], 2), round(s['y'], 2), round(s['z'], 2), anatomical, label,
+                     '%d %.6f' % (s['n_voxels'], s['extent'])])
+
+    return pd.DataFrame(rows, columns=columns), kept
@@ -0,0 +1,198 @@
+############################################################
+# First-level COPE data for RSA, extracted once and cached
+############################################################
+
+# The word-wise COPE images of a subject (from
+# x3_first_level_COPE_to_common_native_space.sh: one <run>_cope<i>.nii.gz per
+# run and word, with cope1 the first word alphabetically) used to be stacked
+# whole into memory (runs x words x every voxel of the volume) before the
+# useless voxels were removed. Here they are read one image at a time, and only
+# the voxels inside the subject's COPE mask (<subject>_run1_cope1_mask.nii.gz,
+# which x3 applied to every COPE, so every voxel outside it is 0 everywhere) are
+# kept. The runs of each word are averaged as they are read, so the data of a
+# subject is one contiguous (words x voxels) float32 array per condition.
+#
+# Useless voxels (not finite, or constant, over all the runs and words:
+# cosmo_remove_useless_data()) are found in the same pass, from the running
+# minimum and maximum of every voxel, and removed at the end.
+#
+# Images are opened with mmap=True: uncompressed images are memory-mapped, so
+# only the mask voxels are read; compressed ones are decompressed one at a time.
+# Peak memory is the (all the words of both conditions x mask voxels) float32
+# array of run averages, plus one image, instead of all the samples of a
+# subject at full volume size.
+#
+# The arrays are cached in a folder, for the later stages (searchlights, ROI
+# RDMs), which memory-map them:
+#
+#   <cache_dir>/<subject>_<condition>_cope_data.npy   (words x voxels) float32
+#   <cache_dir>/<subject>_voxels.npy                  (voxels x 3) voxel indices
+#   <cache_dir>/<subject>_cope_data.json              words of each condition,
+#                                                     volume shape, affine, and
+#                                                     the images they came from
+#
+# The .json is written last, so it marks a complete cache; a cache is rebuilt
+# when any of its images is newer, or the word lists have changed.
+#
+# Usage:
+#
+#   word_lists = cope_data.read_word_lists(top_dir, subject)
+#   cope_data.build(cache_dir, subject, cope_dir, word_lists, runs)
+#   data, words = cope_data.load(cache_dir, subject, 'aloud')
+#   ijk, info = cope_data.load_voxels(cache_dir, subject)
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+
+conditions = ['aloud', 'silent']
+
+
+def read_word_lists(top_dir, subject, behav_subfolder='fmri_runs2'):
+    """Word list of each condition for a subject (alphabetical), as
+    rsa_models.py reads them for the hypothesis models."""
+    words = {}
+    for condition in conditions:
+        words[condition] = pd.read_csv(word_list_path(top_dir, subject, condition, behav_subfolder),
+                                       header=None).sort_values(by=0)[0].tolist()
+    words['alltrials'] = sorted(words['aloud'] + words['silent'])
+    return words
+
+
+def word_list_path(top_dir, subject, condition, behav_subfolder='fmri_runs2'):
+    return os.path.join(top_dir, 'behavioural_data', behav_subfolder, subject, condition + '_words.txt')
+
+
+def cope_filenames(cope_dir, runs, n_words):
+    """COPE image of every run (rows) and word (columns, alphabetical order)."""
+    return [[os.path.join(cope_dir, '%s_cope%d.nii.gz' % (run, i_word)) for i_word in range(1, n_words + 1)]
+            for run in runs]
+
+
+def mask_filename(cope_dir, subject):
+    return os.path.join(cope_dir, '%s_run1_cope1_mask.nii.gz' % subject)
+
+
+def _paths(cache_dir, subject):
+    return {'info': os.path.join(cache_dir, '%s_cope_data.json' % subject),
+            'voxels': os.path.join(cache_dir, '%s_voxels.npy' % subject),
+            'data': {c: os.path.join(cache_dir, '%s_%s_cope_data.npy' % (subject, c)) for c in conditions}}
+
+
+def _read_voxels(filename, voxels):
+    """Values of the voxels (flat, Fortran-order indices) of an image, as float32."""
+    import nibabel as nib
+
+    data = np.asanyarray(nib.load(filename, mmap=True).dataobj)
+    return np.asarray(data.reshape(-1, order='F')[voxels], dtype=np.float32)
+
+
+def is_current(cache_dir, subject, sources, word_lists):
+    """Whether the cache of a subject exists, is for the same words, and is newer
+    than all the sources."""
+    info_fn = _paths(cache_dir, subject)['info']
+    if not os.path.exists(info_fn):
+        return False
+    with open(info_fn) as f:
+        info = json.load(f)
+    if info['sources'] != sources or any(info['words'][c] != word_lists[c] for c in conditions):
+        return False
+    return os.path.getmtime(info_fn) >= max(os.path.getmtime(fn) for fn in sources)
+
+
+@instrumentation.traced
+def build(cache_dir, subject, cope_dir, word_lists, runs, mask_fn=None, force=False):
+    """Extract and cache the COPE data of a subject (see the top of this file),
+    unless the cache is current. word_lists are from read_word_lists(). mask_fn
+    defaults to the subject's run 1 cope1 mask, and without one every voxel of
+    the volume is read. Returns the path of the cache's .json."""
+    import nibabel as nib
+
+    paths = _paths(cache_dir, subject)
+    words_all = word_lists['alltrials']
+    filenames = cope_filenames(cope_dir, runs, len(words_all))
+    if mask_fn is None:
+        mask_fn = mask_filename(cope_dir, subject)
+    sources = [fn for run_fns in filenames for fn in run_fns]
+    if os.path.exists(mask_fn):
+        sources.append(mask_fn)
+
+    if not force and is_current(cache_dir, subject, sources, word_lists):
+        return paths['info']
+
+    reference = nib.load(filenames[0][0])
+    shape = reference.shape[:3]
+    if os.path.exists(mask_fn):
+        mask = np.asanyarray(nib.load(mask_fn).dataobj).reshape(-1, order='F') != 0
+        voxels = np.flatnonzero(mask)
+    else:
+        voxels = np.arange(int(np.prod(shape)))
+
+    # Average the runs of every word, and keep track of which voxels are useful
+    data = np.empty((len(words_all), len(voxels)), dtype=np.float32)
+    finite = np.ones(len(voxels), dtype=bool)
+    low = np.full(len(voxels), np.inf, dtype=np.float32)
+    high = np.full(len(voxels), -np.inf, dtype=np.float32)
+    for i_word in range(len(words_all)):
+        with instrumentation.phase('cope_data.word', subject=subject):
+            total = np.zeros(len(voxels))
+            for run_fns in filenames:
+                values = _read_voxels(run_fns[i_word], voxels)
+                finite &= np.isfinite(values)
+                np.minimum(low, values, out=low)
+                np.maximum(high, values, out=high)
+                total += values
+            data[i_word] = total / len(filenames)
+
+    useful = finite & (low != high)
+    ijk = np.stack(np.unravel_index(voxels[useful], shape, order='F'), axis=1).astype(np.int32)
+
+    # Write the arrays, then the .json
+    os.makedirs(cache_dir, exist_ok=True)
+    rows = {word: k for k, word in enumerate(words_all)}
+    for condition in conditions:
+        fn = paths['data'][condition]
+        tmp_fn = '%s.%d.tmp.npy' % (fn[:-len('.npy')], os.getpid())
+        out = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=np.float32,
+                                        shape=(len(word_lists[condition]), int(useful.sum())))
+        for k, word in enumerate(word_lists[condition]):
+            out[k] = data[rows[word], useful]
+        out.flush()
+        del out
+        os.replace(tmp_fn, fn)
+
+    tmp_fn = '%s.%d.tmp.npy' % (paths['voxels'][:-len('.npy')], os.getpid())
+    np.save(tmp_fn, ijk)
+    os.replace(tmp_fn, paths['voxels'])
+
+    info = {'subject': subject, 'runs': list(runs), 'shape': [int(n) for n in shape],
+            'affine': reference.affine.tolist(), 'reference': filenames[0][0],
+            'words': {condition: word_lists[condition] for condition in conditions},
+            'sources': sources}
+    tmp_fn = paths['info'] + '.%d.tmp' % os.getpid()
+    with open(tmp_fn, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp_fn, paths['info'])
+    return paths['info']
+
+
+def load(cache_dir, subject, condition):
+    """The cached data of a subject and condition (a read-only memory map of
+    words x voxels), and its words."""
+    paths = _paths(cache_dir, subject)
+    with open(paths['info']) as f:
+        words = json.load(f)['words'][condition]
+    return np.load(paths['data'][condition], mmap_mode='r'), words
+
+
+def load_voxels(cache_dir, subject):
+    """The voxel indices (voxels x 3) of a subject's cached data, and the rest of
+    its cache info (shape, affine, reference image, words)."""
+    paths = _paths(cache_dir, subject)
+    with open(paths['info']) as f:
+        info = json.load(f)
+    return np.load(paths['voxels']), info
@@ -0,0 +1,303 @@
+############################################################
+# Opt-in instrumentation of the model builders
+############################################################
+
+# Records where the time goes when hypothesis models are built: wall time and
+# call counts of named phases (WAV reading, MFCCs, DTW, edit distances, glyph
+# rendering, ...), counters (e.g. cache hits and misses), and memory high-water
+# marks. Instrumentation is off by default; when it is off, phase() returns a
+# shared do-nothing context manager and count() returns straight away, so the
+# instrumented code runs at (nearly) full speed.
+#
+# To switch it on, either call enable(trace_dir) before building, or set the
+# RSA_TRACE environment variable to a folder before make_rsa_model_functions.py
+# is imported (a summary is then printed when the process exits). Set
+# RSA_TRACE_MEMORY=1 to also trace Python/numpy allocations with tracemalloc
+# (slower, but gives the peak memory of each phase).
+#
+# Each run gets its own folder, <trace_dir>/<date>-<time>-<pid>, and worker
+# processes started during the run (which inherit RSA_TRACE_RUN) add their
+# events to it. report() gathers them all into:
+#
+#   trace.json     Chrome trace (open in chrome://tracing or https://ui.perfetto.dev)
+#   summary.csv    per phase: calls, total/mean/max time, memory high-water marks
+#
+# and prints the summary table.
+#
+# Usage in code:
+#
+#   with instrumentation.phase('acoustic.mfcc'):
+#       ...
+#   instrumentation.count('acoustic_cache.hit')
+#
+#   @instrumentation.traced
+#   def make_semantic_matrix(word_list): ...
+
+import os
+import csv
+import sys
+import json
+import time
+import atexit
+import threading
+import contextlib
+import functools
+
+enabled = False
+
+_run_dir = None
+_memory = False
+_events = []
+_counters = {}
+_stacks = threading.local()
+_NULL = contextlib.nullcontext()
+
+try:
+    import resource
+except ImportError:
+    # (not available on Windows)
+    resource = None
+
+
+def _maxrss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / (1024**2 if sys.platform == 'darwin' else 1024)
+
+
+############################################################
+# Switching on and off
+############################################################
+
+def enable(trace_dir, memory=False):
+    """Start recording, into a new run folder in trace_dir. Returns the run folder.
+    Worker processes started from now on record into the same run."""
+    run_dir = os.path.join(os.path.abspath(trace_dir), time.strftime('%Y%m%d-%H%M%S') + '-%d' % os.getpid())
+    os.makedirs(run_dir, exist_ok=True)
+
+    os.environ['RSA_TRACE_RUN'] = run_dir
+    os.environ['RSA_TRACE_MEMORY'] = '1' if memory else ''
+    _join(run_dir, memory)
+    return run_dir
+
+
+def _join(run_dir, memory):
+    global enabled, _run_dir, _memory
+    _reset()
+    _run_dir = run_dir
+    _memory = memory
+    if memory:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    enabled = True
+
+
+def disable():
+    """Stop recording (events recorded so far are written to the run folder)."""
+    global enabled
+    if enabled:
+        flush()
+    enabled = False
+
+
+def _reset():
+    _events.clear()
+    _counters.clear()
+    _stacks.__dict__.clear()
+
+
+# A forked worker inherits the parent's unwritten events; only the parent writes them
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset)
+
+
+############################################################
+# Recording
+############################################################
+
+class _Phase:
+    __slots__ = ('name', 'args', 'start', 'peak')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.peak = 0
+
+    def __enter__(self):
+        if _memory:
+            import tracemalloc
+            stack = _stack()
+            if stack:
+                # Allocations so far count towards the enclosing phase
+                stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        args = dict(self.args)
+        args['max_rss_mb'] = _maxrss_mb()
+
+        if _memory:
+            import tracemalloc
+            stack = _stack()
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            args['traced_peak_mb'] = peak / 1024**2
+            stack.pop()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+
+        _events.append({'name': self.name, 'cat': self.name.split('.')[0], 'ph': 'X',
+                        'ts': self.start / 1000, 'dur': (end - self.start) / 1000,
+                        'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+        return False
+
+
+def _stack():
+    if not hasattr(_stacks, 'phases'):
+        _stacks.phases = []
+    return _stacks.phases
+
+
+def phase(name, **args):
+    """Context manager timing one phase. Keyword arguments are recorded with the
+    event (e.g. the number of pairs)."""
+    if not enabled:
+        return _NULL
+    return _Phase(name, args)
+
+
+def traced(function):
+    """Decorator recording every call of a function as a phase named after it."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return function(*args, **kwargs)
+        with _Phase(function.__name__, {}):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def count(name, n=1):
+    """Add n to a counter."""
+    if enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def flush():
+    """Append this process' events (and its counter totals) to the run folder.
+    Worker functions call this at the end of every task."""
+    if not enabled or not (_events or _counters):
+        return
+
+    events = list(_events)
+    if _counters:
+        events.append({'name': 'counters', 'ph': 'C', 'ts': time.perf_counter_ns() / 1000,
+                       'pid': os.getpid(), 'tid': 0, 'args': dict(_counters)})
+    _events.clear()
+
+    # Counters are cumulative per process: only the last record of each is used
+    with open(os.path.join(_run_dir, 'events-%d.jsonl' % os.getpid()), 'a') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+
+
+############################################################
+# Reporting
+############################################################
+
+def _read_events(run_dir):
+    events = []
+    for name in sorted(os.listdir(run_dir)):
+        if name.startswith('events-') and name.endswith('.jsonl'):
+            with open(os.path.join(run_dir, name)) as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+    return events
+
+
+def summarize(events):
+    """Per phase totals, and counter totals over all processes, from a list of
+    trace events. Returns (phases, counters): phases is a list of dicts, sorted
+    by total time."""
+    phases = {}
+    for event in events:
+        if event['ph'] != 'X':
+            continue
+        row = phases.setdefault(event['name'], {'phase': event['name'], 'calls': 0, 'total_s': 0.0,
+                                                'max_ms': 0.0, 'max_rss_mb': None, 'traced_peak_mb': None})
+        row['calls'] += 1
+        row['total_s'] += event['dur'] / 1e6
+        row['max_ms'] = max(row['max_ms'], event['dur'] / 1e3)
+        for key in ['max_rss_mb', 'traced_peak_mb']:
+            value = event['args'].get(key)
+            if value is not None:
+                row[key] = value if row[key] is None else max(row[key], value)
+
+    for row in phases.values():
+        row['mean_ms'] = row['total_s'] * 1e3 / row['calls']
+
+    last = {}
+    for event in events:
+        if event['ph'] == 'C':
+            last[event['pid']] = event['args']
+    counters = {}
+    for values in last.values():
+        for name, value in values.items():
+            counters[name] = counters.get(name, 0) + value
+
+    return sorted(phases.values(), key=lambda row: -row['total_s']), counters
+
+
+def report(run_dir=None, file=None):
+    """Gather the events of a run (by default, the current one) into trace.json
+    and summary.csv in the run folder, and print the summary table. Returns
+    (phases, counters), as summarize()."""
+    if run_dir is None:
+        if _run_dir is None:
+            raise RuntimeError('Instrumentation has not been enabled')
+        flush()
+        run_dir = _run_dir
+    file = file or sys.stdout
+
+    events = _read_events(run_dir)
+    phases, counters = summarize(events)
+
+    names = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+              'args': {'name': 'main' if run_dir.endswith('-%d' % pid) else 'worker %d' % pid}}
+             for pid in sorted(set(event['pid'] for event in events))]
+    with open(os.path.join(run_dir, 'trace.json'), 'w') as f:
+        json.dump({'traceEvents': names + events, 'displayTimeUnit': 'ms'}, f)
+
+    columns = ['phase', 'calls', 'total_s', 'mean_ms', 'max_ms', 'max_rss_mb', 'traced_peak_mb']
+    with open(os.path.join(run_dir, 'summary.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(phases)
+
+    fmt = lambda value, spec: spec % value if value is not None else '-'
+    print('\nInstrumentation summary (%s):' % run_dir, file=file)
+    print('%-34s %8s %10s %10s %10s %11s %11s' % ('phase', 'calls', 'total_s', 'mean_ms', 'max_ms',
+                                                 'max_rss_mb', 'peak_mb'), file=file)
+    for row in phases:
+        print('%-34s %8d %10.3f %10.3f %10.3f %11s %11s'
+              % (row['phase'], row['calls'], row['total_s'], row['mean_ms'], row['max_ms'],
+                 fmt(row['max_rss_mb'], '%.0f'), fmt(row['traced_peak_mb'], '%.1f')), file=file)
+    for name in sorted(counters):
+        print('%-34s %8d' % (name, counters[name]), file=file)
+
+    return phases, counters
+
+
+# Switch on from the environment: join the run of the process that started this
+# one, or start a new run (reported when this process exits)
+if os.environ.get('RSA_TRACE_RUN'):
+    _join(os.environ['RSA_TRACE_RUN'], bool(os.environ.get('RSA_TRACE_MEMORY')))
+elif os.environ.get('RSA_TRACE'):
+    enable(os.environ['RSA_TRACE'], memory=bool(os.environ.get('RSA_TRACE_MEMORY')))
+    atexit.register(report)
@@ -6,8 +6,9 @@
 import pandas as pd
 import itertools
 import os.path
+from functools import lru_cache, partial
 import numpy as np
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial.distance import pdist, cdist, squareform
 from scipy import spatial
 
 ############################################################
@@ -22,67 +23,109 @@ assets_dir = os.path.join(top_dir, 'MRIanalyses', 'assets')
 # Import dependencies for specific functions
 ############################################################
 
-# Dependencies for articulatory measure (corpustools)
-from corpustools import corpus, symbolsim, contextmanagers
-from corpustools.symbolsim.string_similarity import string_similarity
-from corpustools.corpus import *
-from corpustools.corpus.io import *
-from corpustools.contextmanagers import *
+# The heavy third-party packages (corpustools, gensim, PIL) are only
+# imported inside the functions that need them, so importing this file (e.g. in
+# every worker process) stays quick and light when only a few measures are built.
 
-# Dependencies for orthographic measure (wordkit)
-import wordkit
-from wordkit.features import OpenNGramTransformer, LinearTransformer, fourteen, CVTransformer, PhonemeFeatureExtractor
-#import eng_to_ipa as ipa
+# NEW Dependencies for acoustic distance (modified function from Bartelds, 2020;
+# stored in the same folder as this script)
+from acoustic_distance import acoustic_distance, pairwise_acoustic_distances, FeatureCache
 
-# Dependencies for semantic measure (gensim and pattern)
-import gensim ## we can ignore the warning about Levenshtein distance - it doesn't matter to us
-from gensim import downloader as api
-from pattern.en import lemma, lexeme  # .en gives us the English version
+# All hypothesis matrices are returned as RDM objects (condensed upper triangle +
+# word labels; see rdm.py). Use .to_csv() / .to_dataframe() for the full matrix.
+from rdm import RDM
 
-# Dependencies for visual measure (Pillow / PIL)
-import PIL
-from PIL import Image, ImageDraw, ImageFont
-from imageio import imread
+# Opt-in timing of the phases below (see instrumentation.py)
+import instrumentation
 
-# NEW Dependencies for acoustic distance (modified function from Bartelds, 2020;
-# stored in the same folder as this script)
-from acoustic_distance import acoustic_distance
+# Rendering and correlation of word silhouettes, for visual measure
+from visual_silhouettes import GlyphCache, pack_silhouettes, correlation_distances
+
+# Sparse open n-gram features, for orthographic measure
+from open_ngrams import OpenNGramFeatures
+from open_ngrams import correlation_distances as orthographic_correlation_distances
+import open_ngrams
+
+# Blocked, memory-mapped computation of lexicon-sized matrices
+import blocked_rdm
 
 ############################################################
 # Import assets for specific functions
 ############################################################
 
+# Every asset is loaded on first use (by the accessor functions below) and then
+# kept for the rest of the session.
+
 # IPHOD corpus, for articulatory measure
 corpus_path = os.path.join(assets_dir, 'corpora_and_models', 'iphod_corpus')
-mycorpus=load_binary(corpus_path)
-mycontext=BaseCorpusContext(mycorpus, sequence_type='transcription', type_or_token='type')
 
-# Pre-made word2vec model, for semantic measure
+@lru_cache(maxsize=None)
+@instrumentation.traced
+def get_iphod_corpus():
+    from corpustools.corpus.io import load_binary
+    return load_binary(corpus_path)
+
+@lru_cache(maxsize=None)
+@instrumentation.traced
+def get_iphod_context():
+    from corpustools.contextmanagers import BaseCorpusContext
+    return BaseCorpusContext(get_iphod_corpus(), sequence_type='transcription', type_or_token='type')
+
+# Pre-made word2vec model, for semantic measure. The vectors are memory-mapped
+# (read-only), so that parallel workers share a single copy in the page cache.
 sem_model_fname = os.path.join(assets_dir, 'corpora_and_models', 'SEMmodel_glove-wiki-gigaword-300.model')
-sem_model = gensim.models.keyedvectors.KeyedVectors.load(sem_model_fname)
+
+@lru_cache(maxsize=None)
+@instrumentation.traced
+def get_sem_model():
+    from gensim.models import KeyedVectors
+    return KeyedVectors.load(sem_model_fname, mmap='r')
 
 # List of speakers and path to audio recordings for phonological (acoustic) distance.
 acoust_path = os.path.join(top_dir, 'MRIanalyses', 'assets', 'word_audio_recordings')
 voices = ['vol1', 'vol2', 'vol3', 'vol4','vol5','vol6',
             'ai_Clara_f_CAN', 'ai_Liam_m_CAN', 'ai_Jenny_f_USA', 'ai_Davis_m_USA']
 
+# On-disk cache of acoustic features (MFCCs etc.), so that each recording is only
+# featurized once, and re-used across subjects, conditions and re-runs
+cache_dir = os.path.join(assets_dir, 'cache')
+acoustic_cache = FeatureCache(os.path.join(cache_dir, 'acoustic_features'))
+
+# Rendered word silhouettes for visual measure (kept across subjects and runs)
+glyph_cache = GlyphCache(os.path.join(cache_dir, 'visual_glyphs'))
+
+# Fitted open n-gram feature spaces for orthographic measure, by (n, window)
+_orthographic_features = {}
+
 ############################################################
 # Define custom functions for constructing hypothesis matrices
 ############################################################
 
 # Articulatory (feature-weighted phonological edit distance)
+@instrumentation.traced
 def make_articulatory_matrix(word_list):
 
     # Ensure word list is sorted alphabetically
     word_list_sorted = sorted(word_list)
 
-    # Arrange list of words into all possible pairs
-    pairs = list(itertools.permutations(word_list_sorted, 2))
+    # Arrange list of words into all unique pairs. The distance is symmetric, so we
+    # only need each pair once (in the same order as the condensed RDM)
+    pairs = list(itertools.combinations(word_list_sorted, 2))
 
-    # Define an empty matrix, containing a row/column for ever word
-    matrix=pd.DataFrame(index=word_list_sorted, columns=word_list_sorted)
+    return RDM(word_list_sorted, articulatory_distances(pairs))
 
-    for pair in pairs:
+# Articulatory distance for each (word1, word2) in a list of pairs
+@instrumentation.traced
+def articulatory_distances(pairs):
+    from corpustools.symbolsim.string_similarity import string_similarity
+
+    mycorpus = get_iphod_corpus()
+    mycontext = get_iphod_context()
+
+    # Define an empty (condensed) matrix, containing a value for every pair
+    distances = np.zeros(len(pairs))
+
+    for k, pair in enumerate(pairs):
 
         # Each pair is a tuple, so let's convert to list
         pair_list = list(pair)
@@ -96,9 +139,10 @@ def make_articulatory_matrix(word_list):
         w2 = mycorpus.find(pair_list[1])
 
         # Get similarity for this pair
-        x = string_similarity(corpus_context=mycontext
-                              , query=(w1,w2)
-                              , algorithm='phono_edit_distance')
+        with instrumentation.phase('articulatory.edit_distance'):
+            x = string_similarity(corpus_context=mycontext
+                                  , query=(w1,w2)
+                                  , algorithm='phono_edit_distance')
 
         # The object "x" is technically a list of tuples, BUT there is only one tuple. The tuple contains:
         # (1) string1, (2) string2, (3) the phonological edit distance betwen string1 and string2
@@ -114,56 +158,50 @@ def make_articulatory_matrix(word_list):
         max_len = max(len(pair_list[0]), len(pair_list[1]))
 
         # Divide distance by max word length
-        distance = distance/max_len
-
-        # Insert the distance value into the corresponding row/column
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[1]]=distance
-
-        # Finally, enter zeros along the diagonal
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[0]]=0
-
-    return matrix
-
-# Orthographic (correlation distance of open bigram vectors)
-def make_orthographic_matrix(word_list):
+        distances[k] = distance/max_len
 
-    for i in word_list:
+    return distances
 
-        # Transform to features based on open bigrams. We'll use a constrained bigram approach
-        # but see options here: https://github.com/clips/wordkit/tree/master/wordkit/features/orthography
-        o = OpenNGramTransformer(2)
-        features = o.fit_transform(word_list)
+# Orthographic (correlation distance of open bigram vectors; see open_ngrams.py).
+# By default these are unconstrained open bigrams; n sets the n-gram size, and a
+# window constrains the n-grams to letters at most window letters apart. See also
+# https://github.com/clips/wordkit/tree/master/wordkit/features/orthography
+@instrumentation.traced
+def make_orthographic_matrix(word_list, n=2, window=None):
 
+    # The feature space for each (n, window) is fitted once, and extended with any
+    # new words, rather than refitted for every call
+    if (n, window) not in _orthographic_features:
+        _orthographic_features[n, window] = OpenNGramFeatures(n, window)
+    with instrumentation.phase('orthographic.features', words=len(word_list)):
+        features = _orthographic_features[n, window].transform(list(word_list))
 
-        # Arrange features into a DSM (correlation distance)
-        matrix = squareform(pdist(features, 'correlation'))
-
-        # Plug into a pandas df
-        df = pd.DataFrame(data=matrix, index=word_list, columns=word_list)
-
-
-    return df
+    # Arrange features into a DSM (correlation distance)
+    with instrumentation.phase('orthographic.correlation', words=len(word_list)):
+        distances = orthographic_correlation_distances(features)
+    return RDM(word_list, distances)
 
 # Phonological (acoustic distance)
-def make_phonological_matrix(word_list):
+@instrumentation.traced
+def make_phonological_matrix(word_list, n_jobs=1):
     word_list_sorted = sorted(word_list)
 
-    # Arrange list of words into all possible pairs
-    pairs = list(itertools.permutations(word_list_sorted, 2))
+    # Arrange list of words into all unique pairs (acoustic distance is symmetric, so
+    # each pair is computed once, in the same order as the condensed RDM)
+    pairs = list(itertools.combinations(word_list_sorted, 2))
 
     # Use the following if you want all combinations with replacement (useful for comparing similarity of 2 sets)
     # pairs = list(itertools.combinations_with_replacement(word_list_sorted, 2))
 
-    # Create an empty list that will house matrices computed from each volunteer
-    acoustic_matrices = []
+    return RDM(word_list_sorted, phonological_distances(pairs, n_jobs=n_jobs))
+
+# Folder and set number of every set of recordings (one phonological DSM is computed per set)
+def recording_sets():
+    sets = []
 
     # Loop through volunteers
     for voice in voices:
 
-        # Define two empty matrices, containing a row/column for ever word
-        matrix_1=pd.DataFrame(index=word_list_sorted, columns=word_list_sorted)
-        matrix_2=pd.DataFrame(index=word_list_sorted, columns=word_list_sorted)
-
         # We have 2 sets of words for each volunteer (except vol6). So, we'll compute a DSM for each set.
         for s in [1, 2]:
 
@@ -171,372 +209,496 @@ def make_phonological_matrix(word_list):
             if s==2 and voice in ['ai_Clara_f_CAN', 'ai_Liam_m_CAN', 'ai_Jenny_f_USA', 'ai_Davis_m_USA', 'vol6']:
                 continue
 
-            # Call the matrix for this set
-            matrix = eval('matrix_%s' %s)
+            # Call path to audio files for this set
+            sets.append((os.path.join(acoust_path, voice, 'auto_find_labels'), s))
+
+    return sets
 
-            # Loop through word pairs
-            for pair in pairs:
+# Audio files of every recording of the given words
+def recording_files(word_list):
+    return [os.path.join(file_path, w + str(s) + '.wav')
+            for file_path, s in recording_sets() for w in word_list]
 
-                # Define each word in the pair
-                w1 = pair[0]
-                w2 = pair[1]
+# Phonological distance (averaged over volunteers/sets) for each (word1, word2) in a list of pairs
+@instrumentation.traced
+def phonological_distances(pairs, n_jobs=1):
 
-                # Call path to audio files for this set
-                file_path = os.path.join(acoust_path, voice, 'auto_find_labels')
+    # Create an empty list that will house the audio files for every pair, from every
+    # volunteer and set. All of these are computed in one go (in parallel if n_jobs > 1)
+    file_pairs = []
+    n_sets = 0
 
-                # Define the audio file for each word in the pair
-                file1 = os.path.join(file_path, w1 + str(s) + '.wav')
-                file2 = os.path.join(file_path, w2 + str(s) + '.wav')
+    # Loop through volunteers and sets
+    for file_path, s in recording_sets():
+        n_sets += 1
 
-                # Compute acoustic distance
-                distance = acoustic_distance(file1, file2)
+        # Define the audio file for each word in each pair
+        for w1, w2 in pairs:
+            file_pairs.append((os.path.join(file_path, w1 + str(s) + '.wav'),
+                               os.path.join(file_path, w2 + str(s) + '.wav')))
 
-                # Insert the distance value into the corresponding row/column
-                matrix.loc[matrix.index==pair[0], matrix.columns==pair[1]]=distance
+    # Compute acoustic distances. Features for each recording are computed once and
+    # cached; pairs are spread across n_jobs worker processes.
+    distances = pairwise_acoustic_distances(file_pairs, acoustic_cache, n_jobs=n_jobs)
 
-                # Enter zero on the diagonal
-                matrix.loc[matrix.index==pair[0], matrix.columns==pair[0]]=0
+    # Arrange into one (condensed) matrix per volunteer/set, and compute the average
+    acoustic_matrices = distances.reshape(n_sets, len(pairs))
 
-            # Append matrix to list of matrices
-            acoustic_matrices.append(matrix.to_numpy())
+    return np.average(acoustic_matrices, axis=0)
 
-    # Compute the average of all acoustic matrices and convert to a pandas DataFrame
-    matrix = pd.DataFrame(np.average(acoustic_matrices, axis=0),
-                    columns = word_list_sorted, index = word_list_sorted)
+# Unit-length word vectors for a vocabulary (a tuple of words), gathered into one
+# contiguous (n_words x 300) array. Cached per vocabulary, so repeated calls with
+# the same words (e.g. for each condition) don't gather them again.
+@lru_cache(maxsize=32)
+def _get_normalized_vectors(words):
+    sem_model = get_sem_model()
 
+    missing = [w for w in words if w not in sem_model]
+    if missing:
+        raise KeyError('No semantic vectors found for: %s' % ', '.join(missing))
 
-    return matrix
+    vectors = np.array(sem_model.vectors[[sem_model.get_index(w) for w in words]], dtype=np.float64)
+
+    return _normalize_rows(vectors)
+
+# Normalize vectors (in place) as model.similarity() does (all-zero vectors are left as zeros)
+def _normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
 
 # Semantic distance (cosine distance of word2vec vectors)
+@instrumentation.traced
 def make_semantic_matrix(word_list):
 
     # Ensure word list is sorted alphabetically
     word_list_sorted = sorted(word_list)
 
-    # Arrange list of words into all possible pairs
-    pairs = list(itertools.permutations(word_list_sorted, 2))
-
-    # Define an empty matrix, containing a row/column for ever word
-    matrix=pd.DataFrame(index=word_list_sorted, columns=word_list_sorted)
-
-    # Loop through word pairs, getting a distance value for each pair, and insert it into our matrix
-    for pair in pairs:
-
-        # Assign each word to an object and compute distance
-        w1 = pair[0]
-        w2 = pair[1]
-        x = sem_model.similarity(w1, w2)
-
-        # model.similarity spits out cosine similarity (i.e. lower values = LESS similar).
-        # Therefore, subtract the similarity value from 1 to get a distance measure.
-        d = 1-x
-
-        # Insert the distance value into the corresponding row/column
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[1]]=d
+    # Cosine similarity of every pair of words, with a single matrix multiply
+    with instrumentation.phase('semantic.vectors', words=len(word_list_sorted)):
+        vectors = _get_normalized_vectors(tuple(word_list_sorted))
+    with instrumentation.phase('semantic.similarity', words=len(word_list_sorted)):
+        similarity = vectors @ vectors.T
 
-        # Finally enter zeros along the diagonal
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[0]]=0
+        # Cosine similarity is higher for MORE similar words. Therefore, subtract the
+        # similarity from 1 to get a distance measure (upper triangle, in condensed order)
+        distances = 1 - similarity[np.triu_indices(len(word_list_sorted), 1)]
 
-    return matrix
+    return RDM(word_list_sorted, distances)
 
-# Visual (correlation distance of silhouette vectors)
+# Visual (correlation distance of silhouette vectors; see visual_silhouettes.py)
+@instrumentation.traced
 def make_visual_matrix(word_list):
 
-    # Create empty list to store vectors
-    vectors = []
-
     # Ensure word list is sorted alphabetically
     word_list_sorted = sorted(word_list)
 
-    for word in word_list_sorted:
-
-        # Define display ratio
-        W, H = (1920,1080)
-
-        # Create background image
-        win = Image.new('RGB', (W,H), color=(128,128,128) # RGB from experiment
-                       )
-
-        # Define word we will draw and font. Letter height should be proportional (0.1) to window height
-        thisword = word
-        fontsize = int(H * 0.1)
-        myfont = ImageFont.truetype("arial.ttf", fontsize)
-
-        # Call background image and "draw" word onto it
-        draw = ImageDraw.Draw(win)
-
-        # Define font / text size
-        myFont = ImageFont.truetype("arial.ttf", fontsize)
-        w, h = draw.textsize(word, font=myFont)
+    # Silhouette of each word, as it appeared on screen (cropped, from the glyph cache)
+    with instrumentation.phase('visual.glyphs', words=len(word_list_sorted)):
+        glyphs = [glyph_cache.get(word) for word in word_list_sorted]
 
-        # Define word position
-        pos = ((W-w)/2,(H-h)/2)
+    # Arrange silhouettes into a DSM (correlation distance over the whole screen)
+    W, H = glyph_cache.screen_size
+    with instrumentation.phase('visual.correlation', words=len(word_list_sorted)):
+        distances = correlation_distances(pack_silhouettes(glyphs), W * H)
 
-        # Put everything together
-        draw.text(pos, text=thisword,font=myfont, fill="white")
-
-        # Binarize image (0 for background, 1 for everything else)
-        win_bin = win.point( lambda p: 0 if p == 128 else 1 )
-
-        # Convert to array
-        arr = np.array(win_bin)
-        arr_flat = np.ndarray.flatten(arr)
-
-        # Convert arr to a vector
-        vector = arr_flat.tolist()
-
-        # Add to list of vectors
-        vectors.append(vector)
-
-    # Once we've looped through all words in this condition, arrange vectors into a DSM (correlation distance)
-    matrix = squareform(pdist(vectors, 'correlation'))
-
-    # Plug into a pandas df
-    df = pd.DataFrame(data=matrix, index=word_list_sorted, columns=word_list_sorted)
-
-    return df
+    return RDM(word_list_sorted, distances)
 
 
 ############################################################
 # Define functions for posisble confounding properties
 ############################################################
 
-# Import assets...
+# Import assets... (each table is read on first use, then kept)
 
 # Concreteness ratings (from Brysbaert et al., 2014)
 conc_fname = os.path.join(assets_dir, 'Brysbaert_et_al_2014_concreteness_ratings.csv')
-conc = pd.read_csv(conc_fname)[['Word', 'Conc.M']]
-conc = conc.rename(columns={'Word': 'WORD', 'Conc.M': 'RATING'})
+
+@lru_cache(maxsize=None)
+@instrumentation.traced
+def get_conc_ratings():
+    conc = pd.read_csv(conc_fname)[['Word', 'Conc.M']]
+    return conc.rename(columns={'Word': 'WORD', 'Conc.M': 'RATING'})
 
 # Grapheme-to-phoneme consistency values (Obtained from Chee et al., 2020) for G2P measure measure
 g_to_p_values_fname = os.path.join(assets_dir, 'grapheme_to_phoneme_consistency_norms', 'quickread_words_alphabetical_consistency.csv')
-gpvs = pd.read_csv(g_to_p_values_fname, sep=',', usecols = ['WORD', 'O', 'N', 'C'])  # The remaining columns are combinations of O,N,C and not really useful to us
+
+@lru_cache(maxsize=None)
+@instrumentation.traced
+def get_g2p_values():
+    return pd.read_csv(g_to_p_values_fname, sep=',', usecols = ['WORD', 'O', 'N', 'C'])  # The remaining columns are combinations of O,N,C and not really useful to us
 
 # Imageability ratings (from Scott et al., 2019)
 imag_fname = os.path.join(assets_dir, 'Scott_et_al_2019_imageability_ratings.csv')
-imag = pd.read_csv(imag_fname, sep=',', usecols=['Words', 'IMAG'])
-imag = imag.rename(columns={'Words': 'WORD', 'IMAG': 'RATING'})
+
+@lru_cache(maxsize=None)
+@instrumentation.traced
+def get_imag_ratings():
+    imag = pd.read_csv(imag_fname, sep=',', usecols=['Words', 'IMAG'])
+    return imag.rename(columns={'Words': 'WORD', 'IMAG': 'RATING'})
 
 # Morphological complexity (N morphemes)
 morph_fname = os.path.join(assets_dir, 'quickread_words_morphemes.csv')
-morph = pd.read_csv(morph_fname)[['WORD', 'N_MORPHEMES']]
-morph = morph.rename(columns={'WORD': 'WORD', 'N_MORPHEMES': 'RATING'})
+
+@lru_cache(maxsize=None)
+@instrumentation.traced
+def get_morph_counts():
+    morph = pd.read_csv(morph_fname)[['WORD', 'N_MORPHEMES']]
+    return morph.rename(columns={'WORD': 'WORD', 'N_MORPHEMES': 'RATING'})
 
 # Syntactic category (noun only = 0, noun and verb = 1)
 nounverb_fname = os.path.join(assets_dir, 'quickread_words_noun_or_verb.csv')
-nounverb = pd.read_csv(nounverb_fname)
 
+@lru_cache(maxsize=None)
+@instrumentation.traced
+def get_nounverb_categories():
+    return pd.read_csv(nounverb_fname)
 
-# Define functions...
 
-# Concereteness (absolute difference in concreteness ratings)
-def make_conc_matrix(word_list):
+# Shared engine...
 
-    # Define df as conc (pd dataframe containing concreteness ratings)
-    df = conc.copy()
+# Word -> feature lookup tables, built once per ratings table (on first use) and
+# then re-used by every call. Looking words up in these is a single hash lookup,
+# rather than a scan over the whole ratings table for every word in every pair.
+_feature_indices = {}
 
-    # Ensure word list is sorted alphabetically
-    word_list_sorted = sorted(word_list)
+def _get_feature_index(name, df, value_cols):
 
-    # Arrange list of words into all possible pairs
-    pairs = list(itertools.permutations(word_list_sorted, 2))
+    if name not in _feature_indices:
 
-    # Define an empty matrix, containing a row/column for ever word
-    matrix=pd.DataFrame(index=word_list_sorted, columns=word_list_sorted)
+        # Some tables contain duplicate entries for the same word. The original
+        # (pair-wise) code always took the first match, so we do the same here
+        index = df.drop_duplicates(subset='WORD', keep='first').set_index('WORD')
+        _feature_indices[name] = index[value_cols].astype(float)
 
-    for pair in pairs:
+    return _feature_indices[name]
 
-        # Define each word in the pair
-        w1 = pair[0]
-        w2 = pair[1]
+# Pull the feature vector for every word in word_list (in order) from a
+# feature index, raising a single clear error if any words are missing
+def _lookup_features(index, word_list, name):
 
-        # Get rating for each word
-        w1_rating = df.loc[df['WORD'] == w1, 'RATING'].iloc[0]
-        w2_rating = df.loc[df['WORD'] == w2, 'RATING'].iloc[0]
+    missing = [w for w in word_list if w not in index.index]
+    if missing:
+        raise KeyError('No %s values found for: %s' % (name, ', '.join(missing)))
 
-        # Compute distance as absolute difference in ratings
-        distance = abs(w1_rating - w2_rating)
+    return index.loc[word_list].to_numpy()
 
-        # Insert the distance value into the corresponding row/column
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[1]]=distance
+# Arrange an (n_words x n_features) array into a DSM. For a single feature
+# 'cityblock' is the absolute difference; 'euclidean' is used for vectors.
+# Words whose features are NaN end up with NaN distances (see make_imag_matrix).
+def _pairwise_feature_matrix(word_list, features, metric):
 
-        # Finally, enter zeros along the diagonal
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[0]]=0
+    features = np.asarray(features, dtype=float).reshape(len(word_list), -1)
 
-    return matrix
+    with instrumentation.phase('ratings.pdist', words=len(word_list)):
+        distances = pdist(features, metric)
+    return RDM(word_list, distances)
 
-# Grapheme-to-phoneme consistency (euclidean distance of G2P vectors)
-def make_g2p_matrix(word_list):
+# Define functions...
+
+# Concereteness (absolute difference in concreteness ratings)
+@instrumentation.traced
+def make_conc_matrix(word_list):
 
     # Ensure word list is sorted alphabetically
     word_list_sorted = sorted(word_list)
 
-    # Arrange list of words into all possible pairs
-    pairs = list(itertools.permutations(word_list_sorted, 2))
+    # Get rating for each word (get_conc_ratings() is a pd dataframe containing concreteness ratings)
+    index = _get_feature_index('conc', get_conc_ratings(), ['RATING'])
+    ratings = _lookup_features(index, word_list_sorted, 'concreteness')
 
-    # Define an empty matrix, containing a row/column for ever word
-    matrix=pd.DataFrame(index=word_list_sorted, columns=word_list_sorted)
+    # Compute distance as absolute difference in ratings
+    return _pairwise_feature_matrix(word_list_sorted, ratings, 'cityblock')
 
-    for pair in pairs:
-
-        # Define each word in the pair
-        w1 = pair[0]
-        w2 = pair[1]
+# Grapheme-to-phoneme consistency (euclidean distance of G2P vectors)
+@instrumentation.traced
+def make_g2p_matrix(word_list):
 
-        # Get vector for each word
-        w1_vec = gpvs.loc[gpvs['WORD'].isin([w1])].iloc[0][1:]
-        w2_vec = gpvs.loc[gpvs['WORD'].isin([w2])].iloc[0][1:]
+    # Ensure word list is sorted alphabetically
+    word_list_sorted = sorted(word_list)
 
-        # Treat values for O,N,C as a vector and compute euclidean distance
-        distance = spatial.distance.euclidean(w1_vec, w2_vec)
+    # Get vector for each word (every column other than WORD, i.e. O, N, C)
+    gpvs = get_g2p_values()
+    value_cols = [c for c in gpvs.columns if c != 'WORD']
+    index = _get_feature_index('g2p', gpvs, value_cols)
+    vectors = _lookup_features(index, word_list_sorted, 'G2P consistency')
 
-        # Insert the distance value into the corresponding row/column
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[1]]=distance
+    # Treat values for O,N,C as a vector and compute euclidean distance
+    return _pairwise_feature_matrix(word_list_sorted, vectors, 'euclidean')
 
-        # Finally, enter zeros along the diagonal
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[0]]=0
+# Imageability (absolute difference in imageability ratings)
 
-    return matrix
+# Ratings are not provided for these words in Scott et al.
+imag_unrated_words = ['account', 'campaign', 'century', 'department', 'journey', 'painting', 'powder', 'turnip']
 
-# Imageability (absolute difference in imageability ratings)
-def make_imag_matrix(word_list):
+@instrumentation.traced
+def make_imag_matrix(word_list, keep_masked=False):
 
-    # Remove the following words (ratings are not provided for these words in Scott et al.)
-    rm_words = ['account', 'campaign', 'century', 'department', 'journey', 'painting', 'powder', 'turnip']
+    # Remove the unrated words
+    rm_words = imag_unrated_words
 
     # Ensure the word list is sorted alphabetically
-    word_list_sorted = sorted([i for i in word_list if i not in rm_words])
+    word_list_sorted = sorted(word_list)
+    rated_words = [i for i in word_list_sorted if i not in rm_words]
 
-    # Define df as imag (pd dataframe containing imageability ratings)
-    df = imag.copy()
+    # Get rating for each word (get_imag_ratings() is a pd dataframe containing imageability ratings).
+    # Note that these are converted to float when the index is built. Words without
+    # ratings get NaN.
+    index = _get_feature_index('imag', get_imag_ratings(), ['RATING'])
+    ratings = pd.Series(np.nan, index=word_list_sorted)
+    ratings[rated_words] = _lookup_features(index, rated_words, 'imageability')[:, 0]
 
-    # Arrange list of words into all possible pairs
-    pairs = list(itertools.permutations(word_list_sorted, 2))
+    # Compute distance as absolute difference in ratings. The unrated words are masked
+    # (NaN); by default they are dropped from the matrix altogether, as before.
+    matrix = _pairwise_feature_matrix(word_list_sorted, ratings.to_numpy(), 'cityblock')
+    matrix = matrix.mask([i for i in word_list_sorted if i in rm_words])
 
-    # Define an empty matrix, containing a row/column for ever word
-    matrix=pd.DataFrame(index=word_list_sorted, columns=word_list_sorted)
+    if keep_masked:
+        return matrix
 
-    for pair in pairs:
+    return matrix.dropna()
 
-        # Define each word in the pair
-        w1 = pair[0]
-        w2 = pair[1]
 
-        # Get rating for each word - note that these have to be converted to float
-        w1_rating = float(df.loc[df['WORD'] == w1, 'RATING'].iloc[0])
-        w2_rating = float(df.loc[df['WORD'] == w2, 'RATING'].iloc[0])
+# Morphological complexity (absolute difference in number of morphemes)
+@instrumentation.traced
+def make_morph_matrix(word_list):
 
-        # Compute distance as absolute difference in ratings
-        distance = abs(w1_rating - w2_rating)
+    # Ensure word list is sorted alphabetically
+    word_list_sorted = sorted(word_list)
 
-        # Insert the distance value into the corresponding row/column
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[1]]=distance
+    # Get N morphemes for each word (get_morph_counts() is a pd dataframe containing N morphemes)
+    index = _get_feature_index('morph', get_morph_counts(), ['RATING'])
+    ratings = _lookup_features(index, word_list_sorted, 'N morphemes')
 
-        # Finally, enter zeros along the diagonal
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[0]]=0
+    # Compute distance as absolute difference in ratings
+    return _pairwise_feature_matrix(word_list_sorted, ratings, 'cityblock')
 
-    return matrix
+# Syntactic category (absolute difference between 0 (noun only) and 1 (noun and verb) )
+@instrumentation.traced
+def make_nounverb_matrix(word_list):
 
+    # Ensure word list is sorted alphabetically
+    word_list_sorted = sorted(word_list)
 
-# Morphological complexity (absolute difference in number of morphemes)
-def make_morph_matrix(word_list):
+    # Get noun/verb assignment for each word (get_nounverb_categories() is a pd dataframe containing
+    # binary noun-verb assignments)
+    index = _get_feature_index('nounverb', get_nounverb_categories(), ['RATING'])
+    ratings = _lookup_features(index, word_list_sorted, 'noun/verb')
 
-    # Define df as morph (pd dataframe containing N morphemes)
-    df = morph.copy()
+    # Compute distance as absolute difference in ratings
+    return _pairwise_feature_matrix(word_list_sorted, ratings, 'cityblock')
+
+# Word length (absolute difference in word length)
+@instrumentation.traced
+def make_wordlength_matrix(word_list):
 
     # Ensure word list is sorted alphabetically
     word_list_sorted = sorted(word_list)
 
-    # Arrange list of words into all possible pairs
-    pairs = list(itertools.permutations(word_list_sorted, 2))
-
-    # Define an empty matrix, containing a row/column for ever word
-    matrix=pd.DataFrame(index=word_list_sorted, columns=word_list_sorted)
+    # Get length of each word
+    lengths = [len(w) for w in word_list_sorted]
 
-    for pair in pairs:
+    # Compute distance as absolute difference in word length. Note: use
+    # feature_edit_distance_div_maxlen() for values normalized for word length
+    return _pairwise_feature_matrix(word_list_sorted, lengths, 'cityblock')
 
-        # Define each word in the pair
-        w1 = pair[0]
-        w2 = pair[1]
 
-        # Get N morphemes for each word
-        w1_rating = df.loc[df['WORD'] == w1, 'RATING'].iloc[0]
-        w2_rating = df.loc[df['WORD'] == w2, 'RATING'].iloc[0]
+############################################################
+# Lexicon-scale matrices
+############################################################
 
-        # Compute distance as absolute difference in ratings
-        distance = abs(w1_rating - w2_rating)
+# For screening candidate stimuli, the semantic, orthographic and ratings-based
+# measures can be computed over tens of thousands of words. The matrix is then
+# built block by block, straight into a memory-mapped file (see blocked_rdm.py),
+# so memory use depends on block_size rather than on the number of words.
+# Unlike the builders above, words without vectors (semantic) or ratings are
+# masked (NaN) rather than raising an error, since a large candidate list will
+# usually contain some.
+
+blocked_measures = ['semantic', 'orthographic', 'conc', 'g2p', 'imag', 'morph', 'nounverb', 'wordlength']
+
+# Ratings tables of the ratings-based measures: (accessor, value columns, metric)
+_blocked_ratings = {'conc': (get_conc_ratings, ['RATING'], 'cityblock'),
+                    'g2p': (get_g2p_values, ['O', 'N', 'C'], 'euclidean'),
+                    'imag': (get_imag_ratings, ['RATING'], 'cityblock'),
+                    'morph': (get_morph_counts, ['RATING'], 'cityblock'),
+                    'nounverb': (get_nounverb_categories, ['RATING'], 'cityblock')}
+
+@instrumentation.traced
+def make_blocked_matrix(measure, word_list, out_dir, block_size=2048, top_k=None, dtype=np.float32):
+    """The matrix of a measure for a (large) list of words, computed block by
+    block into out_dir (words in alphabetical order). Returns an RDM backed by the
+    memory-mapped result. With top_k, the top_k nearest words of every word are
+    also saved; read them with blocked_rdm.load_neighbours(out_dir)."""
+
+    if measure not in blocked_measures:
+        raise ValueError('%s matrices cannot be computed in blocks (use one of: %s)'
+                         % (measure, ', '.join(blocked_measures)))
 
-        # Insert the distance value into the corresponding row/column
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[1]]=distance
+    # Ensure word list is sorted alphabetically
+    word_list_sorted = sorted(word_list)
 
-        # Finally, enter zeros along the diagonal
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[0]]=0
+    if measure == 'semantic':
+        # Vectors are gathered (and normalized) one block at a time, from the
+        # memory-mapped model. Words without vectors get NaN vectors.
+        sem_model = get_sem_model()
+        known = np.array([w in sem_model for w in word_list_sorted])
+        indices = np.array([sem_model.get_index(w) if k else 0 for w, k in zip(word_list_sorted, known)])
+        masked = [w for w, k in zip(word_list_sorted, known) if not k]
+
+        def rows(start, stop):
+            vectors = _normalize_rows(np.array(sem_model.vectors[indices[start:stop]], dtype=np.float64))
+            vectors[~known[start:stop]] = np.nan
+            return vectors
+
+        def distances(a, b):
+            return 1 - a @ b.T
+
+    elif measure == 'orthographic':
+        # Sparse features (a fresh feature space, fitted to these words only), and
+        # their row sums, for the correlation (see open_ngrams.py)
+        features = OpenNGramFeatures().transform(word_list_sorted)
+        d, sums, sq_sums = open_ngrams.correlation_stats(features)
+        masked = []
+
+        def rows(start, stop):
+            return features[start:stop], (sums[start:stop], sq_sums[start:stop])
+
+        def distances(a, b):
+            return open_ngrams.correlation_block(a[0], b[0], d, a[1], b[1])
+
+    else:
+        if measure == 'wordlength':
+            values, metric = np.array([[len(w)] for w in word_list_sorted], dtype=float), 'cityblock'
+            masked = []
+        else:
+            accessor, value_cols, metric = _blocked_ratings[measure]
+            index = _get_feature_index(measure, accessor(), value_cols)
+
+            # Words without ratings get NaN features
+            values = index.reindex(word_list_sorted).to_numpy(dtype=float, copy=True)
+            if measure == 'imag':
+                values[np.isin(word_list_sorted, imag_unrated_words)] = np.nan
+            masked = [w for w, v in zip(word_list_sorted, values) if np.isnan(v).any()]
+            values[np.isnan(values).any(axis=1)] = np.nan
+
+        def rows(start, stop):
+            return values[start:stop]
+
+        def distances(a, b):
+            return cdist(a, b, metric)
+
+    blocked_rdm.compute(word_list_sorted, rows, distances, out_dir, block_size=block_size, dtype=dtype,
+                        top_k=top_k, masked=masked, measure=measure)
+    return blocked_rdm.load(out_dir)
 
-    return matrix
 
-# Syntactic category (absolute difference between 0 (noun only) and 1 (noun and verb) )
-def make_nounverb_matrix(word_list):
+############################################################
+# Vocabulary-wide master matrices
+############################################################
 
-    # Define df as nounverb morph (pd dataframe containing binary noun-verb assignments)
-    df = nounverb.copy()
+# Subjects all draw their words from the same stimulus pool, so rather than
+# building every matrix from scratch for each subject and condition, get_matrix()
+# keeps one "master" RDM per measure over every word seen so far (saved in
+# master_dir), and serves each word list by slicing it out of the master. When a
+# word list contains new words, the master is extended first:
+#  - for the expensive measures (articulatory, phonological) only the new pairs
+#    are computed;
+#  - the other measures are cheap, and are simply rebuilt over the new vocabulary.
+# Orthographic distances depend on the whole word list (the correlation runs over
+# the open bigram features that occur in it), so they can't be sliced from a
+# master. They are always built directly, from the cached sparse features.
+#
+# Note that masters are not invalidated when the underlying assets change (e.g.
+# new recordings): delete the master file (or pass rebuild=True) in that case.
 
-    # Ensure word list is sorted alphabetically
-    word_list_sorted = sorted(word_list)
+master_dir = os.path.join(cache_dir, 'master_rdms')
 
-    # Arrange list of words into all possible pairs
-    pairs = list(itertools.permutations(word_list_sorted, 2))
+master_pair_functions = {'articulatory': articulatory_distances,
+                          'phonological': phonological_distances}
 
-    # Define an empty matrix, containing a row/column for ever word
-    matrix=pd.DataFrame(index=word_list_sorted, columns=word_list_sorted)
+vocabulary_dependent_measures = ['orthographic']
 
-    for pair in pairs:
+# Masters loaded (or built) in this session, by measure
+_master_rdms = {}
 
-        # Define each word in the pair
-        w1 = pair[0]
-        w2 = pair[1]
+def master_path(measure):
+    return os.path.join(master_dir, measure + '.npz')
 
-        # Get N morphemes for each word
-        w1_rating = df.loc[df['WORD'] == w1, 'RATING'].iloc[0]
-        w2_rating = df.loc[df['WORD'] == w2, 'RATING'].iloc[0]
+@instrumentation.traced
+def get_master_matrix(measure, word_list, n_jobs=1, rebuild=False):
+    """Master RDM for a measure, covering (at least) every word in word_list.
+    n_jobs is passed on to the phonological measure."""
 
-        # Compute distance as absolute difference in ratings
-        distance = abs(w1_rating - w2_rating)
+    master_fn = master_path(measure)
 
-        # Insert the distance value into the corresponding row/column
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[1]]=distance
+    if rebuild:
+        _master_rdms.pop(measure, None)
+    elif measure not in _master_rdms and os.path.exists(master_fn):
+        _master_rdms[measure] = RDM.load(master_fn)
 
-        # Finally, enter zeros along the diagonal
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[0]]=0
+    master = _master_rdms.get(measure)
+    if master is not None and set(word_list) <= set(master.labels):
+        instrumentation.count('master.hit')
+        return master
+    instrumentation.count('master.extend')
 
-    return matrix
+    # Build (or extend) the master over the union of the old and new words
+    vocabulary = sorted(set(word_list) | set(master.labels if master is not None else []))
 
-# Word length (absolute difference in word length)
-def make_wordlength_matrix(word_list):
+    if measure in master_pair_functions:
+        pair_function = master_pair_functions[measure]
+        if measure == 'phonological':
+            pair_function = partial(pair_function, n_jobs=n_jobs)
+        if master is None:
+            master = RDM([], [])
+        master = master.extend(vocabulary, pair_function)
+    elif measure == 'imag':
+        master = make_imag_matrix(vocabulary, keep_masked=True)
+    else:
+        master = globals()['make_' + measure + '_matrix'](vocabulary)
 
-    # Ensure word list is sorted alphabetically
-    word_list_sorted = sorted(word_list)
+    os.makedirs(master_dir, exist_ok=True)
+    master.save(master_fn)
+    _master_rdms[measure] = master
 
-    # Arrange list of words into all possible pairs
-    pairs = list(itertools.permutations(word_list_sorted, 2))
+    return master
 
-    # Define an empty matrix, containing a row/column for ever word
-    matrix=pd.DataFrame(index=word_list_sorted, columns=word_list_sorted)
+@instrumentation.traced
+def get_matrix(measure, word_list, keep_masked=False, n_jobs=1):
+    """The matrix make_<measure>_matrix(word_list) would give, sliced out of the
+    vocabulary-wide master for the measure (words in alphabetical order). Masked
+    words (e.g. words without imageability ratings) are dropped, unless
+    keep_masked is True."""
 
-    for pair in pairs:
+    if measure in vocabulary_dependent_measures:
+        return globals()['make_' + measure + '_matrix'](word_list)
 
-        # Each pair is a tuple, so let's convert to list
-        pair_list = list(pair)
+    master = get_master_matrix(measure, word_list, n_jobs=n_jobs)
+    matrix = master.subset(sorted(word_list))
 
-        w1 = pair_list[0]
-        w2 = pair_list[1]
+    if keep_masked:
+        return matrix
 
-        # Get similarity for this pair
-        distance = abs(len(w1)-len(w2))  # Note: use feature_edit_distance_div_maxlen() for values normalized for word length
+    return matrix.dropna()
 
-        # Insert the distance value into the corresponding row/column
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[1]]=distance
 
-        # Finally, enter zeros along the diagonal
-        matrix.loc[matrix.index==pair[0], matrix.columns==pair[0]]=0
+############################################################
+# Backwards compatibility
+############################################################
 
-    return matrix
+# The assets used to be module-level variables. They are still available under
+# their old names (e.g. make_rsa_model_functions.sem_model), loaded on first access.
+_lazy_assets = {'mycorpus': get_iphod_corpus,
+                'mycontext': get_iphod_context,
+                'sem_model': get_sem_model,
+                'conc': get_conc_ratings,
+                'gpvs': get_g2p_values,
+                'imag': get_imag_ratings,
+                'morph': get_morph_counts,
+                'nounverb': get_nounverb_categories}
+
+def __getattr__(name):
+    if name in _lazy_assets:
+        return _lazy_assets[name]()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
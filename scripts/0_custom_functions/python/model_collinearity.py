@@ -0,0 +1,188 @@
+############################################################
+# Correlations and collinearity between hypothesis models
+############################################################
+
+# How similar are the hypothesis models (e.g. articulatory vs phonological,
+# semantic vs concreteness), for every subject? Instead of loading the models of
+# one subject at a time and correlating them pair by pair (as
+# x12_visualize_RDMS_and_get_correlations.m does), the models of all subjects
+# are stacked into one (subjects x models x pairs) array of condensed RDMs, and
+# all the model-by-model correlations of all subjects come from a few batched
+# matrix products:
+#
+#   n    = V V'      sx  = X V'      sxx = X^2 V'      sxy = X X'
+#   r    = (n sxy - sx sy) / sqrt((n sxx - sx^2) (n syy - sy^2))
+#
+# where X is the stack with missing values set to 0 and V marks the values that
+# are present, so every correlation only uses the pairs that both models have
+# (e.g. leaving out the words without imageability ratings, as the MATLAB script
+# does). Subjects with fewer words are padded with missing values.
+#
+# Spearman correlations are the Pearson correlations of the ranks, ranked over
+# the pairs that both models have (models with the same missing pairs are ranked
+# together). Variance inflation factors (VIF) of each model, given all the other
+# models, are the diagonal of the inverse of each subject's correlation matrix.
+
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+
+def stack_models(store, condition, measures, subjects=None):
+    """Condensed RDMs of every subject and measure for a condition, from a
+    ModelStore, as a (subjects x measures x pairs) array (NaN where a pair is
+    missing), and the subjects. Within a subject, every measure is put in the
+    word order of the first one, followed by the words that only other measures
+    have (e.g. imag, stored without the words that have no rating, is missing
+    some of the words of the others: its pairs with them are NaN). Subjects
+    without all the measures are left out."""
+    if subjects is None:
+        subjects = sorted(set(key[0] for key in store.keys(condition=condition)))
+    subjects = [s for s in subjects if all((s, condition, m) in store for m in measures)]
+
+    labels = {s: _all_labels(store, s, condition, measures) for s in subjects}
+    n_pairs = max([len(l) * (len(l) - 1) // 2 for l in labels.values()], default=0)
+    stack = np.full((len(subjects), len(measures), n_pairs), np.nan)
+
+    for k, subject in enumerate(subjects):
+        for m, measure in enumerate(measures):
+            if store.entry(subject, condition, measure)['labels'] == labels[subject]:
+                values = store.get_array(subject, condition, measure)
+            else:
+                values = store.get(subject, condition, measure).reindex(labels[subject]).values
+            stack[k, m, :len(values)] = values
+
+    return stack, subjects
+
+
+# Labels of the first measure, followed by those that only other measures have
+def _all_labels(store, subject, condition, measures):
+    labels = list(store.entry(subject, condition, measures[0])['labels'])
+    seen = set(labels)
+    for measure in measures[1:]:
+        for label in store.entry(subject, condition, measure)['labels']:
+            if label not in seen:
+                seen.add(label)
+                labels.append(label)
+    return labels
+
+
+def _pearson(x, valid):
+    """Pairwise-complete Pearson correlations between the rows of every subject:
+    x and valid are (subjects x models x pairs); returns (subjects x models x
+    models) correlations and numbers of pairs."""
+    v = valid.astype(np.float64)
+    x = np.where(valid, x, 0)
+
+    n = v @ v.transpose(0, 2, 1)
+    sx = x @ v.transpose(0, 2, 1)
+    sxx = (x ** 2) @ v.transpose(0, 2, 1)
+    sxy = x @ x.transpose(0, 2, 1)
+    sy, syy = sx.transpose(0, 2, 1), sxx.transpose(0, 2, 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx ** 2) * (n * syy - sy ** 2))
+    return np.clip(r, -1, 1), n.astype(np.int64)
+
+
+def _ranks(x, valid):
+    return np.where(valid, rankdata(np.where(valid, x, np.inf), axis=-1), np.nan)
+
+
+def _spearman(x, valid):
+    """Pairwise-complete Spearman correlations (see _pearson())."""
+    r = np.empty(x.shape[:2] + x.shape[1:2])
+
+    # Models with the same missing pairs in every subject (the usual case) are
+    # ranked all at once
+    if (valid == valid[:, :1]).all():
+        return _pearson(_ranks(x, valid), valid)[0]
+
+    # Otherwise, rank each pair of models over the pairs they both have, for each
+    # group of models that have the same pairs
+    for s in range(x.shape[0]):
+        packed = np.ascontiguousarray(np.packbits(valid[s], axis=1))
+        rows = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+        _, first, group = np.unique(rows, return_index=True, return_inverse=True)
+        masks = valid[s][first]
+        for a in range(len(masks)):
+            for b in range(a, len(masks)):
+                models = np.flatnonzero((group == a) | (group == b))
+                both = masks[a] & masks[b]
+                ranks = rankdata(x[s][np.ix_(models, both)], axis=-1)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    block = np.corrcoef(ranks) if len(models) > 1 else np.ones((1, 1))
+                in_a, in_b = group[models] == a, group[models] == b
+                r[s][np.ix_(models[in_a], models[in_b])] = block[np.ix_(in_a, in_b)]
+                r[s][np.ix_(models[in_b], models[in_a])] = block[np.ix_(in_b, in_a)]
+    return r
+
+
+def correlations(stack, method='pearson'):
+    """Model-by-model correlations of every subject (subjects x models x models)
+    and the number of pairs each one is based on."""
+    valid = np.isfinite(stack)
+    r, n = _pearson(stack, valid)
+    if method == 'spearman':
+        r = _spearman(stack, valid)
+    elif method != 'pearson':
+        raise ValueError("method must be 'pearson' or 'spearman', not %r" % method)
+    return r, n
+
+
+def vifs(r):
+    """Variance inflation factor of every model given all the others, from
+    correlation matrices (subjects x models x models). Models that are a perfect
+    combination of the others get inf."""
+    vif = np.full(r.shape[:2], np.nan)
+    ok = np.isfinite(r).all(axis=(1, 2))
+    if ok.any():
+        m = r[ok]
+        singular = np.linalg.matrix_rank(m) < m.shape[1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inverse = np.linalg.pinv(m)
+        v = np.diagonal(inverse, axis1=1, axis2=2).copy()
+        v[singular] = np.inf
+        vif[ok] = v
+    return vif
+
+
+def report(stack, subjects, measures, condition=None):
+    """Correlations and VIFs of one stack (from stack_models()), as two
+    DataFrames:
+
+    by_subject     one row per subject and pair of models: pearson, spearman
+                   and n_pairs
+    summary        one row per pair of models (model_b = '' for the VIF of
+                   model_a): mean, sd, min and max over subjects"""
+    pearson, n = correlations(stack, 'pearson')
+    spearman, _ = correlations(stack, 'spearman')
+    vif = vifs(pearson)
+
+    i, j = np.triu_indices(len(measures), 1)
+    measures = np.asarray(measures, dtype=object)
+    per_subject = pd.DataFrame({
+        'subject': np.repeat(subjects, len(i)),
+        'model_a': np.tile(measures[i], len(subjects)),
+        'model_b': np.tile(measures[j], len(subjects)),
+        'pearson': pearson[:, i, j].ravel(),
+        'spearman': spearman[:, i, j].ravel(),
+        'n_pairs': n[:, i, j].ravel()})
+    vif_frame = pd.DataFrame({'subject': np.repeat(subjects, len(measures)),
+                              'model_a': np.tile(measures, len(subjects)),
+                              'model_b': '',
+                              'vif': vif.ravel()})
+
+    summary = (pd.concat([per_subject.melt(id_vars=['subject', 'model_a', 'model_b'],
+                                           value_vars=['pearson', 'spearman'], var_name='statistic'),
+                          vif_frame.melt(id_vars=['subject', 'model_a', 'model_b'],
+                                         value_vars=['vif'], var_name='statistic')])
+               .groupby(['statistic', 'model_a', 'model_b'], sort=False)['value']
+               .agg(['mean', 'std', 'min', 'max'])
+               .rename(columns={'std': 'sd'})
+               .reset_index())
+
+    if condition is not None:
+        per_subject.insert(0, 'condition', condition)
+        summary.insert(0, 'condition', condition)
+    return per_subject, summary
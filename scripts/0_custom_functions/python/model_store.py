@@ -0,0 +1,220 @@
+############################################################
+# Binary store for all the hypothesis model RDMs of an experiment
+############################################################
+
+# Rather than one CSV file per subject x condition x measure, all the models of
+# an experiment are kept in one folder:
+#
+#   <store_dir>/index.json      one entry per model: subject, condition, measure,
+#                               word labels, masked labels, and where its values are
+#   <store_dir>/<measure>.bin   the condensed values (float64, pdist order) of every
+#                               model of that measure, one after the other
+#
+# The .bin files are raw arrays, so they can be memory-mapped: reading a model
+# (or all the models of a measure, for a group analysis) only touches the values
+# that are actually used, and nothing is parsed. Values are stored at full
+# precision.
+#
+# New models are appended to the end of their measure's .bin file, and the index
+# is only updated (atomically) once their values are on disk, so an interrupted
+# run never leaves the index pointing at missing data. Replacing a model appends
+# the new values and repoints the index; compact() reclaims the space of values
+# that are no longer used.
+#
+# MATLAB (get_rsa_model.m) still reads CSV files: export_csv() writes these in the
+# same layout as before.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from rdm import RDM
+
+
+class ModelStore:
+    """Hypothesis model RDMs of one experiment, keyed on (subject, condition, measure)."""
+
+    dtype = np.dtype(np.float64)
+
+    def __init__(self, store_dir, experiment='quickread'):
+        self.store_dir = store_dir
+        self.experiment = experiment
+        self._entries = {}
+        self._maps = {}
+
+        index_fn = os.path.join(store_dir, 'index.json')
+        if os.path.exists(index_fn):
+            with open(index_fn) as f:
+                index = json.load(f)
+            self.experiment = index['experiment']
+            for entry in index['models']:
+                self._entries[entry['subject'], entry['condition'], entry['measure']] = entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return tuple(key) in self._entries
+
+    def __repr__(self):
+        return '<ModelStore %r: %d models>' % (self.store_dir, len(self))
+
+    def _bin_path(self, measure):
+        return os.path.join(self.store_dir, measure + '.bin')
+
+    def _write_index(self):
+        index = {'experiment': self.experiment,
+                 'dtype': self.dtype.str,
+                 'models': [self._entries[key] for key in sorted(self._entries)]}
+        index_fn = os.path.join(self.store_dir, 'index.json')
+        tmp_fn = '%s.%d.tmp' % (index_fn, os.getpid())
+        with open(tmp_fn, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_fn, index_fn)
+
+    ############################################################
+    # Writing
+    ############################################################
+
+    def put(self, subject, condition, measure, rdm):
+        """Add (or replace) the model RDM for a subject, condition and measure."""
+        self.put_many([(subject, condition, measure, rdm)])
+
+    def put_many(self, models):
+        """Add (or replace) several (subject, condition, measure, rdm) models, with a
+        single update of the index."""
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        for subject, condition, measure, rdm in models:
+            values = np.ascontiguousarray(rdm.values, dtype=self.dtype)
+
+            bin_fn = self._bin_path(measure)
+            with open(bin_fn, 'ab') as f:
+
+                # An interrupted write can leave a partial value at the end; drop it
+                end = f.seek(0, os.SEEK_END)
+                if end % self.dtype.itemsize:
+                    end = f.truncate(end - end % self.dtype.itemsize)
+
+                offset = end // self.dtype.itemsize
+                f.write(values.tobytes())
+
+            self._entries[subject, condition, measure] = {
+                'subject': subject, 'condition': condition, 'measure': measure,
+                'labels': [str(l) for l in rdm.labels], 'masked': [str(l) for l in rdm.masked],
+                'offset': int(offset), 'length': int(values.shape[0])}
+            self._maps.pop(measure, None)
+
+        self._write_index()
+
+    def compact(self):
+        """Rewrite the .bin files without the values of replaced models."""
+        for measure in sorted(set(key[2] for key in self._entries)):
+            entries = [self._entries[key] for key in sorted(self._entries) if key[2] == measure]
+            values = self.measure_values(measure)
+
+            tmp_fn = '%s.%d.tmp' % (self._bin_path(measure), os.getpid())
+            offset = 0
+            with open(tmp_fn, 'wb') as f:
+                for entry in entries:
+                    f.write(np.ascontiguousarray(values[entry['offset']:entry['offset'] + entry['length']]).tobytes())
+                    entry['offset'] = offset
+                    offset += entry['length']
+
+            # Release the memory map before replacing the file (required on Windows)
+            del values
+            self._maps.pop(measure, None)
+            os.replace(tmp_fn, self._bin_path(measure))
+
+        self._write_index()
+
+    ############################################################
+    # Reading
+    ############################################################
+
+    def keys(self, subject=None, condition=None, measure=None):
+        """(subject, condition, measure) of every stored model, optionally filtered."""
+        return [key for key in sorted(self._entries)
+                if (subject is None or key[0] == subject)
+                and (condition is None or key[1] == condition)
+                and (measure is None or key[2] == measure)]
+
+    def entry(self, subject, condition, measure):
+        try:
+            return self._entries[subject, condition, measure]
+        except KeyError:
+            raise KeyError('No %s model for %s, %s in %s'
+                           % (measure, subject, condition, self.store_dir)) from None
+
+    def measure_values(self, measure):
+        """Memory map (read-only) of the values of every model of a measure."""
+        if measure not in self._maps:
+            if os.path.getsize(self._bin_path(measure)) == 0:
+                # (empty files can't be memory-mapped)
+                self._maps[measure] = np.zeros(0, dtype=self.dtype)
+            else:
+                self._maps[measure] = np.memmap(self._bin_path(measure), dtype=self.dtype, mode='r')
+        return self._maps[measure]
+
+    def get_array(self, subject, condition, measure):
+        """Condensed values of one model (a read-only view into the memory map)."""
+        entry = self.entry(subject, condition, measure)
+        return self.measure_values(measure)[entry['offset']:entry['offset'] + entry['length']]
+
+    def get(self, subject, condition, measure):
+        """One model, as an RDM (backed by the memory map)."""
+        entry = self.entry(subject, condition, measure)
+        return RDM(entry['labels'], self.get_array(subject, condition, measure),
+                   masked=entry['masked'])
+
+    def get_dataframe(self, subject, condition, measure):
+        """One model, as a square DataFrame with word labels."""
+        return self.get(subject, condition, measure).to_dataframe()
+
+    def stack(self, measure, keys=None):
+        """(n_models x n_pairs) array of the condensed values of several models of
+        one measure (by default all of them), and their keys. All the models must
+        have the same number of words."""
+        if keys is None:
+            keys = self.keys(measure=measure)
+        entries = [self.entry(*key) for key in keys]
+
+        lengths = set(entry['length'] for entry in entries)
+        if len(lengths) > 1:
+            raise ValueError('Cannot stack %s models with different numbers of words' % measure)
+
+        values = self.measure_values(measure)
+        offsets = np.array([entry['offset'] for entry in entries], dtype=np.intp)
+        length = lengths.pop() if lengths else 0
+        return values[offsets[:, None] + np.arange(length)], keys
+
+    ############################################################
+    # CSV export (for get_rsa_model.m)
+    ############################################################
+
+    def csv_path(self, assets_dir, subject, condition, measure):
+        """Where the CSV of a model lives: the layout the MATLAB scripts expect."""
+        return os.path.join(assets_dir, subject, 'RSA_models', self.experiment,
+                            self.experiment + '_' + subject + '_' + condition + '_' + measure + '.csv')
+
+    def export_csv(self, assets_dir, keys=None):
+        """Write the square matrix of every model (or of the given keys) to CSV,
+        exactly as DataFrame.to_csv() did. Returns the file names."""
+        if keys is None:
+            keys = self.keys()
+
+        filenames = []
+        for key in keys:
+            filename = self.csv_path(assets_dir, *key)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            self.get(*key).to_csv(filename)
+            filenames.append(filename)
+        return filenames
+
+    def to_frame(self):
+        """Summary of the stored models (one row per model)."""
+        return pd.DataFrame([{'subject': e['subject'], 'condition': e['condition'],
+                              'measure': e['measure'], 'n_words': len(e['labels']),
+                              'n_masked': len(e['masked'])}
+                             for e in (self._entries[key] for key in sorted(self._entries))])
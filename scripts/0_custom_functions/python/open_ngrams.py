@@ -0,0 +1,120 @@
+############################################################
+# Open n-gram features, for the orthographic measure
+############################################################
+
+# A word is represented by how often each "open n-gram" (n letters of the word,
+# in order but not necessarily adjacent) occurs in it, e.g. for n = 2, "salt" is
+# {sa, sl, st, al, at, lt}. With a window, only n-grams whose letters all fall
+# within window + 1 consecutive letters are counted. These are the features of
+# wordkit's OpenNGramTransformer(n) and ConstrainedOpenNGramTransformer(n, window)
+# (without padding), which this module replaces.
+#
+# The feature space is fitted once, on every word seen so far, and each word's
+# features are kept as one row of a sparse matrix. A matrix for any word list is
+# then a sparse slice of those rows.
+#
+# wordkit fits its feature space to the word list itself, and that matters for
+# the correlation distance: every feature of the fitted space counts as an
+# observation, including those that are 0 for both words. The correlation is
+# therefore computed from sparse sums over the rows, with the number of
+# features (d) set to the number of features that occur in the word list:
+#
+#   r = (d*Sxy - Sx*Sy) / sqrt((d*Sxx - Sx^2) * (d*Syy - Sy^2))
+#
+# which gives the same values as pdist(wordkit_features, 'correlation').
+
+from itertools import combinations
+import numpy as np
+from scipy import sparse
+
+
+def open_ngrams(word, n=2, window=None):
+    """All open n-grams of a word (with repeats), as tuples of letters."""
+    if window is None:
+        return list(combinations(word, n))
+
+    grams = []
+    for idx in range(len(word)):
+        subword = word[idx:idx + window + 1]
+        grams.extend((subword[0],) + rest for rest in combinations(subword[1:], n - 1))
+    return grams
+
+
+class OpenNGramFeatures:
+    """Open n-gram counts for a growing vocabulary, as sparse rows."""
+
+    def __init__(self, n=2, window=None):
+        if window is not None and window < n:
+            raise ValueError('window (%d) must be at least n (%d)' % (window, n))
+        self.n = n
+        self.window = window
+        self.features = {}
+        self._rows = {}
+
+    def fit(self, words):
+        """Add the n-grams of any new words to the feature space."""
+        for word in words:
+            if word in self._rows:
+                continue
+            grams = open_ngrams(word, self.n, self.window)
+            if not grams:
+                raise ValueError("'%s' did not contain any ngrams." % word)
+
+            counts = {}
+            for gram in grams:
+                idx = self.features.setdefault(gram, len(self.features))
+                counts[idx] = counts.get(idx, 0) + 1
+            self._rows[word] = counts
+        return self
+
+    def transform(self, words):
+        """Sparse (n_words x n_features) CSR matrix of n-gram counts (fitting any
+        new words first)."""
+        self.fit(words)
+
+        indptr = [0]
+        indices = []
+        data = []
+        for word in words:
+            counts = self._rows[word]
+            indices.extend(counts.keys())
+            data.extend(counts.values())
+            indptr.append(len(indices))
+
+        return sparse.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.intp),
+                                  np.array(indptr, dtype=np.intp)), shape=(len(words), len(self.features)))
+
+
+def correlation_stats(features):
+    """Per-row sums (Sx) and sums of squares (Sxx) of a sparse feature matrix, and
+    the number of features (d) that occur in at least one of its rows."""
+    features = sparse.csr_matrix(features, dtype=np.float64)
+    d = float(len(np.unique(features.indices[features.data != 0])))
+    sums = np.asarray(features.sum(axis=1)).ravel()
+    sq_sums = np.asarray(features.multiply(features).sum(axis=1)).ravel()
+    return d, sums, sq_sums
+
+
+def correlation_block(features_a, features_b, d, stats_a, stats_b):
+    """(len(a) x len(b)) correlation distances between the rows of two sparse
+    feature matrices, given d and the (sums, sq_sums) of each (see
+    correlation_stats())."""
+    (sums_a, sq_a), (sums_b, sq_b) = stats_a, stats_b
+    products = (features_a @ features_b.T).toarray()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = ((d * products - sums_a[:, None] * sums_b[None, :])
+             / np.sqrt((d * sq_a - sums_a**2)[:, None] * (d * sq_b - sums_b**2)[None, :]))
+
+    return 1 - r
+
+
+def correlation_distances(features):
+    """Correlation distance between every pair of rows of a sparse feature matrix,
+    over the features that occur in at least one row. Returns a condensed
+    (pdist-ordered) vector."""
+    features = sparse.csr_matrix(features, dtype=np.float64)
+    d, sums, sq_sums = correlation_stats(features)
+
+    distances = correlation_block(features, features, d, (sums, sq_sums), (sums, sq_sums))
+    return distances[np.triu_indices(features.shape[0], 1)]
@@ -0,0 +1,271 @@
+############################################################
+# Compact container for representational dissimilarity matrices (RDMs)
+############################################################
+
+# An RDM is symmetric with zeros on the diagonal, so the only information we
+# actually need to keep is the upper triangle. This module stores that triangle
+# as a flat ("condensed") vector, in exactly the same order as scipy's pdist()
+# and MATLAB's squareform(..., 'tovector'): (0,1), (0,2), ... (0,n-1), (1,2), ...
+# Word labels are kept alongside, so the full (square) matrix can be rebuilt on
+# demand for the notebook / MATLAB consumers via to_dataframe() and to_csv().
+
+import os
+import numpy as np
+import pandas as pd
+
+
+# Position of the pair (i, j) in a condensed vector of n labels. Works for
+# scalars and for numpy arrays of indices. i and j must differ.
+def condensed_index(n, i, j):
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return i * (2 * n - i - 1) // 2 + (j - i - 1)
+
+
+class RDM:
+    """Labelled dissimilarity matrix, stored as a condensed upper triangle.
+
+    labels : row/column labels (usually words), in matrix order
+    values : the n*(n-1)/2 off-diagonal dissimilarities, in pdist order
+    masked : labels that have no valid data (e.g. words without ratings). All
+             cells in the row/column of a masked label are NaN, including its
+             diagonal cell.
+    check_masked : set the cells of the masked labels to NaN if they aren't.
+             Values that are known to be NaN there (e.g. written by
+             blocked_rdm.compute()) can skip the check, which reads all of
+             those cells.
+    """
+
+    def __init__(self, labels, values, masked=(), dtype=np.float64, check_masked=True):
+
+        self.labels = list(labels)
+        n = len(self.labels)
+
+        self.values = np.ascontiguousarray(values, dtype=dtype).reshape(-1)
+        if self.values.shape[0] != n * (n - 1) // 2:
+            raise ValueError('Expected %d condensed values for %d labels, got %d'
+                             % (n * (n - 1) // 2, n, self.values.shape[0]))
+
+        self._index = {label: i for i, label in enumerate(self.labels)}
+        if len(self._index) != n:
+            raise ValueError('RDM labels must be unique')
+
+        masked = set(masked)
+        self.masked = tuple(label for label in self.labels if label in masked)
+
+        # Make sure the masked rows/columns really are NaN (only writing if they
+        # aren't, so that read-only, memory-mapped values can be used as they are)
+        if self.masked and check_masked:
+            pos = self._pair_positions(self._positions(self.masked))
+            if not np.isnan(self.values[pos]).all():
+                self.values[pos] = np.nan
+
+    ############################################################
+    # Constructors
+    ############################################################
+
+    @classmethod
+    def from_square(cls, matrix, labels=None, dtype=np.float64):
+        """Build an RDM from a square matrix (numpy array or pandas DataFrame).
+        Only the upper triangle is read."""
+
+        if isinstance(matrix, pd.DataFrame):
+            if labels is None:
+                labels = list(matrix.index)
+            matrix = matrix.to_numpy(dtype=float)
+
+        matrix = np.asarray(matrix, dtype=float)
+        n = matrix.shape[0]
+        if matrix.shape != (n, n):
+            raise ValueError('Expected a square matrix, got shape %s' % (matrix.shape,))
+        if labels is None:
+            labels = list(range(n))
+
+        values = matrix[np.triu_indices(n, 1)]
+
+        # Rows whose diagonal is NaN were masked when the matrix was written
+        masked = [labels[i] for i in np.flatnonzero(np.isnan(np.diag(matrix)))]
+
+        return cls(labels, values, masked=masked, dtype=dtype)
+
+    @classmethod
+    def read_csv(cls, filename, dtype=np.float64, **kwargs):
+        """Read an RDM written by to_csv() (or by DataFrame.to_csv())."""
+        return cls.from_square(pd.read_csv(filename, index_col=0, **kwargs), dtype=dtype)
+
+    ############################################################
+    # Accessors
+    ############################################################
+
+    @property
+    def n(self):
+        return len(self.labels)
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return '<RDM: %d labels, %s, %d masked>' % (self.n, self.values.dtype, len(self.masked))
+
+    def index(self, label):
+        """Row/column number of a label."""
+        try:
+            return self._index[label]
+        except KeyError:
+            raise KeyError('%r is not a label of this RDM' % (label,)) from None
+
+    def _positions(self, labels):
+        return np.array([self.index(label) for label in labels], dtype=np.intp)
+
+    # Condensed positions of every off-diagonal cell in the given rows
+    def _pair_positions(self, rows):
+        others = np.arange(self.n)
+        pos = [condensed_index(self.n, r, others[others != r]) for r in rows]
+        return np.concatenate(pos) if pos else np.array([], dtype=np.intp)
+
+    def __getitem__(self, pair):
+        """rdm[a, b] is the dissimilarity between labels a and b (in either order)."""
+        a, b = pair
+        i, j = self.index(a), self.index(b)
+        if i == j:
+            return np.nan if a in self.masked else 0.0
+        return self.values[condensed_index(self.n, i, j)]
+
+    def row(self, label):
+        """Dissimilarities between one label and every label (in label order)."""
+        i = self.index(label)
+        others = np.arange(self.n)
+        row = np.zeros(self.n, dtype=self.values.dtype)
+        row[others != i] = self.values[condensed_index(self.n, i, others[others != i])]
+        if label in self.masked:
+            row[i] = np.nan
+        return row
+
+    def to_square(self):
+        """Full (n x n) symmetric matrix."""
+        matrix = np.zeros((self.n, self.n), dtype=self.values.dtype)
+        iu = np.triu_indices(self.n, 1)
+        matrix[iu] = self.values
+        matrix.T[iu] = self.values
+        if self.masked:
+            masked = self._positions(self.masked)
+            matrix[masked, masked] = np.nan
+        return matrix
+
+    ############################################################
+    # Slicing
+    ############################################################
+
+    def subset(self, labels):
+        """New RDM containing only the given labels, in the given order."""
+        rows = self._positions(labels)
+        ii, jj = np.triu_indices(len(rows), 1)
+        values = self.values[condensed_index(self.n, rows[ii], rows[jj])]
+        return RDM(labels, values, masked=[l for l in labels if l in self.masked],
+                   dtype=self.values.dtype)
+
+    def mask(self, labels):
+        """New RDM in which the given labels are masked (set to NaN)."""
+        return RDM(self.labels, self.values.copy(), masked=set(self.masked) | set(labels),
+                   dtype=self.values.dtype)
+
+    def drop(self, labels):
+        """New RDM without the given labels."""
+        labels = set(labels)
+        return self.subset([l for l in self.labels if l not in labels])
+
+    def dropna(self):
+        """New RDM without its masked labels."""
+        return self.drop(self.masked)
+
+    def reindex(self, labels):
+        """New RDM over the given labels, in the given order. Labels this RDM
+        doesn't have are masked (their pairs are NaN)."""
+        labels = list(labels)
+        n = len(labels)
+        present = [(i, self._index[l]) for i, l in enumerate(labels) if l in self._index]
+        new_rows = np.array([i for i, _ in present], dtype=np.intp)
+        rows = np.array([r for _, r in present], dtype=np.intp)
+
+        values = np.full(n * (n - 1) // 2, np.nan, dtype=self.values.dtype)
+        ii, jj = np.triu_indices(len(rows), 1)
+        values[condensed_index(n, new_rows[ii], new_rows[jj])] = \
+            self.values[condensed_index(self.n, rows[ii], rows[jj])]
+        return RDM(labels, values, masked=[l for l in labels if l in self.masked or l not in self._index],
+                   dtype=self.values.dtype)
+
+    def new_pairs(self, labels):
+        """The (a, b) label pairs that extend(labels, ...) needs to compute, in
+        condensed order."""
+        labels, _, ii, jj = self._extension(labels)
+        return [(labels[i], labels[j]) for i, j in zip(ii, jj)]
+
+    def extend(self, labels, pair_distances):
+        """New RDM over labels (which must include all of this RDM's labels, in
+        any order). Pairs this RDM already has are copied; the rest are computed
+        with pair_distances(list of (a, b) label pairs) -> array of distances."""
+        labels, values, ii, jj = self._extension(labels)
+
+        # Compute the pairs that involve at least one new label
+        if len(ii):
+            pairs = [(labels[i], labels[j]) for i, j in zip(ii, jj)]
+            values[condensed_index(len(labels), ii, jj)] = pair_distances(pairs)
+
+        return RDM(labels, values, masked=self.masked, dtype=self.values.dtype)
+
+    # Condensed values over labels, with this RDM's pairs filled in (and NaN
+    # elsewhere), and the rows/columns (ii, jj) of the pairs still to compute
+    def _extension(self, labels):
+        labels = list(labels)
+        n = len(labels)
+        label_set = set(labels)
+        missing = [l for l in self.labels if l not in label_set]
+        if missing:
+            raise ValueError('extend() cannot drop labels: %s' % ', '.join(map(str, missing)))
+
+        values = np.full(n * (n - 1) // 2, np.nan, dtype=self.values.dtype)
+
+        # Copy the known pairs
+        position = {label: i for i, label in enumerate(labels)}
+        rows = np.array([position[l] for l in self.labels], dtype=np.intp)
+        ii, jj = np.triu_indices(self.n, 1)
+        values[condensed_index(n, rows[ii], rows[jj])] = self.values
+
+        # Pairs that involve at least one new label (in condensed order)
+        new = np.ones(n, dtype=bool)
+        new[rows] = False
+        ii, jj = np.triu_indices(n, 1)
+        todo = new[ii] | new[jj]
+
+        return labels, values, ii[todo], jj[todo]
+
+    ############################################################
+    # Adapters for the existing (DataFrame / csv) consumers
+    ############################################################
+
+    def to_dataframe(self):
+        return pd.DataFrame(data=self.to_square(), index=self.labels, columns=self.labels)
+
+    def to_csv(self, filename, **kwargs):
+        """Write the full square matrix, with word labels, exactly as
+        DataFrame.to_csv() does (this is the format read by get_rsa_model.m)."""
+        self.to_dataframe().to_csv(filename, **kwargs)
+
+    ############################################################
+    # Compact binary format
+    ############################################################
+
+    def save(self, filename):
+        """Write the labels and condensed values to a .npz file. The file is
+        written under a temporary name first, so it is never left half-written."""
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, labels=np.array(self.labels, dtype=str), values=self.values,
+                     masked=np.array(self.masked, dtype=str))
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Read an RDM written by save()."""
+        with np.load(filename) as data:
+            return cls(data['labels'].tolist(), data['values'], masked=data['masked'].tolist(),
+                       dtype=data['values'].dtype)
@@ -0,0 +1,204 @@
+############################################################
+# Permutation tests and noise ceilings for RDM correlations
+############################################################
+
+# Significance of the correlation between RDMs (hypothesis models with each
+# other, or ROI neural RDMs with the models) by permuting the labels (words) of
+# the target RDMs, as in a Mantel test.
+#
+# A permutation of the labels moves every pair (i, j) of a condensed RDM to
+# (p[i], p[j]), so a permuted condensed RDM is just values[index], with index
+# computed for a whole batch of permutations at once (a (permutations x pairs)
+# array). Correlations are invariant to the order of the pairs, so the targets
+# and models are z-scored (or, for Spearman, ranked then z-scored) once, and the
+# correlations of a chunk of permutations with all the models are a single
+# batched matrix product. Chunks are sized to keep the permuted targets within
+# max_memory_mb, and can be spread over a process pool.
+#
+# Permutation k is drawn from its own random generator, seeded with
+# SeedSequence(seed, spawn_key=(k,)) (i.e. the k-th child of SeedSequence(seed)),
+# so the permutations, and therefore the results, are the same whatever the
+# chunk size or number of workers. (Null correlations within floating-point
+# rounding of the observed one count as ties, so that the p-values don't
+# depend on how the matrix products happen to be blocked either.)
+#
+# The noise ceiling (Nili et al., 2014) of a set of subjects' RDMs is the mean
+# correlation of each subject's RDM with the mean RDM of all subjects (upper
+# bound) and of the other subjects (lower bound).
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.stats import rankdata
+
+import instrumentation
+from rdm import condensed_index
+
+
+# Null correlations at most this far below the observed one count as ties
+TIE_TOLERANCE = 1e-12
+
+
+def _standardize(values, method):
+    """z-score the rows of values (n x pairs), after ranking them for Spearman."""
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    if not np.isfinite(values).all():
+        raise ValueError('RDMs must not have missing values (drop the masked labels first)')
+    if method == 'spearman':
+        values = rankdata(values, axis=1)
+    elif method != 'pearson':
+        raise ValueError("method must be 'pearson' or 'spearman', not %r" % method)
+    values = values - values.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values / values.std(axis=1, ddof=1, keepdims=True)
+
+
+def aligned(rdms):
+    """Condensed values (rdms x pairs) of RDMs over the labels that none of them
+    masks, in the label order of the first one, and those labels."""
+    keep = set(rdms[0].labels).intersection(*(rdm.labels for rdm in rdms[1:]))
+    keep = keep.difference(*(rdm.masked for rdm in rdms))
+    labels = [l for l in rdms[0].labels if l in keep]
+    values = np.vstack([rdm.subset(labels).values for rdm in rdms])
+    return values, labels
+
+
+def n_labels(n_pairs):
+    """Number of labels of a condensed RDM of n_pairs values."""
+    n = int(round((1 + np.sqrt(1 + 8 * n_pairs)) / 2))
+    if n * (n - 1) // 2 != n_pairs:
+        raise ValueError('%d is not the length of a condensed RDM' % n_pairs)
+    return n
+
+
+def permutations(n, seed, start, stop):
+    """Permutations start:stop of n labels (a (stop - start) x n array).
+    Permutation k only depends on seed and k."""
+    return np.array([np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(k,))).permutation(n)
+                     for k in range(start, stop)], dtype=np.intp).reshape(-1, n)
+
+
+def permutation_index(perms):
+    """Condensed index arrays of a batch of permutations (permutations x n):
+    values[index[k]] is the condensed RDM with its labels permuted by perms[k]."""
+    n = perms.shape[1]
+    i, j = np.triu_indices(n, 1)
+
+    # Condensed position of every cell of the square matrix (the diagonal is
+    # never looked up), so each permuted pair is one lookup
+    table = condensed_index(n, *np.indices((n, n))).astype(np.int32).ravel()
+    cells = perms[:, i] * n
+    cells += perms[:, j]
+    return table[cells]
+
+
+def permuted_correlations(targets, models, index):
+    """Correlations (permutations x targets x models) of the targets, permuted by
+    each row of index, with the models; targets and models are standardized
+    (see _standardize())."""
+    n_pairs = targets.shape[1]
+    permuted = np.take(targets, index, axis=1)
+    return np.matmul(permuted, models.T).transpose(1, 0, 2) / (n_pairs - 1)
+
+
+# Pool workers (these must be top-level functions so that they can be pickled).
+# The RDMs are sent once per worker process, not once per chunk.
+_worker_args = None
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+def _chunk_worker(start, stop):
+    targets, models, seed = _worker_args
+    result = _chunk(targets, models, seed, start, stop)
+    instrumentation.flush()
+    return start, stop, result
+
+def _chunk(targets, models, seed, start, stop):
+    with instrumentation.phase('permutation.chunk', permutations=stop - start):
+        index = permutation_index(permutations(n_labels(targets.shape[1]), seed, start, stop))
+        return permuted_correlations(targets, models, index)
+
+
+@instrumentation.traced
+def permutation_test(targets, models, n_permutations=10000, seed=0, method='pearson', tail='right',
+                     max_memory_mb=256, n_jobs=1, keep_null=False):
+    """Permutation test of the correlation between every target RDM and every
+    model RDM (condensed, all over the same labels, without missing values).
+    The labels of the targets are permuted, the same way for all of them.
+
+    Returns a dict with:
+      r      observed correlations (targets x models)
+      p      p-values (targets x models): the proportion of permutations (counting
+             the observed labelling) with a correlation at least as large (tail
+             'right'), or as large in absolute value (tail 'both'); NaN where r
+             is NaN (a constant target or model)
+      null   with keep_null, the permuted correlations (permutations x targets x
+             models)"""
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    if tail not in ('right', 'both'):
+        raise ValueError("tail must be 'right' or 'both', not %r" % tail)
+
+    targets = _standardize(targets, method)
+    models = _standardize(models, method)
+    if targets.shape[1] != models.shape[1]:
+        raise ValueError('targets and models must have the same number of pairs')
+
+    n_pairs = targets.shape[1]
+    observed = targets @ models.T / (n_pairs - 1)
+
+    # Permuted targets (and index) of one chunk must fit in max_memory_mb
+    chunk_size = max(1, int(max_memory_mb * 2 ** 20 // (n_pairs * (8 * len(targets) + 16))))
+    chunks = [(start, min(start + chunk_size, n_permutations)) for start in range(0, n_permutations, chunk_size)]
+
+    compare = np.abs if tail == 'both' else (lambda x: x)
+    threshold = compare(observed) - TIE_TOLERANCE
+    exceed = np.zeros(observed.shape, dtype=np.int64)
+    null = np.empty((n_permutations,) + observed.shape) if keep_null else None
+
+    def collect(start, stop, result):
+        exceed[...] += (compare(result) >= threshold).sum(axis=0)
+        if keep_null:
+            null[start:stop] = result
+
+    if n_jobs == 1 or len(chunks) <= 1:
+        for start, stop in chunks:
+            collect(start, stop, _chunk(targets, models, seed, start, stop))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(targets, models, seed)) as pool:
+            for start, stop, result in pool.map(_chunk_worker, *zip(*chunks)):
+                collect(start, stop, result)
+
+    # A constant target or model has no correlation (r is NaN), and no p-value
+    p = (exceed + 1) / (n_permutations + 1)
+    p[~np.isfinite(observed)] = np.nan
+
+    result = {'r': observed, 'p': p}
+    if keep_null:
+        result['null'] = null
+    return result
+
+
+def noise_ceiling(rdms, method='pearson'):
+    """Lower and upper bounds of the noise ceiling of a group of RDMs (subjects x
+    pairs, all over the same labels): the mean correlation of each subject's RDM
+    with the mean of the other subjects' RDMs (lower) and of all of them (upper).
+    For Spearman, the RDMs are ranked before they are averaged."""
+    rdms = np.asarray(rdms, dtype=np.float64)
+    if len(rdms) < 2:
+        raise ValueError('The noise ceiling needs at least 2 subjects')
+    if method == 'spearman':
+        rdms = rankdata(rdms, axis=1)
+
+    total = rdms.sum(axis=0)
+    others = _standardize(total - rdms, method)
+    everyone = _standardize(total, method)[0]
+    rdms = _standardize(rdms, 'pearson')
+    n_pairs = rdms.shape[1]
+
+    lower = (rdms * others).sum(axis=1) / (n_pairs - 1)
+    upper = rdms @ everyone / (n_pairs - 1)
+    return lower.mean(), upper.mean()
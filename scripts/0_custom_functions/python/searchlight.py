@@ -0,0 +1,259 @@
+############################################################
+# Searchlight RSA
+############################################################
+
+# Python version of the searchlight in x2_run_glm_searchlights.m, i.e.
+# cosmo_searchlight() with cosmo_spherical_neighborhood() and
+# cosmo_target_dsm_corr_measure(), for the hypothesis models built by
+# make_rsa_model_functions.py.
+#
+# For every searchlight centre (every voxel of the dataset), the neural RDM is
+# the correlation distance between the patterns of the words over the voxels of
+# the sphere (optionally after subtracting each voxel's mean over the words,
+# center_data). It is then compared with all the model RDMs at once:
+#
+#   'glm'          the betas of a regression of the neural RDM on the model
+#                  RDMs, all z-scored (cosmo_target_dsm_corr_measure's glm_dsm)
+#   'correlation'  the Pearson correlation with each model RDM
+#
+# Both are linear in the z-scored neural RDM, so for a block of centres they are
+# a single matrix product with a (pairs x models) weight matrix that is computed
+# once per condition.
+#
+# Spheres are stored once per voxel mask as a Neighbourhood: the voxels of every
+# sphere as CSR arrays (indptr, indices). Centres are processed in blocks; the
+# spheres of a block are padded to the same size (with a voxel that is always 0,
+# which changes no means, norms or dot products), so that all their neural RDMs
+# come from one batched matrix product. Blocks can be spread over a process pool,
+# and every result is written back to its own position, so the output does not
+# depend on the number of workers or the block size.
+#
+# Usage:
+#
+#   nbrhood = searchlight.spherical_neighbourhood(ijk, radius=3)
+#   weights = searchlight.model_weights([m.values for m in models])
+#   results = searchlight.run(samples, nbrhood, weights, n_jobs=8)   # models x voxels
+#   searchlight.write_map(results[0], ijk, shape, affine, fn)
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import instrumentation
+
+
+############################################################
+# Neighbourhoods
+############################################################
+
+def sphere_offsets(radius):
+    """(i, j, k) offsets of the voxels within radius (in voxels) of a centre,
+    nearest first (as cosmo_sphere_offsets())."""
+    r = int(np.floor(radius))
+    grid = np.arange(-r, r + 1)
+    offsets = np.stack(np.meshgrid(grid, grid, grid, indexing='ij'), axis=-1).reshape(-1, 3)
+    distances = np.sqrt((offsets ** 2).sum(axis=1))
+    keep = distances <= radius
+    order = np.argsort(distances[keep], kind='stable')
+    return offsets[keep][order]
+
+
+class Neighbourhood:
+    """Searchlight spheres: the voxels (feature indices) of the sphere around
+    every centre, as CSR arrays. Sphere c is indices[indptr[c]:indptr[c + 1]]."""
+
+    def __init__(self, indptr, indices, n_features):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.n_features = n_features
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __repr__(self):
+        sizes = self.sizes()
+        return '<Neighbourhood: %d centres, %d-%d voxels per sphere>' % (len(self), sizes.min(), sizes.max())
+
+    def sizes(self):
+        return np.diff(self.indptr)
+
+    def padded(self, start, stop):
+        """Spheres of centres start:stop as a (centres x max size) array,
+        padded with n_features (an index past the last feature)."""
+        sizes = self.sizes()[start:stop]
+        table = np.full((stop - start, sizes.max() if len(sizes) else 0), self.n_features, dtype=np.int64)
+        columns = np.arange(table.shape[1])
+        valid = columns < sizes[:, None]
+        table[valid] = self.indices[self.indptr[start]:self.indptr[stop]]
+        return table
+
+
+@instrumentation.traced
+def spherical_neighbourhood(ijk, radius=3):
+    """Spheres of the given radius (in voxels) around every feature, over the
+    features at voxel positions ijk (n_features x 3), as for
+    cosmo_spherical_neighborhood(ds, 'radius', radius)."""
+    ijk = np.asarray(ijk, dtype=np.int64)
+    n = len(ijk)
+    offsets = sphere_offsets(radius)
+
+    # Feature index of every voxel (-1 outside the dataset), with a border of
+    # radius around it so that no offset falls off the volume
+    r = int(np.floor(radius))
+    lower = ijk.min(axis=0) - r
+    shape = ijk.max(axis=0) - lower + r + 1
+    volume = np.full(shape, -1, dtype=np.int64)
+    volume[tuple((ijk - lower).T)] = np.arange(n)
+
+    # One vectorized lookup per offset, for all centres at once
+    table = np.empty((n, len(offsets)), dtype=np.int64)
+    for k, offset in enumerate(offsets):
+        table[:, k] = volume[tuple((ijk - lower + offset).T)]
+
+    valid = table >= 0
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(valid.sum(axis=1), out=indptr[1:])
+    return Neighbourhood(indptr, table[valid], n)
+
+
+############################################################
+# Model weights
+############################################################
+
+def _zscore(x, axis=-1):
+    x = x - x.mean(axis=axis, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return x / x.std(axis=axis, ddof=1, keepdims=True)
+
+
+def model_weights(models, measure='glm'):
+    """(n_pairs x n_models) weights that turn a z-scored neural RDM (condensed)
+    into the searchlight measure, for the condensed model RDMs in models (all in
+    the word order of the data). Returns (weights, pairs): pairs selects the word
+    pairs that have a value in every model (words without data, e.g. unrated
+    words, are left out of every comparison)."""
+    models = np.vstack([np.asarray(m, dtype=np.float64) for m in models])
+    pairs = np.isfinite(models).all(axis=0)
+    models = _zscore(models[:, pairs])
+
+    if measure == 'glm':
+        # Least-squares betas of the z-scored neural RDM on the z-scored models
+        weights = np.linalg.pinv(models.T)
+    elif measure == 'correlation':
+        # Pearson correlation between z-scored vectors
+        weights = models / (models.shape[1] - 1)
+    else:
+        raise ValueError("measure must be 'glm' or 'correlation', not %r" % measure)
+
+    return np.ascontiguousarray(weights.T), pairs
+
+
+############################################################
+# Searchlight
+############################################################
+
+def neural_rdms(samples_t, spheres, center_data=True):
+    """Correlation-distance RDMs (condensed) of the words, over the voxels of
+    each sphere. samples_t is (n_features + 1) x n_words (features x words, with
+    an extra all-zero feature for padding), and spheres is a padded table of
+    feature indices (from Neighbourhood.padded()). Returns an n_spheres x n_pairs
+    array."""
+    n_words = samples_t.shape[1]
+    padding = samples_t.shape[0] - 1
+    valid = (spheres != padding)[:, :, None]
+    n_voxels = valid.sum(axis=1, keepdims=True)
+
+    # spheres x voxels x words
+    x = samples_t[spheres]
+
+    # Subtract each voxel's mean over the words (padding stays 0)
+    if center_data:
+        x -= x.mean(axis=2, keepdims=True)
+
+    # Correlation distance between words: centre and normalize each word's
+    # pattern over the voxels of the sphere
+    x -= x.sum(axis=1, keepdims=True) / n_voxels
+    x *= valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x /= np.sqrt((x ** 2).sum(axis=1, keepdims=True))
+
+    r = np.matmul(x.transpose(0, 2, 1), x)
+    i, j = np.triu_indices(n_words, 1)
+    return 1 - r[:, i, j]
+
+
+def searchlight_block(samples_t, nbrhood, weights, pairs, start, stop, center_data=True):
+    """Searchlight measure (n_models x centres) for centres start:stop."""
+    with instrumentation.phase('searchlight.neural_rdms', centres=stop - start):
+        rdms = neural_rdms(samples_t, nbrhood.padded(start, stop), center_data=center_data)
+    with instrumentation.phase('searchlight.models', centres=stop - start):
+        return (_zscore(rdms[:, pairs]) @ weights).T
+
+
+# Pool workers (these must be top-level functions so that they can be pickled).
+# The data are sent once per worker process, not once per block.
+_worker_args = None
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+def _block_worker(start, stop):
+    samples_t, nbrhood, weights, pairs, center_data = _worker_args
+    result = searchlight_block(samples_t, nbrhood, weights, pairs, start, stop, center_data=center_data)
+    instrumentation.flush()
+    return start, stop, result
+
+
+def _padded_samples(samples):
+    # (float64, whatever the dtype of samples, e.g. a float32 memory map)
+    samples_t = np.zeros((samples.shape[1] + 1, samples.shape[0]))
+    samples_t[:-1] = samples.T
+    return samples_t
+
+
+@instrumentation.traced
+def run(samples, nbrhood, weights, center_data=True, block_size=256, n_jobs=1):
+    """Searchlight over every centre of nbrhood, for samples (n_words x
+    n_features, in the word order of the models) and weights from
+    model_weights(). Returns an n_models x n_centres array.
+
+    Centres are processed block_size at a time; with n_jobs > 1 (or None, for
+    all cores) the blocks are spread over a process pool."""
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    weights, pairs = weights
+    samples_t = _padded_samples(samples)
+    n = len(nbrhood)
+    results = np.full((weights.shape[1], n), np.nan)
+    blocks = [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+    if n_jobs == 1 or len(blocks) <= 1:
+        for start, stop in blocks:
+            results[:, start:stop] = searchlight_block(samples_t, nbrhood, weights, pairs, start, stop,
+                                                       center_data=center_data)
+        return results
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                             initargs=(samples_t, nbrhood, weights, pairs, center_data)) as pool:
+        for start, stop, result in pool.map(_block_worker, *zip(*blocks)):
+            results[:, start:stop] = result
+
+    return results
+
+
+############################################################
+# Maps
+############################################################
+
+def write_map(values, ijk, shape, affine, filename, header=None):
+    """Write values (one per feature) to a NIfTI volume of the given shape, at
+    voxel positions ijk, with 0 everywhere else (as cosmo_map2fmri())."""
+    import nibabel as nib
+
+    volume = np.zeros(tuple(shape)[:3], dtype=np.float32)
+    volume[tuple(np.asarray(ijk).T)] = values
+    img = nib.Nifti1Image(volume, affine, header=header)
+    img.set_data_dtype(np.float32)
+    nib.save(img, filename)
@@ -0,0 +1,183 @@
+############################################################
+# Word silhouettes for the visual measure
+############################################################
+
+# The visual measure is the correlation distance between binary "silhouettes" of
+# the words, as they appeared on screen: each word drawn in white (Arial, letter
+# height 10% of the screen) in the centre of a grey (128) 1920 x 1080 screen, with
+# 1 for every pixel the text touched and 0 for the background.
+#
+# Rather than keeping a full-screen vector of Python ints for every word, each
+# word is rendered once (in greyscale, mode "L"), cropped to the pixels its text
+# touched, and kept as a small boolean array plus its position on the screen.
+# Rendered words are kept in a GlyphCache (in memory, and optionally on disk), so
+# they are shared between subjects and conditions.
+#
+# For the distances, all the words of a matrix are placed in their shared
+# bounding box and bit-packed (8 pixels per byte). Because the silhouettes are
+# binary, the correlation between two of them only depends on how many pixels
+# are set in each (a, b), how many are set in both (c) and the number of pixels
+# on the screen (n):
+#
+#   r = (n*c - a*b) / sqrt((n*a - a^2) * (n*b - b^2))
+#
+# and the pixels outside the bounding box (all 0) don't change a, b or c. This
+# gives the same values as pdist(full_screen_vectors, 'correlation'). (The
+# original code drew in RGB, giving three identical values per pixel; that
+# scales n, a, b and c by the same factor, which cancels out.)
+
+import os
+import hashlib
+import numpy as np
+
+import instrumentation
+
+
+# Screen size and colours from the experiment
+SCREEN_SIZE = (1920, 1080)
+BACKGROUND = 128
+FONT = 'arial.ttf'
+
+# Number of bits set in every possible byte, for counting set pixels in packed rows
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def render_silhouette(word, font=FONT, screen_size=SCREEN_SIZE):
+    """Draw a word as it appeared on screen, and return its silhouette cropped to
+    the pixels the text touched: ((top, left), boolean array). A word that
+    touches no pixels gives a (0, 0) array."""
+    from PIL import Image, ImageDraw, ImageFont
+
+    W, H = screen_size
+
+    # Create background image
+    win = Image.new('L', (W, H), color=BACKGROUND)
+    draw = ImageDraw.Draw(win)
+
+    # Letter height should be proportional (0.1) to window height
+    fontsize = int(H * 0.1)
+    myfont = ImageFont.truetype(font, fontsize)
+
+    # Size of the text (draw.textsize() was removed in Pillow 10; textbbox() from
+    # the origin gives the same width and height)
+    if hasattr(draw, 'textsize'):
+        w, h = draw.textsize(word, font=myfont)
+    else:
+        _, _, w, h = draw.textbbox((0, 0), word, font=myfont)
+
+    # Centre the word on the screen
+    pos = ((W-w)/2, (H-h)/2)
+    draw.text(pos, text=word, font=myfont, fill='white')
+
+    # Binarize image (0 for background, 1 for everything else) and crop
+    silhouette = np.asarray(win) != BACKGROUND
+    rows = np.flatnonzero(silhouette.any(axis=1))
+    cols = np.flatnonzero(silhouette.any(axis=0))
+    if len(rows) == 0:
+        return (0, 0), np.zeros((0, 0), dtype=bool)
+
+    top, left = rows[0], cols[0]
+    return (int(top), int(left)), silhouette[top:rows[-1] + 1, left:cols[-1] + 1].copy()
+
+
+class GlyphCache:
+    """Rendered word silhouettes, keyed on (font, screen size, word).
+
+    Silhouettes are kept in memory for the session. If cache_dir is given they are
+    also saved there (one small .npz per word), so they persist across runs and
+    are shared by parallel workers.
+    """
+
+    # Bump this if render_silhouette() changes
+    version = 1
+
+    def __init__(self, cache_dir=None, font=FONT, screen_size=SCREEN_SIZE):
+        self.cache_dir = cache_dir
+        self.font = font
+        self.screen_size = tuple(screen_size)
+        self.hits = 0
+        self.misses = 0
+        self._glyphs = {}
+
+    def path(self, word):
+        import PIL
+        key = repr((self.font, self.screen_size, word, self.version, PIL.__version__))
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+    def get(self, word):
+        """Return ((top, left), silhouette) for a word, rendering it if needed."""
+        if word in self._glyphs:
+            self.hits += 1
+            instrumentation.count('glyph_cache.hit')
+            return self._glyphs[word]
+
+        fn = self.path(word) if self.cache_dir is not None else None
+
+        if fn is not None and os.path.exists(fn):
+            self.hits += 1
+            instrumentation.count('glyph_cache.hit')
+            with np.load(fn) as data:
+                glyph = (tuple(int(v) for v in data['offset']), data['silhouette'])
+        else:
+            self.misses += 1
+            instrumentation.count('glyph_cache.miss')
+            with instrumentation.phase('visual.render'):
+                glyph = render_silhouette(word, self.font, self.screen_size)
+
+            if fn is not None:
+                # Write to a temporary file first, so that an interrupted run never
+                # leaves a truncated entry behind
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+                with open(tmp_fn, 'wb') as f:
+                    np.savez(f, offset=np.array(glyph[0]), silhouette=glyph[1])
+                os.replace(tmp_fn, fn)
+
+        self._glyphs[word] = glyph
+        return glyph
+
+
+def pack_silhouettes(glyphs):
+    """Place silhouettes (from GlyphCache.get()) in their shared bounding box and
+    bit-pack them: returns an (n_words x n_bytes) uint8 array."""
+    boxes = [(top, left, top + s.shape[0], left + s.shape[1])
+             for (top, left), s in glyphs if s.size]
+    if not boxes:
+        return np.zeros((len(glyphs), 0), dtype=np.uint8)
+
+    top, left = min(b[0] for b in boxes), min(b[1] for b in boxes)
+    bottom, right = max(b[2] for b in boxes), max(b[3] for b in boxes)
+
+    # One word at a time, so only one unpacked (bounding box sized) image exists
+    packed = np.zeros((len(glyphs), ((bottom - top) * (right - left) + 7) // 8), dtype=np.uint8)
+    box = np.zeros((bottom - top, right - left), dtype=bool)
+    for k, ((t, l), s) in enumerate(glyphs):
+        box[:] = False
+        box[t - top:t - top + s.shape[0], l - left:l - left + s.shape[1]] = s
+        packed[k] = np.packbits(box)
+
+    return packed
+
+
+def correlation_distances(packed, n_pixels):
+    """Correlation distance between every pair of bit-packed silhouettes (rows of
+    packed), for silhouettes of n_pixels pixels in total. Returns a condensed
+    (pdist-ordered) vector."""
+    n_words = packed.shape[0]
+
+    # Pixels set in each silhouette, and in both silhouettes of every pair
+    set_counts = _POPCOUNT[packed].sum(axis=1, dtype=np.int64).astype(float)
+    shared = np.zeros(n_words * (n_words - 1) // 2)
+    k = 0
+    for i in range(n_words - 1):
+        shared[k:k + n_words - i - 1] = _POPCOUNT[packed[i] & packed[i + 1:]].sum(axis=1, dtype=np.int64)
+        k += n_words - i - 1
+
+    ii, jj = np.triu_indices(n_words, 1)
+    a, b = set_counts[ii], set_counts[jj]
+    n = float(n_pixels)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (n * shared - a * b) / np.sqrt((n * a - a**2) * (n * b - b**2))
+
+    return 1 - r
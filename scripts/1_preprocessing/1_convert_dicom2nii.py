@@ -1,13 +1,47 @@
 # The purpose of this script is to convert raw DICOM images to
 # 4D nifti data files
+#
+# Series (1 T1 + 4 Quick_Read runs per subject) are found by their
+# SeriesDescription/ProtocolName, from an index of the DICOM headers (see
+# dicom_index.py; the index is cached per subject, so re-runs don't read the
+# DICOM files again).
+#
+# Each series is converted by its own dcm2niix job, and the jobs run in parallel
+# (-j, default: all cores). A series is skipped if its nifti file is newer than
+# all of its DICOM files, so re-running the script only converts new (or
+# re-exported) series; use --force to convert everything again.
+#
+# dcm2niix writes into a temporary folder next to the final file, and the file
+# we keep is then renamed into place, so an interrupted run never leaves a
+# partial nifti file behind (and nothing is written to the DICOM folders).
+#
+# Every run updates dicom2nii_manifest.json (in top_dir): for each series, the
+# DICOM folder, output file, status and conversion time.
+#
+# Usage:
+#   python 1_convert_dicom2nii.py
+#   python 1_convert_dicom2nii.py --subjects subject-001 subject-002 -j 4
+#   python 1_convert_dicom2nii.py --dry-run
 
 
 import shutil, os, glob
+import sys
+import json
+import time
+import argparse
+import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import dicom_index
 
 # Define top top_dir
 top_dir = open('../top_dir_win.txt').read().replace('\n', '')
 
+dcm2niix = top_dir + '/MRIanalyses/assets/mricron/dcm2niix'
+
+manifest_fname = os.path.join(top_dir, 'dicom2nii_manifest.json')
+
 subjects = ['subject-001', 'subject-002', 'subject-003', 'subject-004', 'subject-005',
             'subject-006', 'subject-007', 'subject-008', 'subject-009', 'subject-010',
             'subject-011', 'subject-012', 'subject-013', 'subject-014', 'subject-015',
@@ -15,63 +49,160 @@ subjects = ['subject-001', 'subject-002', 'subject-003', 'subject-004', 'subject
             'subject-021', 'subject-022','subject-023', 'subject-024', 'subject-025',
             'subject-026','subject-027', 'subject-028','subject-029', 'subject-030']
 
-for subj in subjects:
-    print(subj)
+# Functionals
+func_labels = ['Quick_Read_1', 'Quick_Read_2', 'Quick_Read_3', 'Quick_Read_4']
 
+# some variation in series names, so easiest to locate the T1 series based on partial string match
+struct_partial = 'T1_MPRAGE'
 
+
+# The series to convert for a subject: (subj, label, series (from dicom_index), output
+# file, pattern of the dcm2niix output to keep). Series that can't be found are None.
+def subject_series(subj):
     subj_path = top_dir + subj
     source_path = subj_path + '/DICOM/'
-    raw_files = os.listdir(source_path)
-
-    ## Structural image
-
-    # some variation in folder names, so easiest to locate the T1 folder based on partial string match
-    struct_partial = 'T1_MPRAGE'
-    struct = [i for i in raw_files if struct_partial in i][0]
-
-    # remove any old nifti files from source dir
-    for fname in glob.glob(source_path + struct + '/*.nii.gz'):
-        os.remove(fname)
-
-    # convert DICOM to nifti
-    subprocess.check_call([top_dir + '/MRIanalyses/assets/mricron/dcm2niix',
-                          '-x', 'y',
-                          '-z', 'i',
-                          source_path + struct
-                         ])
-
-    # rename to sensible name and move up to subject directory
-    orig_file = glob.glob(source_path + struct + '/*Crop*')[0]
-    new_file = subj_path + '/' + subj + '_struct.nii.gz'
-
-
-    os.rename(orig_file, new_file)
-
-
-    # remove any extra files created during conversion
-    for fname in glob.glob(source_path + struct[0] + '/*.nii.gz'):
-        os.remove(fname)
-
-    # Functionals
-    func_labels = ['Quick_Read_1', 'Quick_Read_2', 'Quick_Read_3', 'Quick_Read_4']
+    index = []
+    if os.path.isdir(source_path):
+        index = dicom_index.index_subject(source_path, subj_path + '/dicom_series_index.json')
 
+    # Structural image: keep the cropped image
+    series = [('struct', dicom_index.find_series(index, struct_partial),
+               subj_path + '/' + subj + '_struct.nii.gz', '*Crop*')]
 
+    # Functionals: keep the image named after the series folder
     for func in func_labels:
-        fmri_run = [i for i in raw_files if func in i][0]
-        print(func)
-
-        # remove any old nifti files from source dir
-        for fname in glob.glob(source_path + fmri_run + '/*.nii.gz'):
-            os.remove(fname)
-
-        subprocess.check_call([top_dir + '/MRIanalyses/assets/mricron/dcm2niix',
-                              '-x', 'y',
-                              '-z', 'i',
-                              source_path + fmri_run
-                             ])
-
-        # rename to sensible name
-        orig_file = glob.glob(source_path + fmri_run + '/' + fmri_run + '*.nii.gz')[0]
-
-        new_file = subj_path + '/' + subj + '_' + func.lower() + '.nii.gz'
-        os.rename(orig_file, new_file)
+        fmri_run = dicom_index.find_series(index, func)
+        series.append((func.lower(), fmri_run, subj_path + '/' + subj + '_' + func.lower() + '.nii.gz',
+                       (os.path.basename(os.path.normpath(fmri_run['folder'])) if fmri_run else '') + '*.nii.gz'))
+
+    return [(subj, label, s, new_file, pattern) for label, s, new_file, pattern in series]
+
+
+# The newest modification time of the folders of a series and of the files in
+# them. Adding or removing files changes the folder's modification time, but
+# overwriting files in place (e.g. a re-export with the same file names) does
+# not, so every file is checked.
+def newest_mtime(series):
+    newest = series['mtime']
+    for folder in series['folders']:
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                newest = max(newest, entry.stat().st_mtime)
+    return newest
+
+
+# The output is current if it is newer than every DICOM file of its series
+def is_current(series, new_file):
+    return os.path.exists(new_file) and os.stat(new_file).st_mtime >= newest_mtime(series)
+
+
+# Convert one series (runs in a worker thread)
+def convert(subj, label, source, new_file, pattern):
+    start = time.time()
+
+    # dcm2niix writes to a temporary folder next to the output, so the file we keep
+    # can be renamed into place in one step
+    out_dir = tempfile.mkdtemp(prefix='.dcm2niix_' + label + '_', dir=os.path.dirname(new_file))
+    try:
+        # convert DICOM to nifti
+        proc = subprocess.run([dcm2niix,
+                               '-x', 'y',
+                               '-z', 'i',
+                               '-o', out_dir,
+                               source
+                               ], capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError('dcm2niix exited with code %d: %s'
+                               % (proc.returncode, proc.stderr.strip() or proc.stdout.strip()))
+
+        # rename to sensible name and move up to subject directory
+        matches = sorted(glob.glob(os.path.join(out_dir, pattern)))
+        if not matches:
+            raise RuntimeError('dcm2niix did not write a file matching %s' % pattern)
+        os.replace(matches[0], new_file)
+    finally:
+        # remove any extra files created during conversion
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    return time.time() - start
+
+
+def read_manifest():
+    if os.path.exists(manifest_fname):
+        with open(manifest_fname) as f:
+            return json.load(f)
+    return {}
+
+
+def write_manifest(manifest):
+    tmp_fname = '%s.%d.tmp' % (manifest_fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_fname, manifest_fname)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert DICOM series to nifti (in parallel, skipping '
+                                                 'series that are already converted).')
+    parser.add_argument('--subjects', nargs='+', default=subjects, metavar='SUBJECT',
+                        help='subjects to convert (default: all)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of dcm2niix jobs to run at once (default: all cores, %(default)s)')
+    parser.add_argument('--force', action='store_true', help='convert every series, even if up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be converted')
+    args = parser.parse_args(argv)
+
+    manifest = read_manifest()
+    jobs = []
+    n_missing = 0
+
+    for subj in args.subjects:
+        for subj, label, series, new_file, pattern in subject_series(subj):
+            key = subj + '/' + label
+            if series is None:
+                print('%s %s: no DICOM series found' % (subj, label))
+                manifest[key] = {'status': 'missing', 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+                n_missing += 1
+                continue
+
+            source = series['folder']
+            if not args.force and is_current(series, new_file):
+                manifest.setdefault(key, {}).update({'source': source, 'output': new_file, 'status': 'current'})
+            else:
+                jobs.append((key, (subj, label, source, new_file, pattern)))
+
+    print('%d series to convert' % len(jobs))
+    if args.dry_run:
+        for key, (subj, label, source, new_file, pattern) in jobs:
+            print('  would convert %s -> %s' % (source, new_file))
+        return 0
+
+    start = time.time()
+    n_failed = 0
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(convert, *job): (key, job) for key, job in jobs}
+        for n, future in enumerate(as_completed(futures), 1):
+            key, (subj, label, source, new_file, pattern) = futures[future]
+            entry = {'source': source, 'output': new_file, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+            try:
+                entry['seconds'] = round(future.result(), 2)
+                entry['status'] = 'converted'
+                print('[%d/%d] %s %s: %.1fs' % (n, len(jobs), subj, label, entry['seconds']), flush=True)
+            except Exception as e:
+                entry['status'] = 'failed'
+                entry['error'] = str(e)
+                n_failed += 1
+                print('[%d/%d] %s %s: FAILED: %s' % (n, len(jobs), subj, label, e), flush=True)
+
+            # Record every series as soon as it is done
+            manifest[key] = entry
+            write_manifest(manifest)
+
+    write_manifest(manifest)
+    print('Converted %d series in %.1fs, %d failed, %d missing' % (len(jobs) - n_failed, time.time() - start,
+                                                                 n_failed, n_missing))
+    return 1 if n_failed or n_missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+# Index of the DICOM series of a subject, read from the file headers only.
+#
+# Finding series by folder name (e.g. 'T1_MPRAGE' in os.listdir(...)) depends on
+# how the scanner export happened to name its folders. Instead, this walks a
+# subject's DICOM tree once, reads the header of every file (stopping before the
+# pixel data, and only the tags below), and catalogues the series by their
+# SeriesDescription, ProtocolName, number of files and volumes, and acquisition
+# time.
+#
+# The index is cached (dicom_series_index.json, in the subject folder), per
+# DICOM directory, with each directory's modification time. Files added to,
+# removed from or renamed in a directory change its modification time, so on
+# later calls only the directories that changed are read again; an unchanged
+# tree is validated with one stat() per directory, without listing or opening
+# any files (which matters on slow network storage). Files overwritten in place
+# don't change their directory's modification time: use rescan=True if their
+# headers may have changed.
+#
+# Usage:
+#   import dicom_index
+#   series = dicom_index.index_subject(subj_path + '/DICOM', subj_path + '/dicom_series_index.json')
+#   t1 = dicom_index.find_series(series, 'T1_MPRAGE')
+#
+# or, to print the series of some subjects:
+#   python dicom_index.py subject-001 subject-002
+
+
+import os
+import sys
+import json
+
+# Bump this if the cached information changes
+INDEX_VERSION = 1
+
+# The only header tags that are read
+TAGS = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'ProtocolName',
+        'AcquisitionNumber', 'AcquisitionDate', 'AcquisitionTime', 'SeriesDate', 'SeriesTime',
+        'NumberOfTemporalPositions']
+
+
+# Summaries of the series in one directory (not including subdirectories), from
+# the headers of its files: {'series': {uid: summary}, 'other_files': number of
+# files that aren't DICOM}.
+def _read_directory(path):
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+
+    series = {}
+    other_files = 0
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if not entry.is_file():
+            continue
+        try:
+            ds = pydicom.dcmread(entry.path, stop_before_pixels=True, specific_tags=TAGS, force=True)
+            uid = str(ds.get('SeriesInstanceUID', ''))
+        except (InvalidDicomError, OSError, ValueError, EOFError):
+            uid = ''
+        if not uid:
+            other_files += 1
+            continue
+
+        s = series.setdefault(uid, {'uid': uid, 'series_number': None, 'description': '', 'protocol': '',
+                                    'n_files': 0, 'acquisitions': [], 'temporal_positions': None,
+                                    'date': '', 'time': ''})
+        s['n_files'] += 1
+        s['series_number'] = _value(ds, 'SeriesNumber', int, s['series_number'])
+        s['description'] = s['description'] or str(ds.get('SeriesDescription', ''))
+        s['protocol'] = s['protocol'] or str(ds.get('ProtocolName', ''))
+        s['temporal_positions'] = _value(ds, 'NumberOfTemporalPositions', int, s['temporal_positions'])
+
+        acquisition = _value(ds, 'AcquisitionNumber', int, None)
+        if acquisition is not None and acquisition not in s['acquisitions']:
+            s['acquisitions'].append(acquisition)
+
+        # Earliest acquisition (or, failing that, series) date and time
+        date = str(ds.get('AcquisitionDate', '') or ds.get('SeriesDate', ''))
+        time = str(ds.get('AcquisitionTime', '') or ds.get('SeriesTime', ''))
+        if date and (not s['date'] or (date, time) < (s['date'], s['time'])):
+            s['date'], s['time'] = date, time
+
+    return {'series': series, 'other_files': other_files}
+
+
+def _value(ds, keyword, convert, default):
+    value = ds.get(keyword)
+    if value is None or value == '':
+        return default
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        return default
+
+
+# Combine the per-directory summaries into one entry per series
+def _combine(dicom_dir, directories):
+    series = {}
+    for rel_path in sorted(directories):
+        for uid, d in directories[rel_path]['series'].items():
+            s = series.setdefault(uid, {'uid': uid, 'series_number': d['series_number'],
+                                        'description': d['description'], 'protocol': d['protocol'],
+                                        'n_files': 0, 'acquisitions': set(), 'temporal_positions': None,
+                                        'date': '', 'time': '', 'folders': []})
+            s['n_files'] += d['n_files']
+            s['acquisitions'].update(d['acquisitions'])
+            s['temporal_positions'] = s['temporal_positions'] or d['temporal_positions']
+            if d['date'] and (not s['date'] or (d['date'], d['time']) < (s['date'], s['time'])):
+                s['date'], s['time'] = d['date'], d['time']
+            s['folders'].append(os.path.join(dicom_dir, rel_path) if rel_path != '.' else dicom_dir)
+            s['mtime'] = max(s.get('mtime', 0), directories[rel_path]['mtime'] / 1e9)
+
+    result = []
+    for s in series.values():
+        # Volumes: the number of temporal positions if the scanner recorded it,
+        # otherwise the number of distinct acquisitions (one per volume for EPI),
+        # otherwise 1
+        acquisitions = s.pop('acquisitions')
+        s['n_volumes'] = s.pop('temporal_positions') or len(acquisitions) or 1
+
+        # The folder to convert: the one holding the series (or the folder
+        # containing all of its folders, if it is spread over several)
+        s['folder'] = s['folders'][0] if len(s['folders']) == 1 else os.path.commonpath(s['folders'])
+        result.append(s)
+
+    return sorted(result, key=lambda s: (s['series_number'] is None, s['series_number'] or 0, s['uid']))
+
+
+def index_subject(dicom_dir, cache_fname=None, rescan=False):
+    """Series in a DICOM tree, as a list of dicts (in series number order) with:
+    uid, series_number, description, protocol, n_files, n_volumes, date, time,
+    folder (to give to dcm2niix), folders (every folder holding its files) and
+    mtime (the latest modification time of those folders, in seconds).
+
+    With cache_fname, the index is read from (and saved to) that file, and only
+    directories whose modification time changed are read again."""
+    cache = {'version': INDEX_VERSION, 'dicom_dir': dicom_dir, 'directories': {}}
+    if cache_fname is not None and not rescan and os.path.exists(cache_fname):
+        with open(cache_fname) as f:
+            cached = json.load(f)
+        if cached.get('version') == INDEX_VERSION and cached.get('dicom_dir') == dicom_dir:
+            cache = cached
+
+    directories = {}
+    changed = False
+
+    # Walk the tree, only descending into (and reading) directories that changed.
+    # An unchanged directory's subdirectories are taken from the cache, but still
+    # checked in turn (a file added to a subdirectory only changes that
+    # subdirectory's modification time).
+    todo = ['.']
+    while todo:
+        rel_path = todo.pop()
+        path = os.path.join(dicom_dir, rel_path) if rel_path != '.' else dicom_dir
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            changed = True
+            continue
+
+        entry = cache['directories'].get(rel_path)
+        if entry is None or entry['mtime'] != mtime:
+            subdirectories = sorted(os.path.relpath(e.path, dicom_dir) for e in os.scandir(path) if e.is_dir())
+            entry = dict(_read_directory(path), mtime=mtime, subdirectories=subdirectories)
+            changed = True
+
+        directories[rel_path] = entry
+        todo.extend(entry['subdirectories'])
+
+    if set(directories) != set(cache['directories']):
+        changed = True
+
+    if cache_fname is not None and changed:
+        cache = {'version': INDEX_VERSION, 'dicom_dir': dicom_dir, 'directories': directories}
+        tmp_fname = '%s.%d.tmp' % (cache_fname, os.getpid())
+        with open(tmp_fname, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_fname, cache_fname)
+
+    return _combine(dicom_dir, directories)
+
+
+def find_series(series, label):
+    """The series whose description or protocol name contains label. If there are
+    several (e.g. a repeated or reformatted series), the one with the most
+    volumes (then files) is returned, latest acquired first. Returns None if
+    there is none."""
+    matches = [s for s in series if label in s['description'] or label in s['protocol']]
+    if not matches:
+        return None
+    return max(matches, key=lambda s: (s['n_volumes'], s['n_files'], s['date'], s['time']))
+
+
+if __name__ == '__main__':
+    top_dir = open('../top_dir_win.txt').read().replace('\n', '')
+
+    for subj in sys.argv[1:]:
+        subj_path = top_dir + subj
+        print(subj)
+        for s in index_subject(subj_path + '/DICOM/', subj_path + '/dicom_series_index.json'):
+            print('  %4s  %-40s %-30s %5d files %5d volumes  %s %s  %s'
+                  % (s['series_number'], s['description'], s['protocol'], s['n_files'], s['n_volumes'],
+                     s['date'], s['time'], s['folder']))
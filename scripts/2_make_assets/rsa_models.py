@@ -0,0 +1,535 @@
+############################################################
+# Incremental build of the RSA hypothesis models
+############################################################
+
+# Command-line alternative to 2_make_rsa_hypothesis_models_quickread.ipynb, which
+# only rebuilds the models whose inputs have changed. Run it from this folder:
+#
+#   python -m rsa_models build             build whatever is out of date
+#   python -m rsa_models build --dry-run   only report what would be built
+#   python -m rsa_models build --force     rebuild everything
+#   python -m rsa_models build --subjects subject-001 --measures semantic visual -j 8
+#
+# Every model (one subject x condition x measure) gets a fingerprint: a hash of
+# its word list, the measure, the measure's parameters (the defaults of its
+# make_<measure>_matrix function), the source code of the functions and modules
+# that compute it, and the contents of the asset files it reads (IPHOD corpus,
+# GloVe model, ratings tables, or the recordings of its words). A model is only
+# rebuilt if its fingerprint differs from the one recorded when it was last
+# built, or if it is missing from the model store.
+#
+# Models are written to the model store (see model_store.py) and exported to csv
+# for MATLAB, a batch at a time (all the models sliced from one master, or
+# every STORE_BATCH models built on their own), so the store's index is not
+# rewritten for every model. The manifest of fingerprints (build_manifest.json,
+# next to the store) is rewritten atomically after every batch is stored, so a
+# crashed or interrupted build simply resumes where it stopped on the next run.
+#
+# The vocabulary-wide master matrices (see get_matrix() in
+# make_rsa_model_functions.py) are fingerprinted in the same way, and rebuilt
+# from scratch if any of their inputs changed.
+
+import os
+import sys
+import json
+import hashlib
+import inspect
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed
+import numpy as np
+import pandas as pd
+
+# Define paths (as in the notebook, top_dir_win.txt is one level up from here)
+top_dir =  open('../top_dir_win.txt').read().replace('\n', '')
+custom_func_dir = os.path.join(top_dir, 'scripts', '0_custom_functions', 'python')
+
+# Add custom_func_dir to system path
+sys.path.insert(0, custom_func_dir)
+
+import make_rsa_model_functions as mrf
+import acoustic_distance
+import banded_dtw
+import open_ngrams
+import visual_silhouettes
+import rdm
+import instrumentation
+from model_store import ModelStore
+
+############################################################
+# Define lists of subjects, conditions, and measures
+############################################################
+
+subjects = ['subject-001', 'subject-002', 'subject-003', 'subject-004', 'subject-005', 'subject-006',
+            'subject-007', 'subject-008', 'subject-009', 'subject-010', 'subject-011', 'subject-012',
+            'subject-013', 'subject-014', 'subject-015', 'subject-016', 'subject-017', 'subject-018',
+            'subject-019', 'subject-020', 'subject-021', 'subject-022', 'subject-023', 'subject-024',
+            'subject-025', 'subject-026', 'subject-027', 'subject-028', 'subject-029', 'subject-030']
+
+# subject-009 did not complete the quickread experiment
+excluded_subjects = ['subject-009']
+
+conditions = ['alltrials', 'aloud', 'silent']
+
+experiment = 'quickread'
+
+# Folder of the word lists, in behavioural_data
+behav_subfolder = 'fmri_runs2'
+
+# Measures built by default (the confound measures can be selected explicitly)
+default_measures = ['articulatory', 'orthographic', 'phonological', 'semantic', 'visual', 'wordlength']
+
+# The functions and modules each measure depends on (their source code is part of
+# the fingerprint), and the asset files it reads for a list of words
+_ratings_code = [mrf._get_feature_index, mrf._lookup_features, mrf._pairwise_feature_matrix]
+
+measures = {
+    'articulatory': {'code': [mrf.articulatory_distances, mrf.get_iphod_corpus, mrf.get_iphod_context],
+                     'assets': lambda words: [mrf.corpus_path]},
+    'orthographic': {'code': [open_ngrams],
+                     'assets': lambda words: []},
+    'phonological': {'code': [mrf.phonological_distances, mrf.recording_sets, acoustic_distance, banded_dtw],
+                     'assets': mrf.recording_files},
+    'semantic':     {'code': [mrf._get_normalized_vectors, mrf.get_sem_model],
+                     'assets': lambda words: _sem_model_files()},
+    'visual':       {'code': [visual_silhouettes],
+                     'assets': lambda words: []},
+    'wordlength':   {'code': [mrf._pairwise_feature_matrix],
+                     'assets': lambda words: []},
+    'conc':         {'code': _ratings_code + [mrf.get_conc_ratings],
+                     'assets': lambda words: [mrf.conc_fname]},
+    'g2p':          {'code': _ratings_code + [mrf.get_g2p_values],
+                     'assets': lambda words: [mrf.g_to_p_values_fname]},
+    'imag':         {'code': _ratings_code + [mrf.get_imag_ratings],
+                     'assets': lambda words: [mrf.imag_fname]},
+    'morph':        {'code': _ratings_code + [mrf.get_morph_counts],
+                     'assets': lambda words: [mrf.morph_fname]},
+    'nounverb':     {'code': _ratings_code + [mrf.get_nounverb_categories],
+                     'assets': lambda words: [mrf.nounverb_fname]},
+}
+
+# Code shared by every measure: slicing from the master matrices, and the RDM container
+_common_code = [mrf.get_matrix, mrf.get_master_matrix, rdm]
+
+# The GloVe model is saved as several files (the .model file, plus its arrays)
+def _sem_model_files():
+    folder, name = os.path.split(mrf.sem_model_fname)
+    if not os.path.isdir(folder):
+        return [mrf.sem_model_fname]
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.startswith(name))
+
+############################################################
+# Fingerprints
+############################################################
+
+def _hash(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+class Fingerprints:
+    """Fingerprints of models and master matrices. Content hashes of asset files
+    are remembered (in the manifest) per (path, size, modification time), so
+    unchanged files are never read again."""
+
+    def __init__(self, file_hashes=None):
+        self.file_hashes = dict(file_hashes or {})
+        self._code = {}
+
+    def file_hash(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        known = self.file_hashes.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        self.file_hashes[path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+    def code(self, measure):
+        """Hash of the source code and default parameters of a measure."""
+        if measure not in self._code:
+            builder = getattr(mrf, 'make_' + measure + '_matrix')
+            sources = [inspect.getsource(obj) for obj in [builder] + measures[measure]['code'] + _common_code]
+            params = {name: repr(p.default) for name, p in inspect.signature(builder).parameters.items()
+                      if p.default is not inspect.Parameter.empty}
+            self._code[measure] = _hash({'sources': sources, 'params': params})
+        return self._code[measure]
+
+    def of(self, measure, words):
+        """Fingerprint of the matrix of a measure for a list of words."""
+        assets = {path: self.file_hash(path) for path in measures[measure]['assets'](words)}
+        return _hash({'measure': measure, 'words': list(words), 'code': self.code(measure), 'assets': assets})
+
+############################################################
+# Manifest
+############################################################
+
+def manifest_path(store):
+    return os.path.join(store.store_dir, 'build_manifest.json')
+
+def read_manifest(store):
+    fn = manifest_path(store)
+    if os.path.exists(fn):
+        with open(fn) as f:
+            return json.load(f)
+    return {'models': {}, 'masters': {}, 'files': {}}
+
+def write_manifest(store, manifest):
+    os.makedirs(store.store_dir, exist_ok=True)
+    fn = manifest_path(store)
+    tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+    with open(tmp_fn, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_fn, fn)
+
+def _unit_key(subject, condition, measure):
+    return '%s/%s/%s' % (subject, condition, measure)
+
+# Number of models built on their own (not sliced from a master) that are
+# stored, and recorded in the manifest, at once
+STORE_BATCH = 20
+
+############################################################
+# Build
+############################################################
+
+def read_word_lists(subject):
+    """Word list of each condition for a subject (alphabetical)."""
+    words = {}
+    for condition in ['aloud', 'silent']:
+        fn = os.path.join(top_dir, 'behavioural_data', behav_subfolder, subject, condition + '_words.txt')
+        words[condition] = pd.read_csv(fn, header=None).sort_values(by=0)[0].tolist()
+    words['alltrials'] = sorted(words['aloud'] + words['silent'])
+    return words
+
+def plan(store, manifest, fingerprints, unit_subjects, unit_conditions, unit_measures, force=False):
+    """Work out which models (and master matrices) are out of date.
+
+    Returns (units, masters): units is a list of (subject, condition, measure,
+    words, fingerprint, reason) for the models to build, masters a dict of
+    measure -> (reason, words) for the master matrices to rebuild from scratch."""
+    units = []
+    word_lists = {subject: read_word_lists(subject) for subject in unit_subjects}
+
+    for measure in unit_measures:
+        for subject in unit_subjects:
+            for condition in unit_conditions:
+                words = word_lists[subject][condition]
+                fp = fingerprints.of(measure, words)
+                old_fp = manifest['models'].get(_unit_key(subject, condition, measure))
+
+                if force:
+                    reason = 'forced'
+                elif (subject, condition, measure) not in store:
+                    reason = 'not built'
+                elif old_fp != fp:
+                    reason = 'inputs changed'
+                else:
+                    continue
+                units.append((subject, condition, measure, words, fp, reason))
+
+    # Master matrices whose inputs changed since they were built are rebuilt from
+    # scratch (the models above only see the inputs of their own words)
+    masters = {}
+    for measure in sorted(set(unit[2] for unit in units)):
+        if measure in mrf.vocabulary_dependent_measures or not os.path.exists(mrf.master_path(measure)):
+            continue
+        labels = mrf.RDM.load(mrf.master_path(measure)).labels
+        if force:
+            masters[measure] = ('forced', labels)
+        elif manifest['masters'].get(measure) != fingerprints.of(measure, labels):
+            masters[measure] = ('inputs changed', labels)
+
+    return units, masters
+
+# Relative cost of building each measure: the expensive ones are scheduled first,
+# so that they don't end up running alone at the end of a build
+measure_costs = {'phonological': 3, 'articulatory': 2, 'visual': 1, 'semantic': 1}
+
+# Pool workers (these must be top-level functions so that they can be pickled).
+# Worker processes are re-used, so each one only loads the assets it needs once.
+# Each one writes out its instrumentation events (if enabled) when it is done.
+def _pair_worker(measure, pairs):
+    start = time.perf_counter()
+    with instrumentation.phase('build.pairs', measure=measure, pairs=len(pairs)):
+        distances = mrf.master_pair_functions[measure](pairs)
+    instrumentation.flush()
+    return distances, time.perf_counter() - start
+
+def _master_worker(measure, words):
+    start = time.perf_counter()
+    with instrumentation.phase('build.master', measure=measure, words=len(words)):
+        if measure == 'imag':
+            master = mrf.make_imag_matrix(words, keep_masked=True)
+        else:
+            master = getattr(mrf, 'make_' + measure + '_matrix')(words)
+    instrumentation.flush()
+    return master, time.perf_counter() - start
+
+def _unit_worker(measure, words):
+    start = time.perf_counter()
+    with instrumentation.phase('build.unit', measure=measure, words=len(words)):
+        matrix = mrf.get_matrix(measure, words)
+    instrumentation.flush()
+    return matrix, time.perf_counter() - start
+
+# Runs tasks as they are submitted (used instead of a pool for --jobs 1)
+class _InlineExecutor:
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+def build(store, manifest, fingerprints, units, masters, jobs=1, chunk_size=1000, export_csv=True):
+    """Build the given models (see plan()) over jobs worker processes, recording
+    them in the manifest as soon as they are stored (a batch at a time). Returns a list of
+    (subject, condition, measure, error) for the models that failed; a failure
+    never stops the rest of the build.
+
+    Master matrices are extended first: for articulatory and phonological, the
+    new word pairs are split into tasks of chunk_size pairs; the other measures
+    are rebuilt over the new vocabulary in one task. Each model is then sliced
+    from its master (in this process) as soon as the master is complete.
+    Orthographic models have no master, and are one task each."""
+
+    by_measure = {}
+    for unit in units:
+        by_measure.setdefault(unit[2], []).append(unit)
+    order = sorted(by_measure, key=lambda measure: -measure_costs.get(measure, 0))
+
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else _InlineExecutor()
+    tasks = {}
+    pending = {}
+    ready = []
+    failures = []
+    unstored = []
+    n_done = [0]
+    build_start = time.perf_counter()
+
+    def report(subject, condition, measure, message):
+        n_done[0] += 1
+        print('[%d/%d] %s %s %s: %s' % (n_done[0], len(units), subject, condition, measure, message),
+              flush=True)
+
+    def store_unit(unit, x, message):
+        unstored.append((unit, x, message))
+        if len(unstored) >= STORE_BATCH:
+            store_units()
+
+    # Store the models built so far, and record them in the manifest
+    def store_units():
+        if not unstored:
+            return
+        keys = [tuple(unit[:3]) for unit, _, _ in unstored]
+        with instrumentation.phase('build.store', models=len(keys)):
+            store.put_many([key + (x,) for key, (_, x, _) in zip(keys, unstored)])
+        if export_csv:
+            with instrumentation.phase('build.export_csv', models=len(keys)):
+                store.export_csv(mrf.assets_dir, keys=keys)
+        for unit, _, _ in unstored:
+            manifest['models'][_unit_key(*unit[:3])] = unit[4]
+        manifest['files'] = fingerprints.file_hashes
+        write_manifest(store, manifest)
+        for unit, _, message in unstored:
+            report(unit[0], unit[1], unit[2], '%s (%s)' % (message, unit[5]))
+        del unstored[:]
+
+    def fail_unit(unit, error):
+        subject, condition, measure = unit[:3]
+        failures.append((subject, condition, measure, error))
+        report(subject, condition, measure, 'FAILED: %r' % (error,))
+
+    def finish_master(measure, master):
+        os.makedirs(mrf.master_dir, exist_ok=True)
+        master.save(mrf.master_path(measure))
+        mrf._master_rdms[measure] = master
+        manifest['masters'][measure] = fingerprints.of(measure, master.labels)
+        write_manifest(store, manifest)
+        for unit in by_measure[measure]:
+            try:
+                x = mrf.get_matrix(unit[2], unit[3])
+            except Exception as e:
+                fail_unit(unit, e)
+                continue
+            unstored.append((unit, x, 'sliced from master'))
+        store_units()
+
+    try:
+        # Submit everything, most expensive measures first
+        for measure in order:
+            measure_units = by_measure[measure]
+
+            if measure in mrf.vocabulary_dependent_measures:
+                for unit in measure_units:
+                    tasks[executor.submit(_unit_worker, measure, unit[3])] = ('unit', measure, unit)
+                continue
+
+            # The master, and the vocabulary it needs to cover
+            if measure in masters:
+                print('Rebuilding %s master matrix (%s)' % (measure, masters[measure][0]), flush=True)
+                master, old_labels = None, masters[measure][1]
+            elif os.path.exists(mrf.master_path(measure)):
+                master = mrf.RDM.load(mrf.master_path(measure))
+                old_labels = master.labels
+            else:
+                master, old_labels = None, []
+            vocabulary = sorted(set(old_labels).union(*[unit[3] for unit in measure_units]))
+
+            if master is not None and set(vocabulary) <= set(master.labels):
+                ready.append((measure, master))
+            elif measure in mrf.master_pair_functions:
+                base = master if master is not None else mrf.RDM([], [])
+                pairs = base.new_pairs(vocabulary)
+                if not pairs:
+                    ready.append((measure, base.extend(vocabulary, None)))
+                    continue
+                chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+                print('%s: %d new word pairs, in %d tasks' % (measure, len(pairs), len(chunks)), flush=True)
+                pending[measure] = {'base': base, 'vocabulary': vocabulary, 'results': [None] * len(chunks),
+                                    'remaining': len(chunks), 'futures': []}
+                for k, chunk in enumerate(chunks):
+                    future = executor.submit(_pair_worker, measure, chunk)
+                    tasks[future] = ('chunk', measure, k)
+                    pending[measure]['futures'].append(future)
+            else:
+                tasks[executor.submit(_master_worker, measure, vocabulary)] = ('master', measure, None)
+
+        # Models whose master already covers their words only need slicing
+        for measure, master in ready:
+            finish_master(measure, master)
+
+        # Then collect the results as they come in
+        for future in as_completed(tasks):
+            kind, measure, item = tasks[future]
+            if future.cancelled():
+                continue
+
+            try:
+                result, elapsed = future.result()
+            except Exception as e:
+                if kind == 'unit':
+                    fail_unit(item, e)
+                    continue
+
+                # Chunks that were already running when another chunk of their
+                # measure failed can't be cancelled; the measure has already failed
+                if kind == 'chunk' and measure not in pending:
+                    continue
+
+                # Without its master, none of the measure's models can be built
+                for other in pending.get(measure, {}).get('futures', []):
+                    other.cancel()
+                pending.pop(measure, None)
+                for unit in by_measure[measure]:
+                    fail_unit(unit, e)
+                continue
+
+            if kind == 'unit':
+                store_unit(item, result, '%.2fs' % elapsed)
+
+            elif kind == 'master':
+                print('%s master matrix: %.1fs' % (measure, elapsed), flush=True)
+                finish_master(measure, result)
+
+            elif measure in pending:
+                state = pending[measure]
+                state['results'][item] = result
+                state['remaining'] -= 1
+                print('%s: task %d/%d done (%.1fs)' % (measure, len(state['results']) - state['remaining'],
+                                                      len(state['results']), elapsed), flush=True)
+                if state['remaining'] == 0:
+                    del pending[measure]
+                    distances = np.concatenate(state['results'])
+                    finish_master(measure, state['base'].extend(state['vocabulary'], lambda pairs: distances))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        store_units()
+
+    print('Built %d of %d models in %.1fs, %d failed'
+          % (len(units) - len(failures), len(units), time.perf_counter() - build_start, len(failures)))
+    for subject, condition, measure, error in failures:
+        print('  FAILED %s %s %s: %r' % (subject, condition, measure, error))
+
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m rsa_models',
+                                     description='Build the RSA hypothesis models (incrementally).')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = commands.add_parser('build', help='build the hypothesis models that are out of date')
+    build_parser.add_argument('--subjects', nargs='+', default=None, metavar='SUBJECT',
+                              help='subjects to build (default: all)')
+    build_parser.add_argument('--conditions', nargs='+', default=conditions, choices=conditions,
+                              metavar='CONDITION', help='conditions to build (default: all)')
+    build_parser.add_argument('--measures', nargs='+', default=default_measures, choices=sorted(measures),
+                              metavar='MEASURE', help='measures to build (default: %s)' % ' '.join(default_measures))
+    build_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                              help='number of worker processes (default: all cores, %(default)s)')
+    build_parser.add_argument('--chunk-size', type=int, default=1000,
+                              help='word pairs per task when extending master matrices (default: %(default)s)')
+    build_parser.add_argument('--dry-run', action='store_true', help='only report what would be built')
+    build_parser.add_argument('--force', action='store_true', help='rebuild everything')
+    build_parser.add_argument('--no-csv', action='store_true', help="don't export csv files for MATLAB")
+    build_parser.add_argument('--store', default=os.path.join(mrf.assets_dir, 'RSA_models', experiment),
+                              help='model store folder (default: %(default)s)')
+    build_parser.add_argument('--trace', metavar='DIR',
+                              help='record where the time goes (see instrumentation.py), in a new folder in DIR')
+    build_parser.add_argument('--trace-memory', action='store_true',
+                              help='with --trace, also record the peak memory of every phase (slower)')
+
+    args = parser.parse_args(argv)
+
+    if args.subjects is None:
+        unit_subjects = [s for s in subjects if s not in excluded_subjects]
+    else:
+        unknown = [s for s in args.subjects if s not in subjects]
+        if unknown:
+            parser.error('unknown subjects: %s' % ' '.join(unknown))
+        unit_subjects = args.subjects
+
+    # (before any worker processes are started, so that they record too)
+    if args.trace and not args.dry_run:
+        instrumentation.enable(args.trace, memory=args.trace_memory)
+
+    store = ModelStore(args.store, experiment)
+    manifest = read_manifest(store)
+    fingerprints = Fingerprints(manifest.get('files'))
+
+    with instrumentation.phase('build.plan'):
+        units, masters = plan(store, manifest, fingerprints, unit_subjects, args.conditions, args.measures,
+                              force=args.force)
+
+    n_total = len(unit_subjects) * len(args.conditions) * len(args.measures)
+    print('%d of %d models to build' % (len(units), n_total))
+
+    if args.dry_run:
+        for measure, (reason, words) in masters.items():
+            print('  would rebuild %s master matrix (%s)' % (measure, reason))
+        for subject, condition, measure, words, fp, reason in units:
+            print('  would build %s %s %s (%s)' % (subject, condition, measure, reason))
+        return 0
+
+    failures = build(store, manifest, fingerprints, units, masters, jobs=args.jobs,
+                     chunk_size=args.chunk_size, export_csv=not args.no_csv)
+
+    if args.trace:
+        instrumentation.report()
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
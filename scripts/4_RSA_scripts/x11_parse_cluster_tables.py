@@ -1,14 +1,33 @@
 # coding: utf-8
 
-# The purpose of this script is to read the cluster tables generated by 
-# the previous script and parse them into human-readable format. This 
+# The purpose of this script is to read the cluster tables generated by
+# the previous script and parse them into human-readable format. This
 # produces one results table for every combination of models and contrasts
-# that yeilded at least one cluster. 
+# that yeilded at least one cluster.
+#
+# All the cluster tables are read at once, into one frame tagged by model and
+# contrast, and parsed together. Anatomical and COG labels come from a small,
+# fixed set of atlas structures, so each distinct label is normalized once (with
+# the fixes in COG_LABEL_FIXES, applied by a single precompiled regex) and the
+# results are mapped back onto the rows; adding another atlas quirk is one more
+# entry in the table, not another pass over every table.
+#
+# Besides one parsed table per model and contrast, this writes all of them
+# together to cluster_tables_parsed.csv (and cluster_tables_parsed.parquet, if
+# pyarrow is installed), with Model and Contrast columns.
+#
+# Usage:
+#   python x11_parse_cluster_tables.py
+#   python x11_parse_cluster_tables.py --all       (every cluster table in the folder)
+#   python x11_parse_cluster_tables.py --models semantic visual --contrasts aloud
 
 # Import necessaries
 import pandas as pd
 import numpy as np
 import os
+import re
+import glob
+import argparse
 
 # Define top top_dir
 top_dir = open('../top_dir_linux.txt').read().replace('\n', '')
@@ -20,113 +39,193 @@ contrasts = ['aloud','silent','aloud-silent', 'silent-aloud']
 # Define paths to data
 data_dir = top_dir + '/MRIanalyses/quickread/group_level_output/RSA_output/1_tables_and_figures'
 out_path = data_dir + '/cluster_tables_parsed/'
-os.makedirs(out_path, exist_ok=True)
 
-# Loop through models and contrasts. On each loop, read the cluster table, transform it
-# into human-readable format, and save to disk.
-for model in models:
-    for contrast in contrasts:
-        infile = data_dir + '/cluster_tables/' + 'cluster_table_' + model + '_' + contrast + '.csv'
-
-        # Read in the cluster table
-        df = pd.read_csv(infile, header=0)  
-
-        # If the cluster table is empty, skip
+# COG label will not match an anatomical label in some instances. This seems to be a
+# result of SLIGHTLY different naming conventions between atlasquery (where the COG label
+# comes from) and the anatomical volumes in the assets folder (where the anatomical labels
+# come from). For example, atlasquery uses "Temporal_Fusiform_Cortexanterior_division",
+# while the anatomical volumes use "Temporal_Fusiform_Cortex_anterior". These are the
+# affected parts of COG labels, and what they are changed to (to match the anatomical labels).
+COG_LABEL_FIXES = {
+    'Gyrustemporooccipital_part': 'Gyrus_temporooccipital',
+    'Cortexanterior_division': 'Cortex_anterior',
+    'Cortexposterior_division': 'Cortex_posterior',
+    'Gyrusposterior_division': 'Gyrus_posterior',
+    'Gyrusanterior_division': 'Gyrus_anterior',
+    'Cortexinferior_division': 'Cortex_inferior',
+    'Cortexsuperior_division': 'Cortex_superior',
+    'Gyruspars_opercularis': 'Gyrus_pars_opercularis',
+    'Gyruspars_triangularis': 'Gyrus_pars_triangularis',
+    'Juxtapositional_Lobule_Cortex_(formerly_Supplementary_Motor_Cortex)': 'Supplementary_Motor_Area',
+    "Heschl's_Gyrus_(includes_H1_and_H2)": 'Heschls_Gyrus',
+}
+
+# One regex for all the fixes (longest first, so a fix is never pre-empted by a
+# shorter one it contains)
+_cog_fix_regex = re.compile('|'.join(re.escape(k) for k in sorted(COG_LABEL_FIXES, key=len, reverse=True)))
+
+# Columns of the parsed tables
+columns = ['Cluster N', 'Cluster extent (mm^3)', 'Mean BF', 'Max BF', 'x', 'y', 'z', 'Anatomical labels']
+
+
+def table_fname(model, contrast):
+    return data_dir + '/cluster_tables/' + 'cluster_table_' + model + '_' + contrast + '.csv'
+
+
+# All cluster tables in the folder, as (model, contrast, file). Model names don't
+# contain underscores, so the rest of the name is the contrast.
+def find_tables():
+    tables = []
+    for fn in sorted(glob.glob(table_fname('*', '*'))):
+        name = os.path.basename(fn)[len('cluster_table_'):-len('.csv')]
+        if name.startswith('raw_') or '_' not in name:
+            continue
+        model, contrast = name.split('_', 1)
+        tables.append((model, contrast, fn))
+    return tables
+
+
+def read_tables(tables):
+    """Read cluster tables ((model, contrast, file) tuples) into one frame, with
+    Model and Contrast columns (categoricals, in the order given). Empty tables
+    are left out."""
+    frames = []
+    for model, contrast, fn in tables:
+        df = pd.read_csv(fn, header=0)
         if df.empty:
             continue
-
-        # Re-number cluster N column, by ascending Mean BF, Cluster extent, and xyz
-        df['Mean BF'] = df['Mean BF'].astype(float)
-        df['Cluster N'] = df['Mean BF'].rank(method='dense', ascending=False).astype(int)
-        
-        # Convert Anatomical labels column to list
-        df['Anatomical labels'] = df['Anatomical labels'].str.split('+')          
-
-        # Split the contents of the Anatomical labels column into separate rows
-        df = df.explode('Anatomical labels')
-
-        # Split (voxels) from anatomical label into separate column
-        df[['Anatomical labels', 'voxels']] = df['Anatomical labels'].str.split('(', expand=True)
-
-        # Delete whitespace in label columns (allows us to match labels across columns below)
-        df['Anatomical labels'] = df['Anatomical labels'].str.strip()
-        df['COG label'] = df['COG label'].str.strip()
-
-        # Bug: COG label will not match an anatomical label in some instances. This seems to be a 
-        # result of SLIGHTLY different naming conventions between atlasquery (where the COG label 
-        # comes from) and the anatomical volumes in the assets folder (where the anatomical labels 
-        # come from). For example, atlasquery uses "Temporal_Fusiform_Cortexanterior_division", 
-        # while the anatomical volumes use "Temporal_Fusiform_Cortex_anterior". To fix this, we need 
-        # to manually change the affected COG labels to match the anatomical labels.
-        df['COG label'] = df['COG label'].str.replace("Gyrustemporooccipital_part", "Gyrus_temporooccipital")
-        df['COG label'] = df['COG label'].str.replace("Cortexanterior_division", "Cortex_anterior")
-        df['COG label'] = df['COG label'].str.replace("Cortexposterior_division", "Cortex_posterior")
-        df['COG label'] = df['COG label'].str.replace("Gyrusposterior_division", "Gyrus_posterior")
-        df['COG label'] = df['COG label'].str.replace("Gyrusanterior_division", "Gyrus_anterior")
-        df['COG label'] = df['COG label'].str.replace("Cortexinferior_division", "Cortex_inferior")
-        df['COG label'] = df['COG label'].str.replace("Cortexsuperior_division", "Cortex_superior")
-        df['COG label'] = df['COG label'].str.replace("Gyruspars_opercularis", "Gyrus_pars_opercularis")
-        df['COG label'] = df['COG label'].str.replace("Gyruspars_triangularis", "Gyrus_pars_triangularis")
-    
-        
-        # Note that we must use regex=False for strings containing parentheses)
-        df['COG label'] = df['COG label'].str.replace(
-            'Juxtapositional_Lobule_Cortex_(formerly_Supplementary_Motor_Cortex)', 'Supplementary_Motor_Area',
-            regex=False)
-        df['COG label'] = df['COG label'].str.replace("Heschl's_Gyrus_(includes_H1_and_H2)", "Heschls_Gyrus",
-            regex=False)
-
-        # Another bug: subcortical lables use Left/Right prefix, cortical use LH/RH suffix. This is already fixed
-        # for COG labels, but not anatomical labels
-        df = df.reset_index(drop=True) # Required for using df.loc
-        
-        df.loc[df['Anatomical labels'].str.contains('Left'), 
-            'Anatomical labels'] = df['Anatomical labels'].str.replace('Left_', '') + '_LH'
-        df.loc[df['Anatomical labels'].str.contains('Right'), 
-            'Anatomical labels'] = df['Anatomical labels'].str.replace('Right_', '') + '_RH'
-
-
-        # If COG label does not match anatomical label, replace it with NaN
-        df.loc[df['COG label'] != df['Anatomical labels'], 'COG label'] = np.nan
-
-        # Replace underscores with spaces in anatomical labels
-        df['Anatomical labels'] = df['Anatomical labels'].str.replace('_', ' ')
-
-        # Change hemi suffix to single-letter prefix 
-        df.loc[df['Anatomical labels'].str.contains('LH'), 'Anatomical labels'] = 'L ' + df['Anatomical labels']
-        df.loc[df['Anatomical labels'].str.contains('RH'), 'Anatomical labels'] = 'R ' + df['Anatomical labels']
-        df['Anatomical labels'] = df['Anatomical labels'].str.replace(' LH','')
-        df['Anatomical labels'] = df['Anatomical labels'].str.replace(' RH','')
-
-        # (re-)Append Anatomical labels with N voxels, delete voxels column
-        df['Anatomical labels'] = df['Anatomical labels'] + ' (' + df['voxels']
-        df = df.drop(columns=['voxels'])
-
-        # Now, boldface the anatomical label if COG label is not nan
-        df.loc[df['COG label'].notnull(), 'Anatomical labels'] = '** ' + df['Anatomical labels'] + ' **'
-
-        # Drop COG label column  
-        df = df.drop(columns=['COG label'])
-
-        # Sort by Cluster N, then Anatomical label
-        df = df.sort_values(['Cluster N', 'Anatomical labels'])
-
-        # Round x, y, z values (0 decimal places)
-        df['x'] = df['x'].round(0)
-        df['y'] = df['y'].round(0)
-        df['z'] = df['z'].round(0)
-
-        # Round mean BF (2 decimal places)
-        df['Mean BF'] = df['Mean BF'].round(2)
-
-        # Remove duplicates of Cluster N, Cluster extent (mm^3), Mean/Max BF, xyz, but otherwsise preserve rows
-        cols = ['Cluster N', 'Cluster extent (mm^3)', 'Mean BF', 'Max BF', 'x', 'y', 'z']
-        df.loc[df.duplicated(subset=cols), cols] = np.nan
-        
-        # Re-order columns, Cluster N, Cluster extent (mm^3), Mean/Max BF, xyz, Anatomical labels
-        df = df[['Cluster N', 'Cluster extent (mm^3)', 'Mean BF', 
-                'Max BF', 'x', 'y', 'z', 'Anatomical labels']]
-
-        # Write out to CSV file
-        outfile = out_path + '/cluster_table_parsed_' + model + '_' + contrast
-        df.to_csv(outfile + ".csv", sep=',', header=True, index=False)
+        frames.append(df.assign(Model=model, Contrast=contrast))
+
+    if not frames:
+        return pd.DataFrame(columns=['Model', 'Contrast'] + columns + ['COG label'])
+
+    df = pd.concat(frames, ignore_index=True)
+    df['Model'] = pd.Categorical(df['Model'], categories=list(dict.fromkeys(t[0] for t in tables)))
+    df['Contrast'] = pd.Categorical(df['Contrast'], categories=list(dict.fromkeys(t[1] for t in tables)))
+    return df
+
+
+# Normalize one COG label, so it can be matched with the anatomical labels
+def _normalize_cog(label):
+    if not isinstance(label, str):
+        return label
+    return _cog_fix_regex.sub(lambda m: COG_LABEL_FIXES[m.group(0)], label.strip())
+
+
+# Normalize one anatomical label (without its number of voxels): returns the label
+# to match with the COG label, and the label to print.
+def _normalize_anatomical(label):
+    if not isinstance(label, str):
+        return label, label
+    label = label.strip()
+
+    # Subcortical lables use Left/Right prefix, cortical use LH/RH suffix. This is already fixed
+    # for COG labels, but not anatomical labels
+    if 'Left' in label:
+        label = label.replace('Left_', '') + '_LH'
+    if 'Right' in label:
+        label = label.replace('Right_', '') + '_RH'
+
+    # Replace underscores with spaces, and change hemi suffix to single-letter prefix
+    shown = label.replace('_', ' ')
+    if 'LH' in shown:
+        shown = 'L ' + shown
+    if 'RH' in shown:
+        shown = 'R ' + shown
+    shown = shown.replace(' LH', '').replace(' RH', '')
+
+    return label, shown
+
+
+def parse_tables(df):
+    """Parse cluster tables (from read_tables()) into human-readable format: one
+    row per cluster and anatomical label, sorted by model, contrast, cluster and
+    label."""
+    tables = ['Model', 'Contrast']
+    if df.empty:
+        return pd.DataFrame(columns=tables + columns)
+    df = df.copy()
+
+    # Re-number cluster N column, by ascending Mean BF, within each table
+    df['Mean BF'] = df['Mean BF'].astype(float)
+    df['Cluster N'] = (df.groupby(tables, observed=True)['Mean BF']
+                       .rank(method='dense', ascending=False).astype(int))
+
+    # Split the contents of the Anatomical labels column (label (N voxels)+label (N voxels)+...)
+    # into separate rows, and split (voxels) from anatomical label into separate column
+    df['Anatomical labels'] = df['Anatomical labels'].str.split('+')
+    df = df.explode('Anatomical labels', ignore_index=True)
+    parts = df['Anatomical labels'].str.rsplit('(', n=1, expand=True).reindex(columns=[0, 1])
+    labels, voxels = parts[0], parts[1]
+
+    # Normalize every distinct label once, and map the results back onto the rows
+    anatomical = {label: _normalize_anatomical(label) for label in labels.dropna().unique()}
+    cog = {label: _normalize_cog(label) for label in df['COG label'].dropna().unique()}
+
+    match_labels = labels.map({label: match for label, (match, shown) in anatomical.items()})
+    shown_labels = labels.map({label: shown for label, (match, shown) in anatomical.items()})
+    cog_labels = df['COG label'].map(cog)
+
+    # (re-)Append Anatomical labels with N voxels, and boldface the anatomical label if
+    # it is the COG label
+    df['Anatomical labels'] = shown_labels + ' (' + voxels
+    is_cog = (cog_labels == match_labels).to_numpy()
+    df.loc[is_cog, 'Anatomical labels'] = '** ' + df.loc[is_cog, 'Anatomical labels'] + ' **'
+
+    # Sort by table, Cluster N, then Anatomical label
+    df = df.sort_values(tables + ['Cluster N', 'Anatomical labels'])
+
+    # Round x, y, z values (0 decimal places), mean BF (2 decimal places)
+    df[['x', 'y', 'z']] = df[['x', 'y', 'z']].round(0)
+    df['Mean BF'] = df['Mean BF'].round(2)
+
+    # Remove duplicates of Cluster N, Cluster extent (mm^3), Mean/Max BF, xyz (within each table),
+    # but otherwsise preserve rows
+    cols = ['Cluster N', 'Cluster extent (mm^3)', 'Mean BF', 'Max BF', 'x', 'y', 'z']
+    df.loc[df.duplicated(subset=tables + cols), cols] = np.nan
+
+    return df[tables + columns].reset_index(drop=True)
+
+
+def write_tables(parsed, out_path, per_table=True):
+    """Write the parsed tables: all together (CSV, and Parquet if pyarrow is
+    installed), and one CSV per model and contrast."""
+    os.makedirs(out_path, exist_ok=True)
+
+    combined = os.path.join(out_path, 'cluster_tables_parsed')
+    parsed.to_csv(combined + '.csv', sep=',', header=True, index=False)
+    try:
+        parsed.to_parquet(combined + '.parquet', index=False)
+    except ImportError:
+        print('pyarrow is not installed, not writing ' + combined + '.parquet')
+
+    if per_table:
+        for (model, contrast), df in parsed.groupby(['Model', 'Contrast'], observed=True, sort=False):
+            outfile = out_path + '/cluster_table_parsed_' + model + '_' + contrast
+            df[columns].to_csv(outfile + ".csv", sep=',', header=True, index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Parse the cluster tables into human-readable format.')
+    parser.add_argument('--models', nargs='+', default=models, help='models (default: all)')
+    parser.add_argument('--contrasts', nargs='+', default=contrasts, help='contrasts (default: all)')
+    parser.add_argument('--all', action='store_true',
+                        help='parse every cluster table in the folder (instead of --models x --contrasts)')
+    parser.add_argument('--combined-only', action='store_true',
+                        help="only write the combined table, not one table per model and contrast")
+    args = parser.parse_args(argv)
+
+    if args.all:
+        tables = find_tables()
+    else:
+        tables = [(model, contrast, table_fname(model, contrast))
+                  for model in args.models for contrast in args.contrasts]
+
+    parsed = parse_tables(read_tables(tables))
+    write_tables(parsed, out_path, per_table=not args.combined_only)
+    print('Parsed %d tables: %d with clusters, %d rows'
+          % (len(tables), parsed.groupby(['Model', 'Contrast'], observed=True).ngroups, len(parsed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -------------------------------------------------------------------------
+
+# The purpose of this script is to get the correlations between the hypothesis
+# models (and the extraneous properties: concreteness, imageability, etc.), and
+# how collinear they are, for every subject and condition.
+#
+# Python companion to part (1) of x12_visualize_RDMS_and_get_correlations.m,
+# using model_collinearity.py (in 0_custom_functions/python). The models of all
+# subjects are read from the model store (see model_store.py) and stacked, and
+# all the correlations are computed at once. Writes, in
+# group_level_output/RSA_output/1_tables_and_figures/model_correlations:
+#
+#   model_correlations_by_subject.csv   Pearson and Spearman r (and the number
+#                                       of word pairs) for every subject,
+#                                       condition and pair of models
+#   model_correlations_summary.csv      mean, sd, min and max over subjects of
+#                                       the correlations, and of the variance
+#                                       inflation factor (VIF) of each model
+#
+# and prints the summary.
+#
+# Usage:
+#   python x12_model_collinearity.py
+#   python x12_model_collinearity.py --conditions alltrials --measures articulatory phonological conc
+
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+import pandas as pd
+
+# Read top_dir
+top_dir = open('../top_dir_linux.txt').read().replace('\n', '')
+custom_func_dir = os.path.join(top_dir, 'scripts', '0_custom_functions', 'python')
+sys.path.insert(0, custom_func_dir)
+
+import model_collinearity
+from model_store import ModelStore
+
+# Define conditions, hypothesis models and extraneous properties
+conditions = ['alltrials', 'aloud', 'silent']
+models = ['articulatory', 'orthographic', 'phonological', 'semantic', 'visual']
+extrans = ['conc', 'g2p', 'imag', 'morph', 'nounverb', 'wordlength']
+
+# Define paths
+store_path = os.path.join(top_dir, 'MRIanalyses', 'assets', 'RSA_models', 'quickread')
+out_path = os.path.join(top_dir, 'MRIanalyses', 'quickread', 'group_level_output', 'RSA_output',
+                        '1_tables_and_figures', 'model_correlations')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Correlations and collinearity between the hypothesis models.')
+    parser.add_argument('--conditions', nargs='+', default=conditions, help='conditions (default: all)')
+    parser.add_argument('--measures', nargs='+', default=models + extrans,
+                        help='models to compare (default: the hypothesis models and extraneous properties)')
+    parser.add_argument('--subjects', nargs='+', default=None, help='subjects (default: all in the store)')
+    parser.add_argument('--store', default=store_path, help='model store folder (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    store = ModelStore(args.store)
+    per_subject, summaries = [], []
+    for condition in args.conditions:
+        stack, subjects = model_collinearity.stack_models(store, condition, args.measures, args.subjects)
+        if not subjects:
+            print('%s: no subject has all of the models' % condition)
+            continue
+
+        print('%s: %d subjects, %d models' % (condition, len(subjects), len(args.measures)))
+        by_subject, summary = model_collinearity.report(stack, subjects, args.measures, condition)
+        per_subject.append(by_subject)
+        summaries.append(summary)
+
+    if not summaries:
+        return 1
+
+    os.makedirs(out_path, exist_ok=True)
+    per_subject = pd.concat(per_subject, ignore_index=True)
+    summary = pd.concat(summaries, ignore_index=True)
+    per_subject.to_csv(os.path.join(out_path, 'model_correlations_by_subject.csv'), index=False)
+    summary.to_csv(os.path.join(out_path, 'model_correlations_summary.csv'), index=False)
+
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(summary.round(3).to_string(index=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+# -------------------------------------------------------------------------
+
+# The purpose of this script is to test how strongly the hypothesis models
+# relate to one another (or ROI neural RDMs relate to the models), for every
+# subject and condition, with permutation tests, and to get the noise ceiling
+# of the target RDMs across subjects.
+#
+# Uses rdm_permutation.py (in 0_custom_functions/python): the word labels of
+# the target RDMs are permuted (the same permutations for all targets), and all
+# the permuted correlations of a chunk of permutations come from one batched
+# matrix product. The permutations only depend on --seed, so the results are
+# the same whatever the number of jobs. Words masked in, or missing from, any
+# of the RDMs are left out of all of the subject's tests: with imag among
+# --models, every correlation (not only those with imag) leaves out the words
+# without imageability ratings, unlike x12_model_collinearity.py, which
+# correlates each pair of models over the words they both have. Correlations
+# with a constant RDM are NaN, with a NaN p-value (not counted as significant).
+#
+# The targets are read from the model store (see model_store.py), or from
+# another store (--target-store, e.g. ROI neural RDMs stored the same way).
+# Writes, in group_level_output/RSA_output/1_tables_and_figures/model_permutation_tests:
+#
+#   model_permutation_tests.csv   r, p and number of words for every subject,
+#                                 condition, target and model
+#   noise_ceilings.csv            lower and upper bounds of the noise ceiling of
+#                                 every target (with --noise-ceiling), over the
+#                                 words that all subjects have
+#
+# Usage:
+#   python x12_model_permutation_tests.py
+#   python x12_model_permutation_tests.py --targets semantic --models conc imag --n-perm 10000 -j 8
+#   python x12_model_permutation_tests.py --target-store <ROI RDM store> --targets IFG STG --noise-ceiling
+
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+import pandas as pd
+
+# Read top_dir
+top_dir = open('../top_dir_linux.txt').read().replace('\n', '')
+custom_func_dir = os.path.join(top_dir, 'scripts', '0_custom_functions', 'python')
+sys.path.insert(0, custom_func_dir)
+
+import rdm_permutation
+from model_store import ModelStore
+
+# Define conditions, hypothesis models and extraneous properties
+conditions = ['alltrials', 'aloud', 'silent']
+models = ['articulatory', 'orthographic', 'phonological', 'semantic', 'visual']
+extrans = ['conc', 'g2p', 'imag', 'morph', 'nounverb', 'wordlength']
+
+# Define paths
+store_path = os.path.join(top_dir, 'MRIanalyses', 'assets', 'RSA_models', 'quickread')
+out_path = os.path.join(top_dir, 'MRIanalyses', 'quickread', 'group_level_output', 'RSA_output',
+                        '1_tables_and_figures', 'model_permutation_tests')
+
+
+def test_subject(target_store, store, subject, condition, targets, measures, args):
+    """Permutation tests of one subject and condition, as a DataFrame (None if a
+    target or model is missing)."""
+    keys = [(target_store, t) for t in targets] + [(store, m) for m in measures]
+    if not all((subject, condition, name) in s for s, name in keys):
+        return None
+
+    values, labels = rdm_permutation.aligned([s.get(subject, condition, name) for s, name in keys])
+    result = rdm_permutation.permutation_test(values[:len(targets)], values[len(targets):],
+                                              n_permutations=args.n_perm, seed=args.seed,
+                                              method=args.method, tail=args.tail, n_jobs=args.jobs)
+
+    rows = [{'subject': subject, 'condition': condition, 'target': t, 'model': m,
+             'r': result['r'][a, b], 'p': result['p'][a, b], 'n_words': len(labels)}
+            for a, t in enumerate(targets) for b, m in enumerate(measures) if t != m]
+    return pd.DataFrame(rows)
+
+
+def noise_ceilings(target_store, subjects, condition, targets, method):
+    """Noise ceiling of every target over subjects, as a DataFrame."""
+    rows = []
+    for target in targets:
+        have = [s for s in subjects if (s, condition, target) in target_store]
+        if len(have) < 2:
+            continue
+        values, labels = rdm_permutation.aligned([target_store.get(s, condition, target) for s in have])
+        lower, upper = rdm_permutation.noise_ceiling(values, method)
+        rows.append({'condition': condition, 'target': target, 'lower': lower, 'upper': upper,
+                     'n_subjects': len(have), 'n_words': len(labels)})
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Permutation tests of the correlations between RDMs.')
+    parser.add_argument('--conditions', nargs='+', default=conditions, help='conditions (default: all)')
+    parser.add_argument('--targets', nargs='+', default=models,
+                        help='RDMs whose labels are permuted (default: the hypothesis models)')
+    parser.add_argument('--models', nargs='+', default=models + extrans,
+                        help='models to test them against (default: the hypothesis models and extraneous properties)')
+    parser.add_argument('--subjects', nargs='+', default=None, help='subjects (default: all in the store)')
+    parser.add_argument('--store', default=store_path, help='model store folder (default: %(default)s)')
+    parser.add_argument('--target-store', default=None, help='store of the targets (default: --store)')
+    parser.add_argument('--n-perm', type=int, default=10000, help='number of permutations (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    parser.add_argument('--method', choices=['pearson', 'spearman'], default='spearman',
+                        help='correlation (default: %(default)s)')
+    parser.add_argument('--tail', choices=['right', 'both'], default='right', help='(default: %(default)s)')
+    parser.add_argument('--noise-ceiling', action='store_true', help='also get the noise ceiling of the targets')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='parallel processes (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    store = ModelStore(args.store)
+    target_store = ModelStore(args.target_store) if args.target_store else store
+
+    tests, ceilings = [], []
+    for condition in args.conditions:
+        subjects = args.subjects
+        if subjects is None:
+            subjects = sorted(set(key[0] for key in target_store.keys(condition=condition)))
+
+        for subject in subjects:
+            start = time.time()
+            result = test_subject(target_store, store, subject, condition, args.targets, args.models, args)
+            if result is None:
+                print('%s, %s: missing targets or models, skipped' % (subject, condition))
+                continue
+            tests.append(result)
+            print('%s, %s: %.1fs' % (subject, condition, time.time() - start), flush=True)
+
+        if args.noise_ceiling:
+            ceilings.append(noise_ceilings(target_store, subjects, condition, args.targets, args.method))
+
+    if not tests:
+        return 1
+
+    os.makedirs(out_path, exist_ok=True)
+    tests = pd.concat(tests, ignore_index=True)
+    tests.to_csv(os.path.join(out_path, 'model_permutation_tests.csv'), index=False)
+
+    summary = (tests.groupby(['condition', 'target', 'model'], sort=False)
+               .agg(mean_r=('r', 'mean'), n_significant=('p', lambda p: int((p < 0.05).sum())),
+                    n_subjects=('r', 'size'))
+               .reset_index())
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(summary.round(3).to_string(index=False))
+
+    if ceilings:
+        ceilings = pd.concat(ceilings, ignore_index=True)
+        ceilings.to_csv(os.path.join(out_path, 'noise_ceilings.csv'), index=False)
+        print(ceilings.round(3).to_string(index=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
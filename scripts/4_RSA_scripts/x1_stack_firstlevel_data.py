@@ -0,0 +1,86 @@
+# -------------------------------------------------------------------------
+
+# The purpose of this script is to arrange all the COPE files from each
+# subject into a single dataset per condition, containing the activity
+# patterns to all the words (averaged over runs), in alphabetical order.
+#
+# Python version of x1_stack_firstlevel_data.m, using cope_data.py (in
+# 0_custom_functions/python). The COPEs are read one at a time, and only the
+# voxels in the subject's COPE mask are kept, so several subjects can be
+# processed at once (-j). Writes, in subject_level_output/1_stacked_firstlevel_COPEs,
+# the cached (words x voxels) arrays that x2_run_glm_searchlights.py reads.
+# Subjects whose cache is current are skipped (--force to rebuild).
+#
+# Usage:
+#   python x1_stack_firstlevel_data.py
+#   python x1_stack_firstlevel_data.py --subjects subject-001 subject-002 -j 4
+
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Read top_dir
+top_dir = open('../top_dir_linux.txt').read().replace('\n', '')
+custom_func_dir = os.path.join(top_dir, 'scripts', '0_custom_functions', 'python')
+sys.path.insert(0, custom_func_dir)
+
+import cope_data
+import instrumentation
+
+# Define runs
+runs = ['quickread_1', 'quickread_2', 'quickread_3', 'quickread_4']
+
+# Define subjects
+subjects = ['subject-001', 'subject-002', 'subject-003', 'subject-004', 'subject-005', 'subject-006',
+            'subject-007', 'subject-008', 'subject-009', 'subject-010', 'subject-011', 'subject-012',
+            'subject-013', 'subject-014', 'subject-015', 'subject-016', 'subject-017', 'subject-018',
+            'subject-019', 'subject-020', 'subject-021', 'subject-022', 'subject-023', 'subject-024',
+            'subject-025', 'subject-026', 'subject-027', 'subject-028', 'subject-029', 'subject-030']
+
+# subjects 008, 009, 015, 018 should be removed (due to missing data or
+# ineligibility)
+bads = ['subject-008', 'subject-009', 'subject-015', 'subject-018']
+subjects = [s for s in subjects if s not in bads]
+
+# Define path to COPE files, and output path
+data_path = os.path.join(top_dir, 'MRIanalyses', 'quickread', 'subject_level_output')
+ds_write_path = os.path.join(data_path, '1_stacked_firstlevel_COPEs')
+
+
+# (this must be a top-level function so that it can be pickled)
+def stack_subject(subject_id, force=False):
+    start = time.time()
+    cope_dir = os.path.join(data_path, subject_id, 'firstLevelCOPEs2common_native_space_ants')
+    word_lists = cope_data.read_word_lists(top_dir, subject_id)
+    cope_data.build(ds_write_path, subject_id, cope_dir, word_lists, runs, force=force)
+    instrumentation.flush()
+    return subject_id, time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stack the first-level COPEs of every subject (Python version '
+                                                 'of x1_stack_firstlevel_data.m).')
+    parser.add_argument('--subjects', nargs='+', default=subjects, metavar='SUBJECT',
+                        help='subjects to stack (default: all)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of subjects processed at once (default: %(default)s)')
+    parser.add_argument('--force', action='store_true', help='rebuild caches that are current')
+    args = parser.parse_args(argv)
+
+    if args.jobs == 1:
+        for subject_id in args.subjects:
+            print('%s: %.1fs' % stack_subject(subject_id, args.force), flush=True)
+        return
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(stack_subject, subject_id, args.force) for subject_id in args.subjects]
+        for future in as_completed(futures):
+            print('%s: %.1fs' % future.result(), flush=True)
+
+
+if __name__ == '__main__':
+    main()
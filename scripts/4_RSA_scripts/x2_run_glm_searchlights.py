@@ -0,0 +1,153 @@
+# -------------------------------------------------------------------------
+
+# The purpose of this script is to perform RSA on data from each individual
+# subject, using a whole-brain searchlight.
+#
+# Python version of x2_run_glm_searchlights.m (no MATLAB needed), using
+# searchlight.py (in 0_custom_functions/python). It does the same steps, and
+# writes the same maps to the same files:
+#
+#   1. stack the COPE images of every word and run (as x1_stack_firstlevel_data.m),
+#      average each word over the runs, and remove useless voxels (non-finite, or
+#      constant over all the samples). The data are extracted and cached by
+#      cope_data.py (here if needed, or beforehand, for many subjects at once,
+#      with x1_stack_firstlevel_data.py)
+#   2. define the searchlight spheres (radius 3 voxels) over the remaining voxels,
+#      once per subject
+#   3. for each condition, regress the neural RDM of every sphere on the
+#      hypothesis models (glm_dsm, correlation distance, center_data)
+#   4. write one map per model: <subject>_<condition>_<model>_searchlight_results.nii.gz
+#
+# Models are read from the model store (see model_store.py), or from their CSV
+# files if they are not in the store.
+#
+# Usage:
+#   python x2_run_glm_searchlights.py
+#   python x2_run_glm_searchlights.py --subjects subject-001 subject-002 -j 16
+
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+
+# Read top_dir
+top_dir = open('../top_dir_linux.txt').read().replace('\n', '')
+custom_func_dir = os.path.join(top_dir, 'scripts', '0_custom_functions', 'python')
+sys.path.insert(0, custom_func_dir)
+
+import searchlight
+import cope_data
+import instrumentation
+from rdm import RDM
+from model_store import ModelStore
+
+# Define runs, conditions and models
+runs = ['quickread_1', 'quickread_2', 'quickread_3', 'quickread_4']
+conditions = ['aloud', 'silent']
+models = ['articulatory', 'orthographic', 'phonological', 'semantic', 'visual']
+
+# Define subjects
+subjects = ['subject-001', 'subject-002', 'subject-003', 'subject-004', 'subject-005', 'subject-006',
+            'subject-007', 'subject-008', 'subject-009', 'subject-010', 'subject-011', 'subject-012',
+            'subject-013', 'subject-014', 'subject-015', 'subject-016', 'subject-017', 'subject-018',
+            'subject-019', 'subject-020', 'subject-021', 'subject-022', 'subject-023', 'subject-024',
+            'subject-025', 'subject-026', 'subject-027', 'subject-028', 'subject-029', 'subject-030']
+
+# subjects 008, 009, 015, 018 should be removed (due to missing data or
+# ineligibility)
+bads = ['subject-008', 'subject-009', 'subject-015', 'subject-018']
+subjects = [s for s in subjects if s not in bads]
+
+# Define important paths, to make things easier later on
+data_path = os.path.join(top_dir, 'MRIanalyses', 'quickread', 'subject_level_output')
+assets_path = os.path.join(top_dir, 'MRIanalyses', 'assets')
+out_path = os.path.join(data_path, 'RSA_output', '1_searchlight_results')
+cache_path = os.path.join(data_path, '1_stacked_firstlevel_COPEs')
+store_path = os.path.join(assets_path, 'RSA_models', 'quickread')
+
+# Define parameters for our searchlight
+search_args = {'radius': 3, 'metric': 'correlation', 'center_data': True, 'measure': 'glm'}
+
+
+# Extract (or reuse) the cached COPE data of a subject: words x voxels, averaged
+# over runs, for each condition
+def load_subject(subject_id):
+    cope_dir = os.path.join(data_path, subject_id, 'firstLevelCOPEs2common_native_space_ants')
+    word_lists = cope_data.read_word_lists(top_dir, subject_id)
+    cope_data.build(cache_path, subject_id, cope_dir, word_lists, runs)
+    return cope_data.load_voxels(cache_path, subject_id)
+
+
+# The model RDM of a subject and condition, in the given word order
+def load_model(store, subject_id, condition, model, words):
+    if (subject_id, condition, model) in store:
+        rdm = store.get(subject_id, condition, model)
+    else:
+        rdm = RDM.read_csv(store.csv_path(assets_path, subject_id, condition, model))
+    return rdm.subset(words).values
+
+
+def run_subject(subject_id, store, n_jobs=1, block_size=256):
+    import nibabel as nib
+
+    with instrumentation.phase('searchlight.load', subject=subject_id):
+        ijk, info = load_subject(subject_id)
+    img = nib.load(info['reference'])
+    shape = info['shape']
+
+    # Use the useful voxels (those that are finite, and not constant, over all
+    # samples) to define the searchlight spheres
+    nbrhood = searchlight.spherical_neighbourhood(ijk, radius=search_args['radius'])
+    print('  %d voxels, %d-%d per sphere' % (len(ijk), nbrhood.sizes().min(), nbrhood.sizes().max()))
+
+    for condition in conditions:
+        start = time.time()
+
+        # Samples of each word, averaged over repeated samples (runs)
+        averaged, words = cope_data.load(cache_path, subject_id, condition)
+
+        # Hypothesis models, in the order in which they are defined by models
+        weights = searchlight.model_weights([load_model(store, subject_id, condition, model, words)
+                                             for model in models], measure=search_args['measure'])
+
+        results = searchlight.run(averaged, nbrhood, weights, center_data=search_args['center_data'],
+                                  block_size=block_size, n_jobs=n_jobs)
+
+        # Now save the results for each model to disk
+        for model, values in zip(models, results):
+            fn = os.path.join(out_path, '%s_%s_%s_searchlight_results.nii.gz' % (subject_id, condition, model))
+            searchlight.write_map(values, ijk, shape, img.affine, fn, header=img.header)
+
+        print('  %s: %.1fs' % (condition, time.time() - start), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the RSA searchlights (Python version of '
+                                                 'x2_run_glm_searchlights.m).')
+    parser.add_argument('--subjects', nargs='+', default=subjects, metavar='SUBJECT',
+                        help='subjects to run (default: all)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: all cores, %(default)s)')
+    parser.add_argument('--block-size', type=int, default=256,
+                        help='searchlight centres per block (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    os.makedirs(out_path, exist_ok=True)
+
+    # Create a text file as a record of the parameters we used
+    params_fn = os.path.join(out_path, 'searchlight_params_%s.txt' % time.strftime('%d-%b-%Y %H_%M_%S'))
+    with open(params_fn, 'w') as f:
+        for name, value in search_args.items():
+            f.write('%s,%s\n' % (name, value))
+        f.write('search_measure,searchlight.py\n')
+
+    store = ModelStore(store_path)
+    for subject_id in args.subjects:
+        print(subject_id)
+        run_subject(subject_id, store, n_jobs=args.jobs, block_size=args.block_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# -------------------------------------------------------------------------
+
+# The purpose of this script is to read in stacked searchlight results
+# from all subjects, and perform group-level statistical testing (i.e.,
+# compute Bayes factors) at every voxel. Statistical testing involves both:
+# 1. testing whether searchlight results are different from zero (in each
+# condition alone)
+# 2. testing whether searchlight results are different between aloud and
+# silent reading.
+#
+# Python version of x5_stack_searchlights.m and x6_bayes_stats.m, using
+# bayes_factors.py (in 0_custom_functions/python), which computes the Bayes
+# factors of all voxels at once instead of calling bf.ttest() per voxel. It
+# writes the same maps to the same files. The searchlight maps are stacked
+# into stacked_searchlight_results_<condition>_<model>.nii (4D, one volume per
+# subject, MNI mask with the cerebellum removed), which are only rebuilt when a
+# subject's map changes.
+#
+# The aloud-silent and silent-aloud maps are split by the group-average maps,
+# which are computed here from the stacked maps (the same averages as
+# x4_average_searchlight_results.sh).
+#
+# Usage:
+#   python x6_bayes_stats.py
+#   python x6_bayes_stats.py --models semantic visual
+
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+# Read top_dir
+top_dir = open('../top_dir_linux.txt').read().replace('\n', '')
+custom_func_dir = os.path.join(top_dir, 'scripts', '0_custom_functions', 'python')
+sys.path.insert(0, custom_func_dir)
+
+import bayes_factors
+
+# Define models and conditions
+models = ['articulatory', 'orthographic', 'phonological', 'semantic', 'visual']
+conditions = ['aloud', 'silent']
+
+# Define list of subjects
+subjects = ['subject-001', 'subject-002', 'subject-003', 'subject-004', 'subject-005', 'subject-006',
+            'subject-007', 'subject-008', 'subject-009', 'subject-010', 'subject-011', 'subject-012',
+            'subject-013', 'subject-014', 'subject-015', 'subject-016', 'subject-017', 'subject-018',
+            'subject-019', 'subject-020', 'subject-021', 'subject-022', 'subject-023', 'subject-024',
+            'subject-025', 'subject-026', 'subject-027', 'subject-028', 'subject-029', 'subject-030']
+
+# subjects 008, 009, 015, 018 should be removed (due to missing data or
+# ineligibility)
+bads = ['subject-008', 'subject-009', 'subject-015', 'subject-018']
+subjects = [s for s in subjects if s not in bads]
+
+# Define paths
+assets_path = os.path.join(top_dir, 'MRIanalyses', 'assets')
+searchlight_path = os.path.join(top_dir, 'MRIanalyses', 'quickread', 'subject_level_output', 'RSA_output',
+                                '2_searchlight_results_in_MNI')
+data_path = os.path.join(top_dir, 'MRIanalyses', 'quickread', 'group_level_output', 'RSA_output')
+
+MNI_mask_fn = os.path.join(assets_path, 'MNI152_T1_2mm_brain_mask.nii.gz')
+cerebellum_mask_fn = os.path.join(assets_path, 'Harvard_Oxford_ROIs', 'Cerebellum.nii.gz')
+
+
+# MNI template mask, with the cerebellum removed (we want to remove the cerebellum
+# from all maps prior to statistical analysis)
+def brain_mask():
+    import nibabel as nib
+    mni = np.asarray(nib.load(MNI_mask_fn).dataobj) != 0
+    cerebellum = np.asarray(nib.load(cerebellum_mask_fn).dataobj) != 0
+    return mni & ~cerebellum
+
+
+def stacked_results(model, condition, mask):
+    """The searchlight results of every subject for a model and condition, as a
+    (subjects x voxels in mask) array, and the stacked NIfTI file."""
+    out_path = os.path.join(data_path, '%s_group_searchlight_output' % model)
+    os.makedirs(out_path, exist_ok=True)
+
+    filenames = [os.path.join(searchlight_path, '%s_%s_%s_searchlight_results_MNI.nii.gz' % (s, condition, model))
+                 for s in subjects]
+    stacked_fn = os.path.join(out_path, 'stacked_searchlight_results_%s_%s.nii' % (condition, model))
+    bayes_factors.stack_maps(filenames, stacked_fn, mask)
+    return bayes_factors.load_stacked(stacked_fn, mask), stacked_fn
+
+
+# Write BF values for the useful voxels of the mask
+def write_bayes_map(values, mask, useful, reference, filename):
+    voxels = mask.copy()
+    voxels[mask] = useful
+    bayes_factors.write_map(values, voxels, reference, filename)
+
+
+def main(argv=None):
+    import nibabel as nib
+
+    parser = argparse.ArgumentParser(description='Compute the group-level Bayes factor maps (Python version '
+                                                 'of x5_stack_searchlights.m and x6_bayes_stats.m).')
+    parser.add_argument('--models', nargs='+', default=models, help='models (default: all)')
+    args = parser.parse_args(argv)
+
+    mask = brain_mask()
+
+    # Loop through models
+    for model in args.models:
+        print(model)
+        start = time.time()
+        out_path = os.path.join(data_path, '%s_group_searchlight_output' % model)
+
+        data = {}
+        for condition in conditions:
+            data[condition], stacked_fn = stacked_results(model, condition, mask)
+        reference = nib.load(stacked_fn)
+
+        # First, run paired-samples t-test comparing aloud vs silent (over the voxels that
+        # are useful in both conditions)
+        useful = bayes_factors.useful_voxels(data['aloud'], data['silent'])
+        bayes_AvS = bayes_factors.bf_ttest(data['aloud'][:, useful], data['silent'][:, useful])
+
+        # Decompose the AvS map into aloud-silent and silent-aloud, using the group-average
+        # searchlight maps
+        aloud_av = data['aloud'][:, useful].mean(axis=0)
+        silent_av = data['silent'][:, useful].mean(axis=0)
+
+        for name, keep in [('aloud-silent', aloud_av > silent_av), ('silent-aloud', aloud_av < silent_av)]:
+            useful_keep = useful.copy()
+            useful_keep[useful] = keep
+            write_bayes_map(bayes_AvS[keep], mask, useful_keep, reference,
+                            os.path.join(out_path, 'bayes_map_%s_%s.nii.gz' % (name, model)))
+
+        # Next, run onesample t-test on each condition alone (test correlations against H0 of zero).
+        for condition in conditions:
+            useful = bayes_factors.useful_voxels(data[condition])
+            bayes_thiscond = bayes_factors.bf_ttest(data[condition][:, useful], tail='right')
+            write_bayes_map(bayes_thiscond, mask, useful, reference,
+                            os.path.join(out_path, 'bayes_map_%s_%s.nii.gz' % (condition, model)))
+
+        print('  %.1fs' % (time.time() - start), flush=True)
+
+
+if __name__ == '__main__':
+    main()
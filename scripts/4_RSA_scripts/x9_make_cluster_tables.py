@@ -0,0 +1,105 @@
+# -------------------------------------------------------------------------
+
+# The purpose of this script is to read in the thresholded whole-brain bayes
+# maps for each model, do clustering, and write the results to tables. Note
+# that the tables report the center of gravity (COG) coordinates of each
+# cluster, rather than peak coordinates.
+#
+# Python version of x9_make_cluster_tables.sh (no FSL needed), using
+# clusters.py (in 0_custom_functions/python). Each map is read once and
+# labelled with a single connected-components pass (26-connectivity, at least
+# 20 voxels, as FSL's cluster), and the anatomical labels come from the
+# Harvard-Oxford masks, precomputed into one label volume. No temporary files
+# are written. For every model and contrast, it writes:
+#
+#   cluster_tables/cluster_table_<model>_<contrast>.csv     (for x11_parse_cluster_tables.py)
+#   <bayes map>_no_small_clusters.nii.gz                     (for x10_mask_conditions.sh, and figures)
+#
+# with the same columns and values as the shell script: despite its name,
+# Cluster extent (mm^3) is the number of voxels of the cluster (as FSL's cluster
+# reports it), and NEW CE its number of voxels and volume in mm^3 (as fslstats
+# -V prints them, e.g. "120 960.000000"). Maps that don't exist are skipped.
+#
+# Usage:
+#   python x9_make_cluster_tables.py
+#   python x9_make_cluster_tables.py --models articulatory --contrasts aloud-silent
+
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+import numpy as np
+
+# Read top_dir
+top_dir = open('../top_dir_linux.txt').read().replace('\n', '')
+custom_func_dir = os.path.join(top_dir, 'scripts', '0_custom_functions', 'python')
+sys.path.insert(0, custom_func_dir)
+
+import clusters
+
+# Define contrasts and models
+models = ['articulatory', 'orthographic', 'phonological', 'semantic', 'visual']
+contrasts = ['aloud', 'silent', 'aloud-silent', 'silent-aloud']
+
+# Define path to data, and output path for tables
+data_dir = os.path.join(top_dir, 'MRIanalyses', 'quickread', 'group_level_output', 'RSA_output')
+output_dir = os.path.join(data_dir, '1_tables_and_figures', 'cluster_tables')
+
+# Define path to Harvard-Oxford anatomical masks
+anat_mask_dir = os.path.join(top_dir, 'MRIanalyses', 'assets', 'Harvard_Oxford_ROIs')
+
+# Define minimum cluster extent (voxels), and the threshold for cluster (the maps
+# have already been thresholded)
+min_extent = 20
+threshold = 1
+
+
+# The Bayes map of a model and contrast. The filename depends on whether we are
+# looking at individual conditions or contrasts
+def bayes_map_fname(model, contrast):
+    if '-' in contrast:
+        name = 'bayes_map_%s_%s_thresh_masked_with_minuend' % (contrast, model)
+    else:
+        name = 'bayes_map_%s_%s_thresh' % (contrast, model)
+    return os.path.join(data_dir, '%s_group_searchlight_output' % model, name)
+
+
+def main(argv=None):
+    import nibabel as nib
+
+    parser = argparse.ArgumentParser(description='Make the cluster tables (Python version of '
+                                                 'x9_make_cluster_tables.sh).')
+    parser.add_argument('--models', nargs='+', default=models, help='models (default: all)')
+    parser.add_argument('--contrasts', nargs='+', default=contrasts, help='contrasts (default: all)')
+    parser.add_argument('--min-extent', type=int, default=min_extent,
+                        help='minimum cluster extent, in voxels (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    os.makedirs(output_dir, exist_ok=True)
+    atlas_labels, membership, names = clusters.load_atlas(anat_mask_dir)
+
+    # Loop through contrasts
+    for contrast in args.contrasts:
+        for model in args.models:
+            bayes_map = bayes_map_fname(model, contrast)
+            if not os.path.exists(bayes_map + '.nii.gz'):
+                print('%s %s: no %s.nii.gz, skipped' % (contrast, model, os.path.basename(bayes_map)))
+                continue
+
+            img = nib.load(bayes_map + '.nii.gz')
+            values = np.asarray(img.dataobj, dtype=np.float32)
+            table, kept = clusters.cluster_table(values, img.affine, atlas_labels, membership, names,
+                                                 threshold=threshold, min_extent=args.min_extent)
+
+            # The map with small clusters removed (useful for figures)
+            out = nib.Nifti1Image(kept, img.affine, header=img.header)
+            out.set_data_dtype(np.float32)
+            nib.save(out, bayes_map + '_no_small_clusters.nii.gz')
+
+            table.to_csv(os.path.join(output_dir, 'cluster_table_%s_%s.csv' % (model, contrast)), index=False)
+            print('%s %s: %d clusters' % (contrast, model, len(table)))
+
+
+if __name__ == '__main__':
+    main()